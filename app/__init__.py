@@ -1,42 +1,87 @@
+"""
+The microblog package.
+
+create_app() builds the Flask application: it loads the config, attaches the extensions below, sets up logging and
+registers the views. The extensions are created here without an application, so importing the package, or just
+app.models from a script, stays cheap: no OpenID, no views, no logging handlers. The search index and the caches start
+with the application that uses them.
+
+'app.app' is the application built from config.py, made the first time it is asked for, so the scripts can keep
+doing 'from app import app'.
+"""
 import os
+import threading
 
 from flask import Flask
-from flask_openid import OpenID  # this takes care of the identification and getting the ID for the user
-from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager  # takes care of the inputs and user handling
-
-# create an application object
-from config import basedir, MAIL_PASSWORD, MAIL_USERNAME, MAIL_PORT, MAIL_SERVER, ADMINS
-
-app = Flask(__name__)
-app.config.from_object('config')  # why is this coming from 'config' object?
+from app.engine import SQLAlchemy  # flask_sqlalchemy's, with the pool settings applied to SQLite too
 
 # SQLAlchemy is Python SQL toolkit and Object Relational Mapper
-db = SQLAlchemy(app)
-# the views are the handlers that response to requests from web browser or other clients
+db = SQLAlchemy()
 
 lm = LoginManager()
-lm.init_app(app)
-lm.login_view = 'login'  # this is the view that logs the user in
-oid = OpenID(app, os.path.join(basedir, "tmp"))
+lm.login_view = 'main.login'  # this is the view that logs the user in
+
+_default_app_lock = threading.Lock()
+
+
+def create_app(config='config', **overrides):
+    """
+    :param config: the object or module path to load the config from
+    :param overrides: config values to set on top of it, e.g. TESTING=True
+    :return: the application
+    """
+    app = Flask(__name__)
+    app.config.from_object(config)
+    app.config.update(overrides)
+
+    db.init_app(app)
+    lm.init_app(app)
+    if not app.debug and not app.testing:
+        _init_logging(app)
 
-# enabling email to be sent when there is an error
-if not app.debug:
+    # the views are the handlers that response to requests from web browser or other clients
+    from app import api, models, views
+    from app.fragments import fragments
+    from app.last_seen import tracker as last_seen
+    from app.profiling import profiler
+    from app import sharding
+    from app.admission import admission
+    from app.replicas import router
+    sharding.init_app(app)
+    router.init_app(app)
+    models.init_app(app)
+    views.init_app(app)
+    admission.init_app(app)
+    app.register_blueprint(api.blueprint)
+    last_seen.init_app(app)
+    fragments.init_app(app)
+    profiler.init_app(app)
+    return app
+
+
+def _init_logging(app):
     import logging
-    from logging.handlers import SMTPHandler
+    from logging.handlers import RotatingFileHandler
+    from app.mail_log import DigestMailHandler
+    from config import basedir
+
+    # enabling email to be sent when there is an error, in digests sent from a background thread (see
+    # app/mail_log.py)
     credentials = None
-    if MAIL_USERNAME or MAIL_PASSWORD:
-        credentials = (MAIL_USERNAME, MAIL_PASSWORD)
-    mail_handler = SMTPHandler((MAIL_SERVER, MAIL_PORT), 'no-reply@' + MAIL_SERVER, ADMINS, "app failure", credentials)
+    if app.config['MAIL_USERNAME'] or app.config['MAIL_PASSWORD']:
+        credentials = (app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD'])
+    mail_handler = DigestMailHandler((app.config['MAIL_SERVER'], app.config['MAIL_PORT']),
+                                     'no-reply@' + app.config['MAIL_SERVER'], app.config['ADMINS'], "app failure",
+                                     credentials, queue_size=app.config['MAIL_QUEUE_SIZE'],
+                                     delay=app.config['MAIL_DIGEST_DELAY'], interval=app.config['MAIL_MIN_INTERVAL'],
+                                     max_records=app.config['MAIL_DIGEST_MAX'], timeout=app.config['MAIL_TIMEOUT'])
     mail_handler.setLevel(logging.ERROR)
     app.logger.addHandler(mail_handler)
 
-
-# enable logging to a file
-if not app.debug:
-    import logging
-    from logging.handlers import RotatingFileHandler
-    file_handler = RotatingFileHandler('tmp/microblog.log', 'a', 1*1024*1024, 10)
+    # enable logging to a file
+    file_handler = RotatingFileHandler(os.path.join(basedir, 'tmp', 'microblog.log'), 'a',
+                                       1*1024*1024, 10)
     file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'))
     app.logger.setLevel(logging.INFO)
     file_handler.setLevel(logging.INFO)
@@ -44,5 +89,11 @@ if not app.debug:
     app.logger.info('microblog startup')
 
 
-# this app is different from the 'app' above.. this is the app module for which we will import views from
-from app import views, models
\ No newline at end of file
+def __getattr__(name):
+    # the default application, built on first use (PEP 562 module attribute)
+    if name != 'app':
+        raise AttributeError("module 'app' has no attribute %r" % name)
+    with _default_app_lock:
+        if 'app' not in globals():
+            globals()['app'] = create_app()
+    return globals()['app']
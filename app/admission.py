@@ -0,0 +1,240 @@
+"""
+Admission control of the views that write.
+
+index() (POST), follow(), unfollow() and edit() each commit, and SQLite lets one writer in at a time: a burst from one
+client or a bot would keep the write lock busy and everyone's writes queue up behind it, holding worker threads the
+reads need too. Requests to the views marked @limit_writes go through two checks before the view runs:
+
+- rate limiting: every user (or address, logged out) has a token bucket of RATE_LIMIT_USER_BURST writes, refilled at
+  RATE_LIMIT_USER_RATE a second, and all of them share one of RATE_LIMIT_GLOBAL_BURST at RATE_LIMIT_GLOBAL_RATE. A
+  write finding its bucket empty gets a 429 with the seconds until the next token in Retry-After
+- load shedding: while SHED_MAX_WRITES writes are already in progress in the worker process, or while the writes
+  wait more than SHED_MAX_LOCK_WAIT seconds on average for the database, new ones get a 503 with Retry-After
+  SHED_RETRY_AFTER. The wait is measured on the first write statement of every transaction, which is where SQLite
+  takes the write lock, and fades with a half-life of LOCK_WAIT_HALF_LIFE seconds, so shedding stops on its own
+
+The buckets are kept in the process (MemoryBuckets), or with RATE_LIMIT_STORE in the store shared by the workers (see
+app/shared_store.py) so the limits hold across them. The refusals are plain text, cheap to send when busy.
+bench_overload.py shows the reads keeping their latency under a flood of writes.
+"""
+import math
+import threading
+import time
+
+from flask import Response, current_app, g, request, session
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app import shared_store
+
+LOCK_WAIT_HALF_LIFE = 2.0
+WRITES = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+
+def limit_writes(*methods):
+    """
+    decorator for the views whose 'methods' requests write, which then go through admission control. Put it right
+    under the route
+    """
+    def decorator(view):
+        view.limit_writes = methods
+        return view
+    return decorator
+
+
+class MemoryBuckets(object):
+    """
+    token buckets kept in this process
+    """
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self._buckets = {}  # key -> (tokens, time they were counted)
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, now=None):
+        """
+        take a token from the bucket 'key', holding 'burst' tokens and refilled at 'rate' a second
+
+        :return: 0 when there was a token, otherwise the seconds until there is one
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            tokens, then = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - then) * rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                return 0
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.maxsize:
+                self._drop_full(now, rate, burst)
+            return (1 - tokens) / rate
+
+    def _drop_full(self, now, rate, burst):
+        # a full bucket is the same as no bucket
+        for key, (tokens, then) in list(self._buckets.items()):
+            if tokens + (now - then) * rate >= burst:
+                del self._buckets[key]
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class SharedStoreBuckets(object):
+    """
+    token buckets in a shared store. Each is kept as the time at which it will be full again (the generic cell rate
+    algorithm), moved forward by a token's worth of time with INCRBYFLOAT for every write, so a write costs one or two
+    commands and no lock. When two workers find the same bucket full at the same moment both writes get in, so the
+    limit can be exceeded by a write or two then, never undercut
+    """
+
+    def __init__(self, store, prefix='rate:'):
+        self.store = store
+        self.prefix = prefix
+
+    def take(self, key, rate, burst, now=None):
+        """
+        see MemoryBuckets.take()
+        """
+        now = time.time() if now is None else now
+        key = self.prefix + key
+        interval = 1.0 / rate
+        full_at = float(self.store.incrbyfloat(key, interval))
+        if full_at < now + interval:  # it was full, count from now
+            self.store.set(key, repr(now + interval), ex=int(math.ceil(interval)))
+            return 0
+        self.store.expire(key, int(math.ceil(full_at - now)))
+        if full_at - now > burst * interval:
+            self.store.incrbyfloat(key, -interval)  # not taken after all
+            return full_at - now - burst * interval
+        return 0
+
+    def clear(self):
+        # only the buckets, the store can hold other things (see FOLLOW_GRAPH_STORE)
+        keys = list(self.store.scan_iter(match=self.prefix + '*'))
+        if keys:
+            self.store.delete(*keys)
+
+
+class Admission(object):
+    def __init__(self, app=None):
+        self.app = None
+        self.buckets = MemoryBuckets()
+        self.lock = threading.Lock()
+        self.writing = 0  # writes admitted and not finished yet, in this process
+        self.lock_wait = 0.0  # average wait for the write lock, as of lock_wait_at
+        self.lock_wait_at = time.time()
+        self.refused = {429: 0, 503: 0}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        store = app.config['RATE_LIMIT_STORE']
+        self.buckets = SharedStoreBuckets(shared_store.connect(store)) if store else MemoryBuckets()
+        # ahead of the other before_request functions (the profiler's aside, see create_app()), so a refusal costs
+        # as little as possible: no user loaded, nothing touched
+        app.before_request_funcs.setdefault(None, []).insert(0, self._admit)
+        app.teardown_request(self._done)
+        # the engine events are global, once is enough however many apps there are
+        if not event.contains(Engine, 'before_cursor_execute', self._sql_started):
+            event.listen(Engine, 'before_cursor_execute', self._sql_started)
+            event.listen(Engine, 'after_cursor_execute', self._sql_finished)
+            event.listen(Engine, 'handle_error', self._sql_failed)
+            event.listen(Engine, 'commit', self._transaction_over)
+            event.listen(Engine, 'rollback', self._transaction_over)
+
+    def _admit(self):
+        view = current_app.view_functions.get(request.endpoint)
+        if request.method not in getattr(view, 'limit_writes', ()):
+            return
+        config = current_app.config
+        # the id Flask-Login keeps in the session, 'user_id' up to 0.4 and '_user_id' after, without loading the user
+        who = session.get('user_id') or session.get('_user_id') or request.remote_addr
+        wait = (self._take('user:%s' % who, config['RATE_LIMIT_USER_RATE'], config['RATE_LIMIT_USER_BURST']) or
+                self._take('global', config['RATE_LIMIT_GLOBAL_RATE'], config['RATE_LIMIT_GLOBAL_BURST']))
+        if wait:
+            return self._refuse(429, wait)
+        max_writes, max_lock_wait = config['SHED_MAX_WRITES'], config['SHED_MAX_LOCK_WAIT']
+        with self.lock:
+            overloaded = ((max_writes is not None and self.writing >= max_writes) or
+                          (max_lock_wait is not None and self.average_lock_wait() > max_lock_wait))
+            if not overloaded:
+                self.writing += 1
+                g.admitted_write = True
+        if overloaded:
+            return self._refuse(503, config['SHED_RETRY_AFTER'])
+
+    def _take(self, key, rate, burst):
+        if rate is None:
+            return 0
+        return self.buckets.take(key, rate, burst)
+
+    def _refuse(self, status, seconds):
+        with self.lock:
+            self.refused[status] += 1
+        message = 'Too many writes, try again later' if status == 429 else 'Too busy, try again later'
+        return Response(message + '\n', status, {'Retry-After': str(max(1, int(math.ceil(seconds))))},
+                        mimetype='text/plain')
+
+    def _done(self, exception):
+        if g.pop('admitted_write', False):
+            with self.lock:
+                self.writing -= 1
+
+    def average_lock_wait(self, now=None):
+        """
+        :return: the seconds the writes waited for the write lock lately, on average
+        """
+        now = time.time() if now is None else now
+        return self.lock_wait * 0.5 ** ((now - self.lock_wait_at) / LOCK_WAIT_HALF_LIFE)
+
+    def observe_lock_wait(self, seconds, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            self.lock_wait = (self.average_lock_wait(now) + seconds) / 2
+            self.lock_wait_at = now
+
+    def _sql_started(self, conn, cursor, statement, parameters, context, executemany):
+        if 'admission_locked' not in conn.info and statement.lstrip()[:7].upper().startswith(WRITES):
+            conn.info['admission_locked'] = time.time()
+
+    def _sql_finished(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.get('admission_locked')
+        if started is not None and started is not True:
+            conn.info['admission_locked'] = True  # the transaction has the lock until it ends
+            self.observe_lock_wait(time.time() - started)
+
+    def _sql_failed(self, context):
+        # a write that gave up on the lock after SQLITE_BUSY_TIMEOUT ('database is locked') waited the longest of all
+        if context.connection is not None:
+            started = context.connection.info.pop('admission_locked', None)
+            if started is not None and started is not True:
+                self.observe_lock_wait(time.time() - started)
+
+    def _transaction_over(self, conn):
+        conn.info.pop('admission_locked', None)
+
+    def metrics(self):
+        """
+        :return: the writes in progress, the lock wait and the refusals, in the Prometheus text format
+        """
+        with self.lock:
+            lines = ['# TYPE microblog_writes_in_progress gauge',
+                     'microblog_writes_in_progress %d' % self.writing,
+                     '# TYPE microblog_lock_wait_seconds gauge',
+                     'microblog_lock_wait_seconds %r' % self.average_lock_wait(),
+                     '# TYPE microblog_refused_total counter']
+            lines.extend('microblog_refused_total{status="%d"} %d' % item for item in sorted(self.refused.items()))
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        self.buckets.clear()
+        with self.lock:
+            self.lock_wait = 0.0
+            self.refused = {429: 0, 503: 0}
+
+
+# admission control for the app, see create_app()
+admission = Admission()
@@ -0,0 +1,215 @@
+"""
+JSON API over the timelines and search, for the mobile clients.
+
+    GET /api/timeline                   the home timeline of the logged in user
+    GET /api/user/<nickname>/posts      the posts of one user
+    GET /api/search?q=<terms>           search results among the posts that are not archived, best match first
+
+Every endpoint takes 'fields', a comma separated subset of POST_FIELDS (all of them by default), and the timelines
+take 'limit' and the 'cursor' returned as 'next' by the previous page:
+
+    {"posts": [{"id": 12, "body": "...", ...}, ...], "next": "bzoxNDk..."}
+
+Only the columns asked for are selected, so no Post or User object is built, and the response is streamed: the rows
+are serialized one at a time as the database cursor hands them over instead of the whole page being assembled in
+memory first. A client that is not logged in gets a 401 with a JSON error, not the redirect to the login page.
+
+The timelines merge in the archived posts once they reach back past the archival cutoff, like the pages do (see
+app/archive.py). /api/search only finds the posts that are not archived, unlike the search page: it streams the
+columns asked for from a single query joining the search index to the post table, in the order of the ranking, while
+the archived posts are in a table of their own.
+"""
+import heapq
+import itertools
+import json
+from collections import OrderedDict
+from functools import wraps
+
+from flask import Blueprint, Response, g, jsonify, request, stream_with_context
+from flask_login import current_user
+
+from app import timeline
+from app.archive import cutoff
+from app.models import ArchivedPost, User, Post
+from app.pagination import OLDER, decode_cursor, encode_cursor, older_than
+from app.replicas import read_replica
+from app.search import search_query
+from config import API_PER_PAGE, API_MAX_PER_PAGE, MAX_SEARCH_RESULTS
+
+
+def field_columns(model):
+    """
+    :param model: Post, or ArchivedPost for the archived posts
+    :return: the column of every field
+    """
+    return OrderedDict([
+        ('id', model.id),
+        ('body', model.body),
+        ('timestamp', model.timestamp),
+        ('author_id', model.user_id),
+        ('author', User.nickname),
+        ('about_me', User.about_me),
+    ])
+
+
+POST_FIELDS = field_columns(Post)
+ARCHIVED_FIELDS = field_columns(ArchivedPost)
+AUTHOR_FIELDS = ('author', 'about_me')  # the ones that need the user table joined in
+
+blueprint = Blueprint('api', __name__, url_prefix='/api')
+
+
+def bad_request(message):
+    response = jsonify(error=message)
+    response.status_code = 400
+    return response
+
+
+def login_required(view):
+    """
+    flask_login's login_required for the API: a client that is not logged in gets a 401 and a JSON error
+    """
+    @wraps(view)
+    def decorated(*args, **kwargs):
+        if not current_user.is_authenticated:
+            response = jsonify(error='login required')
+            response.status_code = 401
+            return response
+        return view(*args, **kwargs)
+    return decorated
+
+
+def requested_fields():
+    """
+    :return: the names of the fields asked for, None when one of them does not exist
+    """
+    names = [name for name in request.args.get('fields', '').split(',') if name] or list(POST_FIELDS)
+    if any(name not in POST_FIELDS for name in names):
+        return None
+    return names
+
+
+def select_fields(query, fields, model=Post):
+    """
+    :return: 'query' reading only the timestamp, the id and 'fields' of the posts, in that order
+    """
+    if any(name in AUTHOR_FIELDS for name in fields):
+        query = query.join(User, User.id == model.user_id)
+    columns = POST_FIELDS if model is Post else ARCHIVED_FIELDS
+    # the timestamp and id of the last post go into the cursor, whether they were asked for or not
+    return query.with_entities(model.timestamp, model.id, *[columns[name] for name in fields])
+
+
+def stream_posts(query, fields, limit, next_cursor=True, archive=None):
+    """
+    the response streaming the posts of 'query' as JSON
+
+    :param query: a Post query, ordered the way the posts are to be listed
+    :param fields: names from POST_FIELDS
+    :param limit: the most posts to send
+    :param next_cursor: whether to read one post more than 'limit' and send the cursor of the next page
+    :param archive: the same posts in the archive, newest first too, see app/archive.py. They are merged in from the
+    first post older than the archival cutoff, or once 'query' runs out
+    :return:
+    """
+    wanted = limit + 1 if next_cursor else limit
+    query = select_fields(query, fields).limit(wanted).yield_per(100)
+    before = cutoff() if archive is not None else None
+
+    def rows():
+        read = 0
+        posts = iter(query)
+        for row in posts:
+            if archive is not None and row[0] < before:
+                posts = itertools.chain([row], posts)
+                break
+            read += 1
+            yield row
+        if archive is not None and read < wanted:
+            archived = select_fields(archive, fields, ArchivedPost).limit(wanted - read).yield_per(100)
+            # rows are (timestamp, id, ...)
+            for row in heapq.merge(posts, archived, key=lambda row: row[:2], reverse=True):
+                yield row
+
+    def generate():
+        yield '{"posts": ['
+        last = more = None
+        for count, row in enumerate(rows()):
+            if count == limit:
+                more = True  # the row past the limit, only there to tell whether there is a next page
+                break
+            if count:
+                yield ', '
+            yield json.dumps(OrderedDict((name, serialize(value)) for name, value in zip(fields, row[2:])))
+            last = row
+        cursor = encode_cursor(OLDER, last[0], last[1]) if more else None
+        yield '], "next": %s}' % json.dumps(cursor)
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+def serialize(value):
+    if hasattr(value, 'isoformat'):
+        return value.isoformat() + 'Z'
+    return value
+
+
+def timeline_page(query, timestamp_column=Post.timestamp, id_column=Post.id, archive=None):
+    """
+    :param archive: the same timeline over the archived posts, read past the end of 'query'
+    """
+    fields = requested_fields()
+    if fields is None:
+        return bad_request('fields can be any of ' + ', '.join(POST_FIELDS))
+    try:
+        limit = max(1, min(int(request.args.get('limit', API_PER_PAGE)), API_MAX_PER_PAGE))
+    except ValueError:
+        return bad_request('limit must be a number')
+    cursor = request.args.get('cursor')
+    if cursor:
+        position = decode_cursor(cursor)
+        if position is None or position[0] != OLDER:
+            return bad_request('invalid cursor')
+        query = older_than(query, position[1], position[2], timestamp_column, id_column)
+        if archive is not None:
+            archive = older_than(archive, position[1], position[2], ArchivedPost.timestamp, ArchivedPost.id)
+    query = query.order_by(None).order_by(timestamp_column.desc(), id_column.desc())
+    if archive is not None and cutoff() is not None:
+        archive = archive.order_by(None).order_by(ArchivedPost.timestamp.desc(), ArchivedPost.id.desc())
+    else:
+        archive = None
+    return stream_posts(query, fields, limit, archive=archive)
+
+
+@blueprint.route('/timeline')
+@read_replica
+@login_required
+def api_timeline():
+    return timeline_page(timeline.home_posts(g.user, load_authors=False), *timeline.sort_columns(),
+                         archive=timeline.home_posts(g.user, load_authors=False, archived=True))
+
+
+@blueprint.route('/user/<nickname>/posts')
+@read_replica
+@login_required
+def api_user_posts(nickname):
+    user = User.query.filter_by(nickname=nickname).first()
+    if user is None:
+        response = jsonify(error='user %s not found' % nickname)
+        response.status_code = 404
+        return response
+    return timeline_page(user.sorted_posts(load_authors=False),
+                         archive=user.sorted_posts(load_authors=False, archived=True))
+
+
+@blueprint.route('/search')
+@read_replica
+@login_required
+def api_search():
+    fields = requested_fields()
+    if fields is None:
+        return bad_request('fields can be any of ' + ', '.join(POST_FIELDS))
+    query = search_query(request.args.get('q', ''))
+    if query is None:
+        return bad_request('q must contain a word to search for')
+    return stream_posts(query, fields, MAX_SEARCH_RESULTS, next_cursor=False)
@@ -0,0 +1,78 @@
+"""
+Hot/cold archival of the old posts.
+
+The timelines almost only ever show recent posts, yet sorted_posts() and followed_posts() run against every post ever
+written. With ARCHIVE_AFTER_DAYS set, archive_posts() (see db_archive.py) moves the posts older than that many days
+from the post table to post_archive (ArchivedPost), next to it in the same database, or on the same shard with sharded
+posts. The post table and its indexes then only hold the recent posts, which stay in the page cache.
+
+The posts are moved in chunks, each copied and deleted in its own transaction, so the app keeps serving requests in
+between and an interrupted run loses nothing. Reading them stays transparent:
+
+- pagination.paginate() and the API timelines read the post table, and merge in the archive by (timestamp, id) for
+  the pages that reach back past the cutoff. Everything archived is older than it, so the pages newer than that
+  never touch the archive. The post table can still have older posts (see below), the merge keeps them in order
+- search keeps the archived posts in its index and loads them from the archive (see app/search.py)
+- posts_count still counts them, and recount() too
+
+Archived posts keep their id. The post with the greatest id always stays in the post table however old it is, so
+that SQLite keeps numbering the new posts after all the archived ones. They leave the materialized timelines
+(TIMELINE_ENABLED), the pages past those read the followed_posts() join of the archive.
+"""
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import and_, func, select
+
+from app import db, sharding
+from app.models import ArchivedPost, Post, timeline
+
+
+def cutoff(app=None):
+    """
+    :return: the time before which posts are archived, None when archival is off
+    """
+    days = (app or current_app).config['ARCHIVE_AFTER_DAYS']
+    if not days:
+        return None
+    return datetime.utcnow() - timedelta(days=days)
+
+
+def archive_posts(chunk_size=1000, pause=0, progress=None):
+    """
+    move the posts older than cutoff() to the archive, on every shard
+
+    :param chunk_size: posts moved per transaction
+    :param pause: seconds to wait between chunks, leaving the database to the requests
+    :param progress: a bulk.Progress
+    :return: the number of posts moved
+    """
+    before = cutoff()
+    if before is None:
+        return 0
+    post = Post.__table__
+    columns = [post.c.id, post.c.body, post.c.timestamp, post.c.user_id]
+    moved = 0
+    for engine in sharding.engines() or [db.engine]:
+        with engine.connect() as connection:
+            newest = connection.execute(select([func.max(post.c.id)])).scalar()
+        if newest is None:
+            continue
+        while True:
+            with engine.begin() as connection:
+                ids = [id for id, in connection.execute(select([post.c.id]).where(and_(
+                    post.c.timestamp < before, post.c.id < newest)).order_by(post.c.id).limit(chunk_size))]
+                if not ids:
+                    break
+                connection.execute(ArchivedPost.__table__.insert().from_select(
+                    [column.name for column in columns], select(columns).where(post.c.id.in_(ids))))
+                connection.execute(post.delete().where(post.c.id.in_(ids)))
+                if not sharding.count():  # the shards have no timeline table
+                    connection.execute(timeline.delete().where(timeline.c.post_id.in_(ids)))
+            moved += len(ids)
+            if progress is not None:
+                progress.add(len(ids))
+            if pause:
+                time.sleep(pause)
+    return moved
@@ -0,0 +1,207 @@
+"""
+Bulk loading of users and posts migrated in from other systems, see db_import.py.
+
+Going through the ORM costs an object, a flush and the after_insert events for every row. Here the records are read
+as a stream, turned into plain dicts and written with one executemany INSERT per chunk, each chunk in its own
+transaction (one per shard with sharded posts), so memory use stays flat and an interrupted import keeps what it
+already wrote. Authors are given by nickname and resolved through a map of all the nicknames read once up front.
+
+Because the ORM events don't run, what they would have maintained is caught up once at the end by finish(): the
+self follow of every new user, the search index, the counters on User and the materialized timelines.
+"""
+import csv
+import json
+import sys
+import time
+from datetime import datetime
+from hashlib import md5
+
+from sqlalchemy import func, select
+
+from app import db, search, sharding, timeline
+from app.models import User, Post, followers, post_ids
+
+
+def read_records(stream, format):
+    """
+    :param stream: a text file
+    :param format: 'jsonl' for one JSON object per line, or 'csv' with a header line naming the fields
+    :return: an iterator of dicts
+    """
+    if format == 'csv':
+        return csv.DictReader(stream)
+    return (json.loads(line) for line in stream if line.strip())
+
+
+def parse_timestamp(value):
+    """
+    ISO 8601 in UTC, like 2017-03-04T12:30:00 or 2017-03-04 12:30:00.250000Z
+
+    :param value:
+    :return: a datetime, or None when there is no value
+    """
+    if not value:
+        return None
+    value = value.rstrip('Z').replace('T', ' ')
+    if hasattr(datetime, 'fromisoformat'):
+        return datetime.fromisoformat(value)
+    return datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f' if '.' in value else '%Y-%m-%d %H:%M:%S')
+
+
+def chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class Progress(object):
+    """
+    prints how many rows were written and how fast, on one line that is rewritten after every chunk
+    """
+
+    def __init__(self, what, out=sys.stderr):
+        self.what = what
+        self.out = out
+        self.count = 0
+        self.start = time.time()
+
+    @property
+    def elapsed(self):
+        return time.time() - self.start
+
+    def add(self, count):
+        self.count += count
+        if self.out is not None:
+            self.out.write('\r%d %s, %.0f/s ' % (self.count, self.what, self.count / max(self.elapsed, 1e-6)))
+            self.out.flush()
+
+    def done(self):
+        if self.out is not None:
+            self.out.write('\n')
+
+
+def last_ids():
+    """
+    the greatest user and post ids before the import, so finish() knows which rows are new
+
+    :return:
+    """
+    if sharding.count():
+        last_post_id = db.session.query(post_ids.c.last_id).scalar()
+    else:
+        last_post_id = db.session.query(func.max(Post.id)).scalar() or 0
+    return db.session.query(func.max(User.id)).scalar() or 0, last_post_id
+
+
+def import_users(records, chunk_size=10000, progress=None):
+    """
+    :param records: dicts with 'email' and optionally 'nickname' and 'about_me'. Users whose email is taken already
+    are skipped, and nicknames are made unique the way User.make_unique_nickname() does
+    :param chunk_size: rows per INSERT and transaction
+    :param progress: a Progress
+    :return: (users imported, records skipped)
+    """
+    taken = set(nickname for nickname, in db.session.query(User.nickname))
+    emails = set(email for email, in db.session.query(User.email))
+    db.session.commit()
+    imported = skipped = 0
+    for chunk in chunks(records, chunk_size):
+        rows = []
+        for record in chunk:
+            email = record.get('email')
+            if not email or email in emails:
+                skipped += 1
+                continue
+            nickname = unique_nickname(record.get('nickname') or email.split('@')[0], taken)
+            taken.add(nickname)
+            emails.add(email)
+            rows.append({'nickname': nickname, 'email': email, 'email_hash': md5(email.encode('utf-8')).hexdigest(),
+                         'about_me': record.get('about_me') or None, 'version': 0})
+        if rows:
+            with db.engine.begin() as connection:
+                connection.execute(User.__table__.insert(), rows)
+            imported += len(rows)
+            if progress is not None:
+                progress.add(len(rows))
+    return imported, skipped
+
+
+def unique_nickname(nickname, taken):
+    if nickname not in taken:
+        return nickname
+    version = 2
+    while nickname + str(version) in taken:
+        version += 1
+    return nickname + str(version)
+
+
+def import_posts(records, chunk_size=10000, progress=None):
+    """
+    :param records: dicts with 'author' (a nickname), 'body' and optionally 'timestamp' (see parse_timestamp(), the
+    time of the import when missing). Posts by unknown authors are skipped
+    :param chunk_size: rows per INSERT and transaction
+    :param progress: a Progress
+    :return: (posts imported, records skipped)
+    """
+    authors = dict(db.session.query(User.nickname, User.id))
+    db.session.commit()
+    now = datetime.utcnow()
+    imported = skipped = 0
+    for chunk in chunks(records, chunk_size):
+        rows = []
+        for record in chunk:
+            user_id = authors.get(record.get('author'))
+            if user_id is None:
+                skipped += 1
+                continue
+            rows.append({'body': record.get('body'), 'user_id': user_id,
+                         'timestamp': parse_timestamp(record.get('timestamp')) or now})
+        if rows:
+            _insert_posts(rows)
+            imported += len(rows)
+            if progress is not None:
+                progress.add(len(rows))
+    return imported, skipped
+
+
+def _insert_posts(rows):
+    shards = sharding.count()
+    if not shards:
+        with db.engine.begin() as connection:
+            connection.execute(Post.__table__.insert(), rows)
+        return
+    # numbered from the sequence of the main database, then each shard gets its rows
+    first = sharding.next_ids(db.session, len(rows))
+    db.session.commit()
+    for id, row in enumerate(rows, first):
+        row['id'] = id
+    for shard in range(shards):
+        shard_rows = [row for row in rows if sharding.shard_of(row['user_id']) == shard]
+        if shard_rows:
+            with sharding.engine(shard).begin() as connection:
+                connection.execute(Post.__table__.insert(), shard_rows)
+
+
+def finish(last_user_id, last_post_id):
+    """
+    bring everything the ORM would have maintained up to date with the imported rows
+
+    :param last_user_id: from last_ids(), before the import
+    :param last_post_id:
+    :return:
+    """
+    user = User.__table__
+    # new users follow themselves, like after_login() makes them do
+    db.session.execute(followers.insert().from_select(
+        ['follower_id', 'followed_id'], select([user.c.id.label('follower_id'), user.c.id.label('followed_id')]).where(
+            user.c.id > last_user_id)))
+    db.session.commit()
+    search.reindex(after_id=last_post_id)
+    User.recount()
+    if timeline.enabled():
+        timeline.rebuild()
@@ -0,0 +1,68 @@
+"""
+A small thread-safe LRU cache shared by the in-process caches of the app (avatar URLs, ...).
+
+Entries can optionally expire 'ttl' seconds after they were stored. hits and misses are counted so the caches can be
+monitored.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+_missing = object()
+
+
+class LRUCache(object):
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (value, stored at), least recently used first
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, _missing)
+            if entry is not _missing and self.ttl is not None and time.time() - entry[1] > self.ttl:
+                entry = _missing
+            if entry is _missing:
+                self.misses += 1
+                return default
+            self._entries[key] = entry  # back at the most recently used end
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.time())
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, _missing)
+            return default if entry is _missing else entry[0]
+
+    def evict_where(self, predicate):
+        """
+        drop every entry whose key matches 'predicate'
+
+        :param predicate: called with each key
+        :return: the number of entries dropped
+        """
+        with self._lock:
+            keys = [key for key in self._entries if predicate(key)]
+            for key in keys:
+                del self._entries[key]
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries), 'maxsize': self.maxsize}
@@ -0,0 +1,74 @@
+"""
+Conditional GET for the timeline and profile pages.
+
+Rendering a page of posts is most of the cost of /index and /user/<nickname>, and people reload them far more often
+than anything changes. The views work out an ETag from everything the page shows (the ids of the posts and the
+versions of their authors, the viewer, the cursors...) with the cheap page query they run anyway, and respond() only
+renders the template when the browser's copy, named by If-None-Match, is out of date. Otherwise it is told to reuse
+it with an empty 304.
+
+The pages are personal, so they are marked private and the browser has to revalidate them on every load. They also
+send a Last-Modified, the time of the newest post, but it does not cover profile edits so If-Modified-Since alone is
+not trusted to answer a 304.
+"""
+import time
+from hashlib import sha1
+
+from flask import current_app, make_response, request, session
+
+
+def page_etag(*parts):
+    """
+    the ETag of a page made of 'parts', which have to be values with a stable repr()
+
+    the session's CSRF token is part of it, and so is the time, rounded to half of WTF_CSRF_TIME_LIMIT, so a page
+    that is reused has a form token that is still good for a while
+
+    :param parts:
+    :return:
+    """
+    limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    window = int(time.time() // (limit / 2)) if limit else None
+    return sha1(repr(parts + (session.get('csrf_token'), window)).encode('utf-8')).hexdigest()
+
+
+def posts_page(posts):
+    """
+    what a KeysetPagination of posts contributes to the page: the posts, the versions of their authors (nickname and
+    avatar, see app/fragments.py) and the links to the next and previous pages
+
+    :param posts:
+    :return: the parts for page_etag() and the time of the newest post
+    """
+    parts = (tuple((post.id, post.user_id, post.author.version or 0) for post in posts.items),
+             posts.next_num, posts.prev_num)
+    newest = max([post.timestamp for post in posts.items if post.timestamp is not None] or [None])
+    return parts, newest
+
+
+def cacheable():
+    """
+    flashed messages are shown once and then gone, so a page carrying them can't be reused
+    """
+    return request.method == 'GET' and '_flashes' not in session
+
+
+def respond(etag, last_modified, render):
+    """
+    :param etag: from page_etag()
+    :param last_modified: a datetime, or None
+    :param render: renders the page, only called when the browser's copy is out of date
+    :return: the response
+    """
+    if not cacheable():
+        return render()
+    if etag in request.if_none_match:
+        response = current_app.response_class(status=304)
+    else:
+        response = make_response(render())
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
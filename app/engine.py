@@ -0,0 +1,123 @@
+"""
+Engine configuration for the app database.
+
+flask_sqlalchemy creates the engine from the SQLALCHEMY_* config values, but it leaves SQLite files on a NullPool
+(a new connection for every checkout) and will not accept SQLALCHEMY_POOL_SIZE for them. This subclass, used for
+'db' in app/__init__.py, gives SQLite files a real QueuePool sized from the config and lets the pooled connections
+move between the threads of a worker.
+
+It also tunes every SQLite connection as it is opened with the PRAGMAs of the SQLITE_PROFILE named in the config
+(see SQLITE_PROFILES below), plus any SQLITE_PRAGMAS overrides. With the default rollback journal every commit
+blocks all readers of the file; the 'wal' profile lets readers carry on from the last committed state while a
+writer works. Connections wait SQLITE_BUSY_TIMEOUT seconds for the write lock held by another connection instead
+of failing straight away with 'database is locked'.
+
+Its sessions are RoutingSessions: while session.info['replica'] holds the engine of a read replica, the SELECTs of
+the session go there and everything else to the primary. Once the session has written, the rest of its transaction
+reads from the primary too. app/replicas.py decides which requests get a replica. app/sharding.py hooks the flush
+of the sessions to write each post to its shard.
+"""
+from collections import OrderedDict
+
+import flask_sqlalchemy
+from sqlalchemy import event, orm
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.elements import TextClause
+from sqlalchemy.sql.selectable import SelectBase
+
+SQLITE_PROFILES = {
+    # SQLite's own defaults: rollback journal, a commit locks out the readers
+    'default': OrderedDict(),
+    # write-ahead log: readers don't wait for writers, and commits only fsync at checkpoints. 8MB of page cache per
+    # connection and 64MB of memory mapped reads
+    'wal': OrderedDict([('journal_mode', 'WAL'), ('synchronous', 'NORMAL'), ('cache_size', -8000),
+                        ('mmap_size', 67108864)]),
+    # wal plus a 64MB page cache per connection, 256MB of memory mapped reads and temporary tables in memory
+    'throughput': OrderedDict([('journal_mode', 'WAL'), ('synchronous', 'NORMAL'), ('cache_size', -64000),
+                               ('mmap_size', 268435456), ('temp_store', 'MEMORY')]),
+    # wal, but every commit is fsynced before it returns
+    'durable': OrderedDict([('journal_mode', 'WAL'), ('synchronous', 'FULL'), ('cache_size', -8000),
+                            ('mmap_size', 67108864)]),
+}
+
+
+def sqlite_pragmas(config):
+    """
+    the PRAGMAs to run on each new SQLite connection for this config, in order
+
+    :param config:
+    :return:
+    """
+    pragmas = OrderedDict(SQLITE_PROFILES[config['SQLITE_PROFILE']])
+    pragmas['busy_timeout'] = int(config['SQLITE_BUSY_TIMEOUT'] * 1000)
+    pragmas.update(config['SQLITE_PRAGMAS'])
+    return pragmas
+
+
+def install_pragmas(engine, pragmas, attach=None):
+    """
+    run 'pragmas' on every connection 'engine' opens from now on
+
+    :param engine:
+    :param pragmas:
+    :param attach: {schema name: path} of other SQLite files to ATTACH to every connection, their tables can then be
+        used in the queries of 'engine' as long as it has no table of the same name
+    :return:
+    """
+    @event.listens_for(engine, 'connect')
+    def apply_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+        for name, path in sorted((attach or {}).items()):
+            cursor.execute('ATTACH DATABASE ? AS %s' % name, (path,))
+        cursor.close()
+
+    engine.sqlite_pragmas = pragmas
+
+
+def is_read(clause):
+    """
+    :return: whether running 'clause' can't change the database: a select, raw SQL starting with SELECT, or no
+        statement at all (session.connection() to look at the database, like search.available())
+    """
+    if isinstance(clause, TextClause):
+        return clause.text.lstrip().upper().startswith('SELECT')
+    return clause is None or isinstance(clause, SelectBase)
+
+
+class RoutingSession(flask_sqlalchemy.SignallingSession):
+    def __init__(self, db, autocommit=False, autoflush=True, **options):
+        flask_sqlalchemy.SignallingSession.__init__(self, db, autocommit, autoflush, **options)
+        # per instance routing of the flush, set up by app/sharding.py when the posts are sharded
+        flush_connection = self.app.extensions.get('flush_connection')
+        if flush_connection is not None:
+            self.connection_callable = lambda mapper, instance: flush_connection(self, mapper, instance)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or not is_read(clause):
+            self.info['wrote'] = True  # a flush, a Core INSERT/UPDATE/DELETE, raw SQL: reads follow the primary now
+        elif self.info.get('replica') is not None and not self.info.get('wrote'):
+            return self.info['replica']
+        return flask_sqlalchemy.SignallingSession.get_bind(self, mapper, clause)
+
+
+class SQLAlchemy(flask_sqlalchemy.SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, info, options):
+        rv = flask_sqlalchemy.SQLAlchemy.apply_driver_hacks(self, app, info, options)
+        if info.drivername.startswith('sqlite') and info.database not in (None, '', ':memory:'):
+            if options.get('pool_size'):
+                options['poolclass'] = QueuePool
+                options.setdefault('connect_args', {})['check_same_thread'] = False
+        return rv  # None for older flask_sqlalchemy, (url, options) for newer ones
+
+    def get_engine(self, app=None, bind=None):
+        engine = flask_sqlalchemy.SQLAlchemy.get_engine(self, app, bind)
+        # engines are created lazily, and again whenever the database URI changes
+        if engine.dialect.name == 'sqlite' and not hasattr(engine, 'sqlite_pragmas'):
+            app = self.get_app(app)
+            install_pragmas(engine, sqlite_pragmas(app.config), app.extensions.get('sqlite_attach', {}).get(bind))
+        return engine
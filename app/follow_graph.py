@@ -0,0 +1,164 @@
+"""
+In-process cache of the follow graph, so User.is_following() is a set lookup instead of a COUNT query.
+
+For every user that was asked about, the cache holds the set of ids the user follows. A set is loaded from the
+followers table the first time it is needed. User.follow()/unfollow() update it right away, so the rest of the
+transaction sees the change, and every user touched by a transaction is invalidated again once it commits or rolls
+back, after which the database is the truth again.
+
+Every invalidation bumps a version of the user's set. The version is read before the ids are loaded, and a set is
+only stored when its version has not changed since, so a load that read the followers table just before a follow
+committed elsewhere does not put the old set back after the invalidation went by.
+
+Where the sets live is up to the backend: MemoryBackend keeps them in this process, SharedStoreBackend keeps them in
+a shared store (see app/shared_store.py) so several worker processes see each other's changes. Either keeps a set
+FOLLOW_GRAPH_TTL seconds at most, and MemoryBackend the sets of FOLLOW_GRAPH_CACHE_SIZE users.
+"""
+import threading
+
+from app.cache import LRUCache
+
+
+class MemoryBackend(object):
+    def __init__(self, maxsize=10000, ttl=None):
+        # user id -> (the set of ids they follow, None when not loaded, the version of the set)
+        self._sets = LRUCache(maxsize, ttl)
+        self._lock = threading.Lock()
+
+    def contains(self, user_id, followed_id):
+        """
+        :return: True or False, or None when the set of 'user_id' is not loaded
+        """
+        followed, version = self._sets.get(user_id, (None, 0))
+        if followed is None:
+            return None
+        return followed_id in followed
+
+    def version(self, user_id):
+        """
+        :return: the version of the set of 'user_id', to hand to load()
+        """
+        return self._sets.get(user_id, (None, 0))[1]
+
+    def load(self, user_id, followed_ids, version):
+        with self._lock:
+            if self.version(user_id) == version:  # otherwise invalidated since 'followed_ids' were read
+                self._sets.set(user_id, (set(followed_ids), version))
+
+    def add(self, user_id, followed_id):
+        with self._lock:
+            followed, version = self._sets.get(user_id, (None, 0))
+            if followed is not None:
+                followed.add(followed_id)
+
+    def remove(self, user_id, followed_id):
+        with self._lock:
+            followed, version = self._sets.get(user_id, (None, 0))
+            if followed is not None:
+                followed.discard(followed_id)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._sets.set(user_id, (None, self.version(user_id) + 1))
+
+    def clear(self):
+        with self._lock:
+            self._sets.clear()
+
+
+class SharedStoreBackend(object):
+    # ids start at 1, so 0 can mark a loaded set even when the user follows nobody (the store drops empty sets)
+    LOADED = 0
+
+    def __init__(self, store, prefix='follow_graph:', ttl=None):
+        self.store = store
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def _key(self, user_id):
+        return self.prefix + str(user_id)
+
+    def _version_key(self, user_id):
+        return self.prefix + 'version:' + str(user_id)
+
+    def contains(self, user_id, followed_id):
+        key = self._key(user_id)
+        if self.store.sismember(key, followed_id):
+            return True
+        return False if self.store.exists(key) else None
+
+    def version(self, user_id):
+        return self.store.get(self._version_key(user_id))
+
+    def load(self, user_id, followed_ids, version):
+        # an invalidation landing between this check and the write can still be missed, the TTL bounds how long for
+        if self.version(user_id) != version:
+            return
+        key = self._key(user_id)
+        self.store.delete(key)
+        self.store.sadd(key, self.LOADED, *followed_ids)
+        if self.ttl:
+            self.store.expire(key, self.ttl)
+
+    def add(self, user_id, followed_id):
+        key = self._key(user_id)
+        if self.store.exists(key):
+            self.store.sadd(key, followed_id)
+
+    def remove(self, user_id, followed_id):
+        self.store.srem(self._key(user_id), followed_id)
+
+    def invalidate(self, user_id):
+        key = self._version_key(user_id)
+        self.store.incrbyfloat(key, 1)
+        if self.ttl:
+            self.store.expire(key, self.ttl)
+        self.store.delete(self._key(user_id))
+
+    def clear(self):
+        # only the sets, the store can hold other things (see RATE_LIMIT_STORE)
+        keys = list(self.store.scan_iter(match=self.prefix + '*'))
+        if keys:
+            self.store.delete(*keys)
+
+
+class FollowGraph(object):
+    def __init__(self, loader, backend=None):
+        """
+        :param loader: called with a user id, returns the ids that user follows according to the database
+        :param backend: defaults to a MemoryBackend
+        """
+        self.loader = loader
+        self.backend = backend or MemoryBackend()
+
+    def is_following(self, user_id, followed_id):
+        following = self.backend.contains(user_id, followed_id)
+        if following is None:
+            version = self.backend.version(user_id)
+            followed_ids = list(self.loader(user_id))
+            self.backend.load(user_id, followed_ids, version)
+            following = followed_id in followed_ids
+        return following
+
+    def followed(self, session, user_id, followed_id):
+        self.backend.add(user_id, followed_id)
+        self._touched(session, user_id)
+
+    def unfollowed(self, session, user_id, followed_id):
+        self.backend.remove(user_id, followed_id)
+        self._touched(session, user_id)
+
+    def _touched(self, session, user_id):
+        session.info.setdefault('follow_graph_touched', set()).add(user_id)
+
+    def end_of_transaction(self, session):
+        """
+        hooked to after_commit and after_rollback of the session. Whatever the outcome, drop the sets of the users
+        the transaction changed so they are read back from the database, this also covers other processes that
+        reloaded them while the transaction was still open
+        """
+        for user_id in session.info.pop('follow_graph_touched', ()):
+            self.backend.invalidate(user_id)
+
+    def clear(self):
+        self.backend.clear()
@@ -0,0 +1,45 @@
+"""
+Cache of rendered post.html fragments.
+
+A post never changes once written, and what post.html shows of its author is their nickname and the avatar of their
+email. So the rendered HTML of a post is cached under (post id, author id, author version, nickname, email): edit()
+bumps User.version, and a nickname or email changed any other way still makes a new key. The timeline templates call
+render_post(post) instead of including post.html, which only runs Jinja for posts that were not rendered before. edit() also drops the fragments of the
+old version right away so they don't sit in the cache until they are evicted.
+"""
+from flask import render_template
+from markupsafe import Markup
+
+from app.cache import LRUCache
+
+
+class FragmentCache(object):
+    def __init__(self, app=None):
+        self.cache = LRUCache()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.cache.maxsize = app.config['FRAGMENT_CACHE_SIZE']
+        app.jinja_env.globals['render_post'] = self.render_post
+
+    def render_post(self, post):
+        author = post.author
+        key = (post.id, post.user_id, author.version or 0, author.nickname, author.email)
+        html = self.cache.get(key)
+        if html is None:
+            html = Markup(render_template('post.html', post=post))
+            self.cache.set(key, html)
+        return html
+
+    def invalidate_author(self, user_id):
+        return self.cache.evict_where(lambda key: key[1] == user_id)
+
+    def clear(self):
+        self.cache.clear()
+
+    def stats(self):
+        return self.cache.stats()
+
+
+fragments = FragmentCache()
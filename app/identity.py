@@ -0,0 +1,78 @@
+"""
+Cache of the logged in users, for Flask-Login's user_loader.
+
+load_user() used to run User.query.get() at the start of every request just to rebuild current_user. IdentityCache
+keeps a detached snapshot of each user it loaded: the column values, no relationships, no session. A request that
+finds the snapshot gets its own copy put into the session with merge(load=False), which runs no SQL, so
+authenticated pages make no identity query in steady state. The copy is persistent, so relationships still lazy load
+and a view that changes the user writes it back as before.
+
+The snapshot of a user is dropped when a transaction that changed them commits: changed() is called by the User
+events and the counter updates in app/models.py. Other processes only find out when the entry expires after
+IDENTITY_CACHE_TTL seconds, so what a page shows of the logged in user can be that much behind there. Users loaded
+from a read replica are not cached.
+"""
+from sqlalchemy import inspect
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.session import make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
+
+from app.cache import LRUCache
+
+
+class IdentityCache(object):
+    def __init__(self, model, session, maxsize=10000, ttl=60):
+        """
+        :param model: the mapped class of the users
+        :param session: the (scoped) session the users are loaded into
+        """
+        self.model = model
+        self.session = session
+        self.cache = LRUCache(maxsize, ttl)
+
+    def load(self, id):
+        """
+        :return: the instance with primary key 'id' in the session, None when there is none
+        """
+        existing = self.session.identity_map.get(identity_key(self.model, id))
+        if existing is not None:
+            return existing
+        snapshot = self.cache.get(id)
+        if snapshot is not None:
+            return self.session.merge(snapshot, load=False)
+        instance = self.session.query(self.model).get(id)
+        # not when it came from a read replica (see app/replicas.py), which can be behind: the stale snapshot would
+        # outlive the request
+        if instance is not None and self.session().info.get('replica') is None:
+            self.cache.set(id, self.snapshot(instance))
+        return instance
+
+    def snapshot(self, instance):
+        """
+        :return: a detached copy of the column values of 'instance'
+        """
+        mapper = inspect(instance).mapper
+        snapshot = mapper.class_manager.new_instance()  # no __init__, no attribute events
+        for attribute in mapper.column_attrs:
+            set_committed_value(snapshot, attribute.key, getattr(instance, attribute.key))
+        make_transient_to_detached(snapshot)
+        return snapshot
+
+    def changed(self, session, id):
+        """
+        drop the snapshot of 'id' once the transaction of 'session' is over
+        """
+        session.info.setdefault('identities_changed', set()).add(id)
+
+    def end_of_transaction(self, session):
+        """
+        hooked to after_commit and after_rollback of the session
+        """
+        for id in session.info.pop('identities_changed', ()):
+            self.cache.pop(id)
+
+    def clear(self):
+        self.cache.clear()
+
+    def stats(self):
+        return self.cache.stats()
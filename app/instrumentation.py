@@ -0,0 +1,61 @@
+"""
+Counting the SQL statements an operation runs, so tests can assert that rendering a page costs a constant number of
+queries whatever the page size.
+
+    with QueryCounter() as queries:
+        client.get('/index')
+    queries.count, queries.statements
+
+Only statements run by the thread that opened the counter are recorded.
+
+query_plan() asks SQLite how it would run a recorded statement, to check that it is answered from an index.
+"""
+import threading
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_active = threading.local()
+
+
+class QueryCounter(object):
+    def __init__(self):
+        self.statements = []
+        self.parameters = []  # the parameters each of the statements ran with
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def __enter__(self):
+        if not hasattr(_active, 'counters'):
+            _active.counters = []
+        _active.counters.append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _active.counters.remove(self)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _record(conn, cursor, statement, parameters, context, executemany):
+    for counter in getattr(_active, 'counters', ()):
+        counter.statements.append(statement)
+        counter.parameters.append(parameters)
+
+
+def query_plan(connection, statement, parameters=()):
+    """
+    the steps of SQLite's plan for 'statement', like 'SEARCH post USING INDEX ix_post_user_id_timestamp (user_id=?)'
+    or 'SCAN user' for a full table scan
+
+    :param connection: a SQLAlchemy connection to an SQLite database
+    :param statement: SQL as it went to the database, with ? placeholders
+    :param parameters:
+    :return:
+    """
+    cursor = connection.connection.cursor()
+    try:
+        return [row[-1] for row in cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)]
+    finally:
+        cursor.close()
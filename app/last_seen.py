@@ -0,0 +1,87 @@
+"""
+Batched last_seen tracking.
+
+before_request() used to bump g.user.last_seen and commit on every authenticated request, which on SQLite means
+every page view takes the database write lock. The tracker below only records the time in memory, keeping the latest
+value per user, and writes all of them in one bulk UPDATE once LAST_SEEN_FLUSH_THRESHOLD users are waiting or
+LAST_SEEN_FLUSH_INTERVAL seconds have passed. A timer makes sure an idle process still flushes within the interval
+and whatever is left is flushed when the process exits, so last_seen is never more than the interval behind.
+"""
+import atexit
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import bindparam
+
+from app import db
+from app.models import User
+
+
+class LastSeenTracker(object):
+    def __init__(self, app=None):
+        self.app = None
+        self.pending = {}  # user id -> last time seen, not written yet
+        self.lock = threading.Lock()
+        self.last_flush = time.time()
+        self.timer = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if self.app is None:
+            atexit.register(self.flush)
+        self.app = app
+
+    def touch(self, user_id, when=None):
+        """
+        record that 'user_id' was just seen, flushing if enough users or time have piled up
+
+        :param user_id:
+        :param when: defaults to now
+        :return:
+        """
+        with self.lock:
+            self.pending[user_id] = when or datetime.utcnow()
+            interval = self.app.config['LAST_SEEN_FLUSH_INTERVAL']
+            due = (len(self.pending) >= self.app.config['LAST_SEEN_FLUSH_THRESHOLD'] or
+                   time.time() - self.last_flush >= interval)
+            if not due and self.timer is None:
+                self.timer = threading.Timer(interval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+        if due:
+            self.flush()
+
+    def flush(self):
+        """
+        write everything pending in a single executemany UPDATE, on its own connection so it never gets mixed up
+        with the transaction of the request that triggered it
+
+        :return: the number of users written
+        """
+        with self.lock:
+            batch, self.pending = self.pending, {}
+            self.last_flush = time.time()
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        if not batch or self.app is None:
+            return 0
+        users = User.__table__
+        statement = users.update().where(users.c.id == bindparam('user_id')).values(last_seen=bindparam('seen'))
+        try:
+            # no app context here, tearing one down would remove the session of the request we may be in
+            with db.get_engine(self.app).begin() as connection:
+                connection.execute(statement, [{'user_id': user_id, 'seen': seen} for user_id, seen in batch.items()])
+        except Exception:
+            # put the batch back so it goes out with the next flush, unless the user was seen again since
+            with self.lock:
+                for user_id, seen in batch.items():
+                    self.pending.setdefault(user_id, seen)
+            self.app.logger.exception('could not flush last_seen for %d users' % len(batch))
+            return 0
+        return len(batch)
+
+
+tracker = LastSeenTracker()
@@ -0,0 +1,162 @@
+"""
+Error emails sent from a background thread, in digests.
+
+logging's SMTPHandler talks to the mail server inside the request that logged the error, so a slow or unreachable
+MAIL_SERVER holds up every request that fails, and a burst of errors ties up all the workers. DigestMailHandler only
+puts the record on a bounded queue; when the queue is full the record is dropped and counted rather than waited for.
+A worker thread takes the records off the queue, waits MAIL_DIGEST_DELAY seconds for more to arrive, and sends them
+all in one email, never more often than once every MAIL_MIN_INTERVAL seconds. A digest lists at most
+MAIL_DIGEST_MAX records and says how many more there were, and how many were dropped.
+
+smtp_sink.py is a local SMTP server to point MAIL_SERVER/MAIL_PORT at in tests and development.
+"""
+import copy
+import logging
+import os
+import smtplib
+import sys
+import threading
+import time
+import traceback
+from email.mime.text import MIMEText
+from email.utils import formatdate
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+_STOP = object()
+
+
+class DigestMailHandler(logging.Handler):
+    def __init__(self, mailhost, fromaddr, toaddrs, subject, credentials=None, queue_size=1000, delay=10,
+                 interval=60, max_records=50, timeout=10):
+        """
+        the first five are the arguments of logging.handlers.SMTPHandler
+
+        :param queue_size: records waiting to be sent, more are dropped
+        :param delay: seconds to wait for more records before sending a digest
+        :param interval: least number of seconds between two digests
+        :param max_records: records listed in full in a digest
+        :param timeout: of the SMTP connection
+        """
+        logging.Handler.__init__(self)
+        self.mailhost, self.mailport = mailhost
+        self.fromaddr = fromaddr
+        self.toaddrs = toaddrs
+        self.subject = subject
+        self.credentials = credentials
+        self.queue = queue.Queue(queue_size)
+        self.delay = delay
+        self.interval = interval
+        self.max_records = max_records
+        self.timeout = timeout
+        self.dropped = 0  # since the last digest
+        self.sent = 0
+        self.failed = 0
+        self.last_sent = 0
+        self._worker = None
+        self._worker_pid = None
+        self._worker_lock = threading.Lock()
+
+    def emit(self, record):
+        try:
+            # format now, while the traceback is there, so the worker only has text to deal with. The record is
+            # shared with the other handlers, so it is a copy that gets changed
+            message = self.format(record)
+            record = copy.copy(record)
+            record.msg = message
+            record.args = None
+            record.exc_info = record.exc_text = None
+            self._ensure_worker()
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def _ensure_worker(self):
+        # a worker started before gunicorn forked does not exist in the workers, each process needs its own
+        if self._worker is not None and self._worker_pid == os.getpid():
+            return
+        with self._worker_lock:
+            if self._worker is None or self._worker_pid != os.getpid():
+                self._worker = threading.Thread(target=self._run, name='error-mail')
+                self._worker.daemon = True
+                self._worker_pid = os.getpid()
+                self._worker.start()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            record = self.queue.get()
+            if record is _STOP:
+                return
+            records, extra = [record], 0
+            deadline = max(time.time() + self.delay, self.last_sent + self.interval)
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    record = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if record is _STOP:
+                    stopping = True
+                    break
+                if len(records) < self.max_records:
+                    records.append(record)
+                else:
+                    extra += 1
+            self._send(records, extra)
+
+    def digest(self, records, extra, dropped):
+        """
+        :return: the subject and body of the email for 'records'
+        """
+        count = len(records) + extra + dropped
+        subject = self.subject if count == 1 else '%s (%d errors)' % (self.subject, count)
+        parts = [record.getMessage() for record in records]
+        if extra:
+            parts.append('... and %d more' % extra)
+        if dropped:
+            parts.append('%d more were dropped, the mail queue was full' % dropped)
+        return subject, ('\n\n' + '-' * 78 + '\n\n').join(parts)
+
+    def _send(self, records, extra):
+        dropped, self.dropped = self.dropped, 0
+        subject, body = self.digest(records, extra, dropped)
+        message = MIMEText(body)
+        message['From'] = self.fromaddr
+        message['To'] = ', '.join(self.toaddrs)
+        message['Subject'] = subject
+        message['Date'] = formatdate()
+        try:
+            smtp = smtplib.SMTP(self.mailhost, self.mailport, timeout=self.timeout)
+            try:
+                if self.credentials:
+                    smtp.login(*self.credentials)
+                smtp.sendmail(self.fromaddr, self.toaddrs, message.as_string())
+            finally:
+                smtp.quit()
+            self.sent += 1
+        except Exception:
+            self.failed += 1
+            sys.stderr.write('Could not send the error digest:\n' + traceback.format_exc())
+        self.last_sent = time.time()
+
+    def close(self):
+        """
+        send what is still queued, called by logging at exit. Waits up to 'timeout' seconds for the mail server
+        """
+        worker = self._worker
+        if worker is not None and worker.is_alive() and self._worker_pid == os.getpid():
+            self.delay = self.interval = 0
+            try:
+                self.queue.put(_STOP, timeout=self.timeout)
+            except queue.Full:
+                pass
+            worker.join(self.timeout)
+        logging.Handler.close(self)
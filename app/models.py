@@ -4,8 +4,15 @@ in the DB.
 
 """
 
-from app import db, app
+from app import db
+from app import sharding, shared_store
+from app.cache import LRUCache
+from app.follow_graph import FollowGraph, MemoryBackend, SharedStoreBackend
+from app.identity import IdentityCache
+from collections import Counter
 from hashlib import md5
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.attributes import set_committed_value
 
 # getting full text search working
 import sys
@@ -16,10 +23,43 @@ else:
     enable_search = True
     import flask_whooshalchemy as whooshalchemy
 
-# this is a auxiliary table that has no data other than foreign keys
+# avatar URLs keyed on (user id, email, size), so pages full of posts by the same few authors don't hash their email
+# again for every post
+avatar_urls = LRUCache()  # sized by init_app()
+
+# this is a auxiliary table that has no data other than foreign keys. A pair can only be in it once, and the unique
+# index answers 'who does X follow' and is_following(); the one on followed_id answers 'who follows X'
 followers = db.Table('followers',
                      db.Column('follower_id', db.Integer, db.ForeignKey('user.id')),
-                     db.Column('followed_id', db.Integer, db.ForeignKey('user.id')))
+                     db.Column('followed_id', db.Integer, db.ForeignKey('user.id')),
+                     db.Index('ix_followers_follower_id_followed_id', 'follower_id', 'followed_id', unique=True),
+                     db.Index('ix_followers_followed_id', 'followed_id'))
+
+# materialized home timelines, one row per (follower, post). Only maintained when TIMELINE_ENABLED is set, see
+# app/timeline.py
+timeline = db.Table('timeline',
+                    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+                    db.Column('post_id', db.Integer, db.ForeignKey('post.id'), primary_key=True),
+                    db.Column('timestamp', db.DateTime),
+                    db.Index('ix_timeline_user_id_timestamp', 'user_id', 'timestamp', 'post_id'))
+
+# the last post id given out, a single row. Only used when the posts are sharded, the shards can't each number their
+# posts, see app/sharding.py
+post_ids = db.Table('post_ids',
+                    db.Column('id', db.Integer, primary_key=True),
+                    db.Column('last_id', db.Integer, nullable=False))
+db.event.listen(post_ids, 'after_create', db.DDL('INSERT INTO post_ids (id, last_id) VALUES (1, 0)'))
+
+
+def _load_followed_ids(user_id):
+    return [followed_id for followed_id, in db.session.query(followers.c.followed_id).filter(
+        followers.c.follower_id == user_id)]
+
+
+# the sets of ids each user follows, either in this process or in the store shared by all workers (see init_app())
+follow_graph = FollowGraph(_load_followed_ids)
+db.event.listen(db.session, 'after_commit', follow_graph.end_of_transaction)
+db.event.listen(db.session, 'after_rollback', follow_graph.end_of_transaction)
 
 
 class User(db.Model):
@@ -30,9 +70,16 @@ class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     nickname = db.Column(db.String(64), index=True, unique=True)
     email = db.Column(db.String(120), index=True, unique=True)
+    email_hash = db.Column(db.String(32))  # md5 of the email for gravatar, kept up to date by _email_changed()
     posts = db.relationship('Post', backref='author', lazy='dynamic')
     about_me = db.Column(db.String(140))
     last_seen = db.Column(db.DateTime)
+    version = db.Column(db.Integer, default=0)  # bumped on every profile edit, cached renderings key on it
+    # copies of followers.count(), followed.count() and posts.count(), so profiles don't have to COUNT(*). Kept up to
+    # date by follow(), unfollow() and the post events below, recount() repairs them
+    followers_count = db.Column(db.Integer, default=0)
+    followed_count = db.Column(db.Integer, default=0)
+    posts_count = db.Column(db.Integer, default=0)
     # this new relationship is called followed
     followed = db.relationship('User',  # initiate a relationship and linking to self (User) to 'User' instances
                                secondary=followers,
@@ -46,27 +93,48 @@ class User(db.Model):
 
     def follow(self, user):
         """
-        returns None when fail
+        returns None when fail. Asks the database rather than the follow graph cache, which can be behind what
+        another worker did, and a pair added twice would break the unique index
 
         :param user:
         :return:
         """
-        if not self.is_following(user):
+        if not self._follows_in_database(user):
             self.followed.append(user)
+            if self.id is not None and user.id is not None:
+                follow_graph.followed(db.session, self.id, user.id)
+            _add_to_counter(self, 'followed_count', 1)
+            _add_to_counter(user, 'followers_count', 1)
             return self
 
     def unfollow(self, user):
-        if self.is_following(user):
+        if self._follows_in_database(user):
             self.followed.remove(user)
+            if self.id is not None and user.id is not None:
+                follow_graph.unfollowed(db.session, self.id, user.id)
+            _add_to_counter(self, 'followed_count', -1)
+            _add_to_counter(user, 'followers_count', -1)
             return self
 
-    def sorted_posts(self):
+    def sorted_posts(self, load_authors=True, archived=False):
         """
         getting the user posts that in order.. this case would use 'self', when trying to get ALL the posts,
         use 'Post' instead
+        :param load_authors: load post.author in the same query, see Post.with_authors()
+        :param archived: the posts moved to the archive instead, as ArchivedPost (see app/archive.py)
         :return:
         """
-        return self.posts.order_by(Post.timestamp.desc())
+        model = ArchivedPost if archived else Post
+        shard = sharding.shard_of(self.id)
+        if shard is None and not archived:
+            query = self.posts
+        else:
+            query = model.query.filter(model.user_id == self.id).on_shard(shard)
+        query = query.order_by(model.timestamp.desc(), model.id.desc())
+        return model.with_authors(query) if load_authors else query
+
+    def _follows_in_database(self, user):
+        return self.followed.filter(followers.c.followed_id == user.id).count() > 0
 
     def is_following(self, user):
         """
@@ -79,18 +147,27 @@ class User(db.Model):
         """
         #  because self.followed has a lazy='dynamic' setting, the query object is returned and NOT the results of the
         #  query itself
-        return self.followed.filter(followers.c.followed_id == user.id).count() > 0
+        if self.id is None or user.id is None:
+            return self._follows_in_database(user)
+        #  otherwise answer from the cached set of ids self follows, see app/follow_graph.py
+        return follow_graph.is_following(self.id, user.id)
 
-    def followed_posts(self):
+    def followed_posts(self, load_authors=True, archived=False):
         """
         This query has three parts, join, filter and order_by
+        :param load_authors: load post.author in the same query, see Post.with_authors()
+        :param archived: the posts moved to the archive instead, as ArchivedPost (see app/archive.py)
         :return:
         """
         #  this method returns a query object and NOT the result, similar to 'lazy' = 'dynamic' in relationship
-        #  this is good practice since the caller can tach on additional queries
-        return Post.query.join(followers,
-                               (followers.c.followed_id == Post.user_id)).filter(
-            followers.c.follower_id == self.id).order_by(Post.timestamp.desc())
+        #  this is good practice since the caller can tach on additional queries. With sharded posts it runs on every
+        #  shard and the rows are merged, see app/sharding.py
+        model = ArchivedPost if archived else Post
+        query = model.query.join(followers,
+                                 (followers.c.followed_id == model.user_id)).filter(
+            followers.c.follower_id == self.id)
+        query = model.with_authors(query) if load_authors else query
+        return sharding.scatter(query).order_by(model.timestamp.desc(), model.id.desc())
 
     @property
     def is_authenticated(self):
@@ -128,39 +205,251 @@ class User(db.Model):
         :param size:
         :return:
         """
-        return 'http://www.gravatar.com/avatar/%s?d=mm&s=%d' % (md5(self.email.encode('utf-8')).hexdigest(), size)
+        key = (self.id, self.email, size)
+        url = avatar_urls.get(key)
+        if url is None:
+            email_hash = self.email_hash or md5(self.email.encode('utf-8')).hexdigest()
+            url = 'http://www.gravatar.com/avatar/%s?d=mm&s=%d' % (email_hash, size)
+            avatar_urls.set(key, url)
+        return url
 
     @staticmethod
     def make_unique_nickname(nickname):
-        if User.query.filter_by(nickname=nickname).first() is None:
-            return None
+        """
+        returns 'nickname' when it is free, otherwise the first free one of nickname2, nickname3, ...
+
+        rather than trying the candidates one query at a time, every nickname starting with 'nickname' is read in a
+        single range scan on the nickname index (a LIKE 'nickname%' would not use the index on SQLite)
+        :param nickname:
+        :return:
+        """
+        query = db.session.query(User.nickname).filter(User.nickname >= nickname)
+        if nickname:
+            query = query.filter(User.nickname < nickname[:-1] + chr(ord(nickname[-1]) + 1))
+        taken = set(name for name, in query)
+        if nickname not in taken:
+            return nickname
+        versions = set()
+        for name in taken:
+            suffix = name[len(nickname):]
+            if suffix.isdigit() and not suffix.startswith('0'):
+                versions.add(int(suffix))
         version = 2
-        while True:
-            new_nickname = nickname + str(version)
-            if User.query.filter_by(nickname=new_nickname).first() is None:
-                break
+        while version in versions:
             version += 1
-        return new_nickname
+        return nickname + str(version)
+
+    @staticmethod
+    def create(nickname, email, attempts=5):
+        """
+        adds and commits a new user, with 'nickname' made unique. Two signups can pick the same free nickname at the
+        same time and only one of them gets past the unique index, so the other works its nickname out again and
+        retries instead of failing
+
+        :param nickname:
+        :param email:
+        :param attempts:
+        :return: the new user, or the existing one when the race was lost to a signup with the same email
+        """
+        for attempt in range(attempts):
+            user = User(nickname=User.make_unique_nickname(nickname), email=email)
+            db.session.add(user)
+            try:
+                db.session.commit()
+                return user
+            except IntegrityError:
+                db.session.rollback()
+                existing = User.query.filter_by(email=email).first()
+                if existing is not None:
+                    return existing
+                if attempt == attempts - 1:
+                    raise
+
+    @staticmethod
+    def recount():
+        """
+        recompute the counters of every user from the followers and post tables, in one UPDATE. posts_count includes
+        the archived posts. With sharded posts the posts are counted on each shard and the posts_count that are off
+        are updated after
+
+        :return: the number of users whose counters were wrong
+        """
+        user = User.__table__
+        counts = {
+            'followers_count': db.select([db.func.count()]).where(followers.c.followed_id == user.c.id).as_scalar(),
+            'followed_count': db.select([db.func.count()]).where(followers.c.follower_id == user.c.id).as_scalar(),
+        }
+        shards = sharding.engines()
+        if not shards:
+            counts['posts_count'] = sum(db.select([db.func.count()]).where(table.c.user_id == user.c.id).as_scalar()
+                                        for table in (Post.__table__, ArchivedPost.__table__))
+        wrong = db.or_(*[db.func.coalesce(user.c[name], -1) != count for name, count in counts.items()])
+        if not shards:
+            result = db.session.execute(user.update().where(wrong).values(counts))
+            db.session.commit()
+            return result.rowcount
+        repaired = set(id for id, in db.session.execute(db.select([user.c.id]).where(wrong)))
+        db.session.execute(user.update().where(wrong).values(counts))
+        posts = Counter()
+        for engine in shards:
+            with engine.connect() as connection:
+                for table in (Post.__table__, ArchivedPost.__table__):
+                    posts.update(dict(connection.execute(db.select([table.c.user_id, db.func.count()]).group_by(
+                        table.c.user_id)).fetchall()))
+        changes = [{'user_id': id, 'count': posts[id]}
+                   for id, posts_count in db.session.execute(db.select([user.c.id, user.c.posts_count]))
+                   if posts_count != posts[id]]
+        if changes:
+            db.session.execute(user.update().where(user.c.id == db.bindparam('user_id')).values(
+                posts_count=db.bindparam('count')), changes)
+        db.session.commit()
+        return len(repaired.union(change['user_id'] for change in changes))
 
     def __repr__(self):
         return '<User %r>' % (self.nickname)
 
 
+def _add_to_counter(user, name, delta):
+    """
+    add 'delta' to one of the counters of 'user'. Rows that exist already are updated in the database with
+    'counter = counter + delta', so concurrent requests can't lose each other's changes
+    """
+    value = (getattr(user, name) or 0) + delta
+    if user.id is None:
+        setattr(user, name, value)  # not inserted yet, it goes in with the row
+        return
+    column = User.__table__.c[name]
+    db.session.execute(User.__table__.update().where(User.__table__.c.id == user.id).values(
+        {column: db.func.coalesce(column, 0) + delta}))
+    set_committed_value(user, name, value)
+    identities.changed(db.session, user.id)
+
+
 class Post(db.Model):
     """
     NOTE the db.ForeignKey, this looks at the user table for its ID
 
     """
     __searchable__ = ['body']  # array of datafield that can be search in the posts
+    query_class = sharding.PostQuery
 
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.String(140))
     timestamp = db.Column(db.DateTime)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
 
+    @staticmethod
+    def with_authors(query):
+        """
+        post.html shows the nickname and avatar of the author of every post, and 'author' is a lazy backref, so
+        rendering a page of posts would fire one SELECT on user per post. This joins the authors into the query that
+        loads the posts instead.
+
+        Leave it off when the query is narrowed down to columns with with_entities(), there is no post to load the
+        author of then.
+        :param query:
+        :return:
+        """
+        return query.options(db.joinedload(Post.author))
+
     def __repr__(self):
         return '<Post %r>' % (self.body)
 
 
-if enable_search:
-    whooshalchemy.whoosh_index(app, Post)
+# the posts of a user newest first, as sorted_posts() and followed_posts() read them, straight off the index
+db.Index('ix_post_user_id_timestamp', Post.user_id, Post.timestamp.desc(), Post.id.desc())
+
+
+class ArchivedPost(db.Model):
+    """
+    a post older than ARCHIVE_AFTER_DAYS, moved out of the post table by app/archive.py. Same columns and same id as
+    the post it was, and shown like one. Lives next to the post table, on the same shard with sharded posts
+
+    """
+    __tablename__ = 'post_archive'
+    query_class = sharding.PostQuery
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    body = db.Column(db.String(140))
+    timestamp = db.Column(db.DateTime)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    author = db.relationship('User')
+
+    @staticmethod
+    def with_authors(query):
+        """
+        see Post.with_authors()
+        """
+        return query.options(db.joinedload(ArchivedPost.author))
+
+    def __repr__(self):
+        return '<ArchivedPost %r>' % (self.body)
+
+
+db.Index('ix_post_archive_user_id_timestamp', ArchivedPost.user_id, ArchivedPost.timestamp.desc(),
+         ArchivedPost.id.desc())
+
+
+@db.event.listens_for(Post, 'before_insert')
+def _number_post(mapper, connection, post):
+    if post.id is None and sharding.count(db.object_session(post).app):
+        post.id = sharding.next_ids(db.object_session(post))
+
+
+@db.event.listens_for(Post, 'after_insert')
+def _post_added(mapper, connection, post):
+    # through the session, 'connection' is the one of the shard when the posts are sharded
+    posts_count = User.__table__.c.posts_count
+    db.object_session(post).execute(User.__table__.update().where(User.__table__.c.id == post.user_id).values(
+        posts_count=db.func.coalesce(posts_count, 0) + 1))
+    identities.changed(db.object_session(post), post.user_id)
+
+
+@db.event.listens_for(Post, 'after_delete')
+def _post_removed(mapper, connection, post):
+    posts_count = User.__table__.c.posts_count
+    db.object_session(post).execute(User.__table__.update().where(User.__table__.c.id == post.user_id).values(
+        posts_count=posts_count - 1))
+    identities.changed(db.object_session(post), post.user_id)
+
+
+# the logged in users, loaded for Flask-Login without a query when they are cached (see app/identity.py). A user
+# written by edit(), after_login() or anything else is dropped from it when the transaction commits
+identities = IdentityCache(User, db.session)
+db.event.listen(db.session, 'after_commit', identities.end_of_transaction)
+db.event.listen(db.session, 'after_rollback', identities.end_of_transaction)
+
+
+@db.event.listens_for(User, 'after_update')
+def _user_updated(mapper, connection, user):
+    identities.changed(db.object_session(user), user.id)
+
+
+@db.event.listens_for(User.email, 'set')
+def _email_changed(user, email, old_email, initiator):
+    """
+    keeps email_hash in step with the email, which also fills it in for new users, and drops the cached avatar URLs
+    of the old email
+    """
+    user.email_hash = md5(email.encode('utf-8')).hexdigest() if email else None
+    if user.id is not None:
+        avatar_urls.evict_where(lambda key: key[0] == user.id)
+
+
+def init_app(app):
+    """
+    sizes the caches and picks the follow graph store from the config of 'app', and starts the search index
+
+    :param app:
+    :return:
+    """
+    avatar_urls.maxsize = app.config['AVATAR_CACHE_SIZE']
+    identities.cache.maxsize = app.config['IDENTITY_CACHE_SIZE']
+    identities.cache.ttl = app.config['IDENTITY_CACHE_TTL']
+    if app.config['FOLLOW_GRAPH_STORE']:
+        follow_graph.backend = SharedStoreBackend(shared_store.connect(app.config['FOLLOW_GRAPH_STORE']),
+                                                  ttl=app.config['FOLLOW_GRAPH_TTL'])
+    else:
+        follow_graph.backend = MemoryBackend(app.config['FOLLOW_GRAPH_CACHE_SIZE'], app.config['FOLLOW_GRAPH_TTL'])
+    if enable_search:
+        whooshalchemy.whoosh_index(app, Post)
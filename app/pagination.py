@@ -0,0 +1,147 @@
+"""
+Keyset (seek) pagination for the post timelines.
+
+Query.paginate() skips 'page * per_page' rows with OFFSET and runs a COUNT(*) over the whole query to know how many
+pages there are, so deep pages and prolific authors get linearly slower. Here the position in a timeline is carried
+in an opaque cursor holding the (timestamp, id) of the post at the edge of the current page. The next page is read
+with a "WHERE (timestamp, id) < cursor ORDER BY timestamp DESC, id DESC LIMIT n" that the index can seek to directly,
+and no total is ever counted, so page N costs the same as page 1.
+
+With archival on (see app/archive.py) the pages that reach back past the archival cutoff merge in the archived posts.
+"""
+import base64
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, or_
+
+from app.archive import cutoff
+from app.models import ArchivedPost, Post
+
+OLDER = 'o'  # the cursor points at the last post of a page, read the posts that come after it
+NEWER = 'n'  # the cursor points at the first post of a page, read the posts that come before it
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def encode_cursor(direction, timestamp, id):
+    delta = timestamp - EPOCH
+    micros = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+    raw = '%s:%d:%d' % (direction, micros, id)
+    return base64.urlsafe_b64encode(raw.encode('ascii')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    :param cursor:
+    :return: (direction, timestamp, id), or None when there is no cursor or it cannot be decoded
+    """
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(str(cursor) + '=' * (-len(cursor) % 4)).decode('ascii')
+        direction, micros, id = raw.split(':')
+        if direction not in (OLDER, NEWER):
+            return None
+        return direction, EPOCH + timedelta(microseconds=int(micros)), int(id)
+    except (TypeError, ValueError, UnicodeDecodeError, OverflowError):
+        return None
+
+
+class KeysetPagination(object):
+    """
+    has the same surface the templates use on flask_sqlalchemy's Pagination (items, has_next, has_prev, next_num,
+    prev_num), except that next_num and prev_num are cursors instead of page numbers and that there is no total
+    """
+
+    def __init__(self, items, next_cursor, prev_cursor):
+        self.items = items
+        self.next_num = next_cursor
+        self.prev_num = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_num is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_num is not None
+
+
+def older_than(query, timestamp, id, timestamp_column=Post.timestamp, id_column=Post.id):
+    """
+    narrow a timeline query down to what comes after the post ('timestamp', 'id') when reading newest first
+
+    :return:
+    """
+    return query.filter(and_(timestamp_column <= timestamp, or_(timestamp_column < timestamp, id_column < id)))
+
+
+def newer_than(query, timestamp, id, timestamp_column=Post.timestamp, id_column=Post.id):
+    """
+    the opposite of older_than()
+
+    :return:
+    """
+    return query.filter(and_(timestamp_column >= timestamp, or_(timestamp_column > timestamp, id_column > id)))
+
+
+def merge(rows, more_rows, limit, newest_first=False):
+    """
+    :return: the first 'limit' posts of two lists sorted by (timestamp, id)
+    """
+    return sorted(rows + more_rows, key=lambda post: (post.timestamp, post.id), reverse=newest_first)[:limit]
+
+
+def paginate(query, cursor, per_page, timestamp_column=Post.timestamp, id_column=Post.id, archive=None):
+    """
+    read one page of a timeline query
+
+    :param query: the timeline query, any ordering it has is replaced by (timestamp, id) descending
+    :param cursor: the cursor from the URL, None (or an invalid one) gives the first page
+    :param per_page:
+    :param timestamp_column: the columns the timeline is sorted on. They must hold the same values as the
+    timestamp and id of the posts returned, but can come from another table (the materialized timeline)
+    :param id_column:
+    :param archive: the same timeline over the archived posts (see app/archive.py), read only for the pages that reach
+    back past the archival cutoff. Everything archived is older than that, but 'query' can have posts older than
+    that too (the newest post is never archived, nor what was written since the last archival run), so the rows of
+    both are merged
+    :return: a KeysetPagination
+    """
+    position = decode_cursor(cursor)
+    query = query.order_by(None)
+    before = cutoff() if archive is not None else None
+    if before is None:
+        archive = None
+    else:
+        archive = archive.order_by(None)
+    if position is not None and position[0] == NEWER:
+        direction, timestamp, id = position
+        rows = newer_than(query, timestamp, id, timestamp_column, id_column).order_by(
+            timestamp_column.asc(), id_column.asc()).limit(per_page + 1).all()
+        if archive is not None and timestamp < before:  # the archive only has posts older than the cutoff
+            rows = merge(rows, newer_than(archive, timestamp, id, ArchivedPost.timestamp, ArchivedPost.id).order_by(
+                ArchivedPost.timestamp.asc(), ArchivedPost.id.asc()).limit(per_page + 1).all(), per_page + 1)
+        items = rows[:per_page][::-1]
+        has_newer = len(rows) > per_page
+        has_older = True
+    else:
+        if position is not None:
+            direction, timestamp, id = position
+            query = older_than(query, timestamp, id, timestamp_column, id_column)
+            if archive is not None:
+                archive = older_than(archive, timestamp, id, ArchivedPost.timestamp, ArchivedPost.id)
+        rows = query.order_by(timestamp_column.desc(), id_column.desc()).limit(per_page + 1).all()
+        # the archive only has posts older than the cutoff, a page that stops short of it has nothing to take there
+        if archive is not None and (len(rows) <= per_page or rows[-1].timestamp < before):
+            rows = merge(rows, archive.order_by(ArchivedPost.timestamp.desc(), ArchivedPost.id.desc()).limit(
+                per_page + 1).all(), per_page + 1, newest_first=True)
+        items = rows[:per_page]
+        has_newer = position is not None
+        has_older = len(rows) > per_page
+    next_cursor = prev_cursor = None
+    if items and has_older:
+        next_cursor = encode_cursor(OLDER, items[-1].timestamp, items[-1].id)
+    if items and has_newer:
+        prev_cursor = encode_cursor(NEWER, items[0].timestamp, items[0].id)
+    return KeysetPagination(items, next_cursor, prev_cursor)
@@ -0,0 +1,197 @@
+"""
+Latency metrics per endpoint, and cProfile dumps of the slowest requests.
+
+For every request this measures the wall time, the number of SQL statements run and the time spent in them (from
+SQLAlchemy's cursor events) and the time spent rendering templates (from Flask's template signals), and adds them to
+histograms kept per endpoint. /admin/metrics serves them in the Prometheus text format. Streamed responses (see
+app/api.py) are measured up to the moment they start streaming.
+
+With PROFILE_SAMPLE_RATE above 0 that fraction of the requests also runs under cProfile, one request at a time, and
+the PROFILE_KEEP slowest of the profiled requests are kept in PROFILE_DIR as <endpoint>-<ms>ms-<time>.prof files, to
+be read with pstats.
+"""
+import bisect
+import cProfile
+import heapq
+import os
+import random
+import threading
+import time
+
+from flask import before_render_template, request, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENTS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+METRICS = (
+    ('request_seconds', SECONDS, 'Wall time of the requests'),
+    ('sql_seconds', SECONDS, 'Time the requests spent running SQL statements'),
+    ('sql_statements', STATEMENTS, 'SQL statements run by the requests'),
+    ('template_seconds', SECONDS, 'Time the requests spent rendering templates'),
+)
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one counts what is above every bucket
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """
+        :return: (upper bound, observations up to it) for every bucket, the last bound being '+Inf'
+        """
+        total = 0
+        for bound, count in zip(list(self.buckets) + ['+Inf'], self.counts):
+            total += count
+            yield bound, total
+
+
+class Profiler(object):
+    def __init__(self, app=None):
+        self.histograms = {}  # (metric, endpoint) -> Histogram
+        self.lock = threading.Lock()
+        self.local = threading.local()  # the measurements of the request this thread is serving
+        self.profiling = threading.Lock()  # cProfile can only follow one request at a time
+        self.slowest = []  # heap of (seconds, path) of the profiles kept
+        self.app = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        # first in line, so the time of the other before_request functions is counted too
+        app.before_request_funcs.setdefault(None, []).insert(0, self._start)
+        app.after_request(self._finish)
+        app.teardown_request(self._teardown)
+        before_render_template.connect(self._template_started, app)
+        template_rendered.connect(self._template_finished, app)
+        # the engine events are global, once is enough however many apps there are
+        if not event.contains(Engine, 'before_cursor_execute', self._sql_started):
+            event.listen(Engine, 'before_cursor_execute', self._sql_started)
+            event.listen(Engine, 'after_cursor_execute', self._sql_finished)
+
+    def _start(self):
+        self.local.current = current = {'start': time.time(), 'sql_seconds': 0.0, 'sql_statements': 0,
+                                        'template_seconds': 0.0, 'template_depth': 0, 'profile': None}
+        rate = self.app.config['PROFILE_SAMPLE_RATE']
+        if rate and random.random() < rate and self.profiling.acquire(False):
+            current['profile'] = cProfile.Profile()
+            current['profile'].enable()
+
+    def _finish(self, response):
+        current = getattr(self.local, 'current', None)
+        if current is None:
+            return response
+        seconds = time.time() - current['start']
+        profile = self._stop_profile(current)
+        endpoint = request.endpoint or 'unmatched'
+        with self.lock:
+            for name, buckets, description in METRICS:
+                value = seconds if name == 'request_seconds' else current[name]
+                histogram = self.histograms.get((name, endpoint))
+                if histogram is None:
+                    histogram = self.histograms[(name, endpoint)] = Histogram(buckets)
+                histogram.observe(value)
+        if profile is not None:
+            self._keep(profile, endpoint, seconds)
+        self.local.current = None
+        return response
+
+    def _teardown(self, exception):
+        # requests that failed without a response never reach _finish()
+        current = getattr(self.local, 'current', None)
+        if current is not None:
+            self._stop_profile(current)
+            self.local.current = None
+
+    def _stop_profile(self, current):
+        profile, current['profile'] = current['profile'], None
+        if profile is not None:
+            profile.disable()
+            self.profiling.release()
+        return profile
+
+    def _keep(self, profile, endpoint, seconds):
+        """
+        save 'profile' if it is one of the PROFILE_KEEP slowest so far, and drop the one it pushes out
+        """
+        keep = self.app.config['PROFILE_KEEP']
+        with self.lock:
+            if len(self.slowest) >= keep and seconds <= self.slowest[0][0]:
+                return
+            directory = self.app.config['PROFILE_DIR']
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            path = os.path.join(directory, '%s-%dms-%d.prof' % (endpoint, seconds * 1000, time.time() * 1000))
+            profile.dump_stats(path)
+            heapq.heappush(self.slowest, (seconds, path))
+            while len(self.slowest) > keep:
+                seconds, path = heapq.heappop(self.slowest)
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def _sql_started(self, conn, cursor, statement, parameters, context, executemany):
+        if getattr(self.local, 'current', None) is not None:
+            conn.info.setdefault('profiling_started', []).append(time.time())
+
+    def _sql_finished(self, conn, cursor, statement, parameters, context, executemany):
+        current = getattr(self.local, 'current', None)
+        started = conn.info.get('profiling_started')
+        if current is not None and started:
+            current['sql_seconds'] += time.time() - started.pop()
+            current['sql_statements'] += 1
+
+    def _template_started(self, sender, template, context, **extra):
+        current = getattr(self.local, 'current', None)
+        if current is not None:
+            # render_post() renders post.html while index.html renders, only the outer template is timed
+            if current['template_depth'] == 0:
+                current['template_started'] = time.time()
+            current['template_depth'] += 1
+
+    def _template_finished(self, sender, template, context, **extra):
+        current = getattr(self.local, 'current', None)
+        if current is not None and current['template_depth']:
+            current['template_depth'] -= 1
+            if current['template_depth'] == 0:
+                current['template_seconds'] += time.time() - current['template_started']
+
+    def metrics(self, caches=None):
+        """
+        :param caches: {name: LRUCache.stats()} to export as well
+        :return: all the histograms in the Prometheus text format
+        """
+        lines = []
+        with self.lock:
+            for name, buckets, description in METRICS:
+                lines.append('# HELP microblog_%s %s' % (name, description))
+                lines.append('# TYPE microblog_%s histogram' % name)
+                for (metric, endpoint), histogram in sorted(self.histograms.items()):
+                    if metric != name:
+                        continue
+                    for bound, count in histogram.cumulative():
+                        lines.append('microblog_%s_bucket{endpoint="%s",le="%s"} %d' % (
+                            name, endpoint, bound if bound == '+Inf' else '%g' % bound, count))
+                    lines.append('microblog_%s_sum{endpoint="%s"} %r' % (name, endpoint, float(histogram.sum)))
+                    lines.append('microblog_%s_count{endpoint="%s"} %d' % (name, endpoint, histogram.count))
+        for counter in ('hits', 'misses'):
+            lines.append('# TYPE microblog_cache_%s_total counter' % counter)
+            for cache, stats in sorted((caches or {}).items()):
+                lines.append('microblog_cache_%s_total{cache="%s"} %d' % (counter, cache, stats[counter]))
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        with self.lock:
+            self.histograms.clear()
+
+
+profiler = Profiler()
@@ -0,0 +1,90 @@
+"""
+Read replicas for the heavy GET views.
+
+SQLALCHEMY_REPLICAS lists the database URIs of copies of the primary database. They are registered as
+flask_sqlalchemy binds ('replica0', 'replica1', ...), so they get the same pool settings and SQLite PRAGMAs as the
+primary. Views decorated with @read_replica serve their GET requests from one of them, picked at random: the
+RoutingSession in app/engine.py sends their SELECTs there, and anything that writes, together with the reads after
+it, to the primary.
+
+Replicas lag behind the primary, so a client that just wrote something would not see it on the next page. After a
+request commits a write, its client reads from the primary for the next REPLICA_STICKY_SECONDS seconds, which is
+kept in the Flask session, so it holds across workers.
+
+For local testing a replica can be a copy of the SQLite file, kept up to date with db_replicate.py.
+"""
+import random
+import time
+
+from flask import current_app, has_request_context, request, session
+
+from app import db
+
+
+def read_replica(view):
+    """
+    decorator for the views whose GET requests can be served from a replica. Put it right under the route
+    """
+    view.read_replica = True
+    return view
+
+
+class ReplicaRouter(object):
+    def __init__(self, app=None):
+        self.app = None
+        self.listening = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        replicas = app.config['SQLALCHEMY_REPLICAS']
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        binds.update(('replica%d' % i, uri) for i, uri in enumerate(replicas))
+        app.config['SQLALCHEMY_BINDS'] = binds
+        app.extensions['replicas'] = ['replica%d' % i for i in range(len(replicas))]
+        if not self.listening:
+            db.event.listen(db.session, 'after_commit', self._committed)
+            db.event.listen(db.session, 'after_rollback', self._rolled_back)
+            self.listening = True
+        app.before_request(self._route)
+        app.teardown_request(self._done)
+
+    def replica_for(self, app):
+        """
+        :return: the engine of one of the replicas of 'app', None when it has none
+        """
+        binds = app.extensions.get('replicas')
+        if not binds:
+            return None
+        return db.get_engine(app, random.choice(binds))
+
+    def _route(self):
+        info = db.session().info
+        info.pop('replica', None)
+        info.pop('wrote', None)
+        view = current_app.view_functions.get(request.endpoint)
+        if request.method not in ('GET', 'HEAD') or not getattr(view, 'read_replica', False):
+            return
+        if session.get('primary_until', 0) > time.time():
+            return  # this client wrote something a moment ago
+        replica = self.replica_for(current_app)
+        if replica is not None:
+            info['replica'] = replica
+
+    def _done(self, exception):
+        info = db.session().info
+        info.pop('replica', None)
+        info.pop('wrote', None)
+
+    def _committed(self, db_session):
+        if db_session.info.pop('wrote', False) and has_request_context():
+            db_session.info.pop('replica', None)  # the rest of the request reads its own writes
+            session['primary_until'] = time.time() + current_app.config['REPLICA_STICKY_SECONDS']
+
+    def _rolled_back(self, db_session):
+        db_session.info.pop('wrote', None)
+
+
+# one router for the app, see create_app()
+router = ReplicaRouter()
@@ -0,0 +1,189 @@
+"""
+Full-text search over Post.body, backed by an SQLite FTS5 table.
+
+flask_whooshalchemy only works on Python 2, so on Python 3 search_results() had nothing to search. Here the bodies
+are indexed in the 'post_search' FTS5 virtual table, whose rowid is the id of the post. The table is created and
+dropped along with the others by db.create_all()/drop_all() and kept in step with the post table by ORM events, one
+row per insert, update or delete, so the index never needs rebuilding in normal operation. reindex() (see
+db_reindex.py) rebuilds it from scratch, for existing databases or after a bulk load.
+
+Results are ranked by FTS5's bm25 and the MAX_SEARCH_RESULTS limit is applied by SQLite, not by slicing the results.
+On databases without FTS5 search falls back to an unranked LIKE scan.
+
+With sharded posts (see app/sharding.py) each shard has its own post_search table, indexing the posts it holds. The
+best matches of every shard are merged on their rank, which bm25 computes from the statistics of each shard, so the
+ranking is close to, but not exactly, the one of a single index.
+
+Archived posts (see app/archive.py) keep their row in the index, under the same id, and search_posts() loads them
+from the archive.
+"""
+import heapq
+import re
+
+from sqlalchemy import DDL, event, inspect, text
+from sqlalchemy.sql import column, table
+
+from app import db, sharding
+from app.models import ArchivedPost, Post
+
+_fts5 = {}  # dialect -> whether its SQLite was built with FTS5, probed once
+
+post_search = table('post_search', column('rowid'), column('rank'))
+
+
+def available(connection):
+    dialect = connection.dialect
+    if dialect not in _fts5:
+        _fts5[dialect] = dialect.name == 'sqlite' and any(
+            option == 'ENABLE_FTS5' for option, in connection.execute(text('PRAGMA compile_options')))
+    return _fts5[dialect]
+
+
+def _available_for_ddl(ddl, target, bind, **kw):
+    return available(bind)
+
+
+event.listen(db.metadata, 'after_create', DDL(
+    "CREATE VIRTUAL TABLE IF NOT EXISTS post_search USING fts5(body, tokenize = 'porter unicode61')").execute_if(
+    callable_=_available_for_ddl))
+event.listen(db.metadata, 'before_drop', DDL('DROP TABLE IF EXISTS post_search').execute_if(
+    callable_=_available_for_ddl))
+
+
+@event.listens_for(Post, 'after_insert')
+def _index_post(mapper, connection, post):
+    if available(connection):
+        connection.execute(text('INSERT INTO post_search (rowid, body) VALUES (:id, :body)'),
+                           id=post.id, body=post.body or '')
+
+
+@event.listens_for(Post, 'after_update')
+def _reindex_post(mapper, connection, post):
+    if available(connection) and inspect(post).attrs.body.history.has_changes():
+        connection.execute(text('UPDATE post_search SET body = :body WHERE rowid = :id'),
+                           id=post.id, body=post.body or '')
+
+
+@event.listens_for(Post, 'after_delete')
+def _unindex_post(mapper, connection, post):
+    if available(connection):
+        connection.execute(text('DELETE FROM post_search WHERE rowid = :id'), id=post.id)
+
+
+def match_expression(terms):
+    """
+    turns what the user typed into an FTS5 query: every word has to appear, and each is quoted so characters that
+    mean something to FTS5 (quotes, AND, NEAR, *, ...) are searched for literally instead of raising a syntax error
+
+    :param terms:
+    :return: None when there is no word to look for
+    """
+    words = re.findall(r'\w+', terms, re.UNICODE)
+    if not words:
+        return None
+    return ' '.join('"%s"' % word for word in words)
+
+
+def search_posts(terms, limit):
+    """
+    :param terms: the words to look for
+    :param limit: the most results to return, MAX_SEARCH_RESULTS in the views
+    :return: the matching posts, best match first, with their authors loaded
+    """
+    match = match_expression(terms)
+    if match is None:
+        return []
+    if not available(db.session.connection()):
+        return Post.with_authors(_like_query(terms)).limit(limit).all()
+    statement = text('SELECT rank, rowid FROM post_search WHERE post_search MATCH :match ORDER BY rank LIMIT :limit')
+    shards = range(sharding.count()) or [None]
+    ranked = heapq.merge(*[[(rank, post_id, shard) for rank, post_id in _on_shard(shard).execute(
+        statement, {'match': match, 'limit': limit})] for shard in shards])
+    ranked = list(ranked)[:limit]
+    if not ranked:
+        return []
+    posts = {}
+    for shard in shards:
+        ids = [post_id for _, post_id, on in ranked if on == shard]
+        for model in (Post, ArchivedPost):  # the archive only for the ones that are not in the post table
+            ids = [post_id for post_id in ids if post_id not in posts]
+            if ids:
+                posts.update((post.id, post) for post in model.with_authors(model.query.filter(
+                    model.id.in_(ids)).on_shard(shard)))
+    return [posts[post_id] for _, post_id, _ in ranked if post_id in posts]
+
+
+def _on_shard(shard):
+    """
+    :return: the connection of the session to 'shard', to the main database for None
+    """
+    if shard is None:
+        return db.session.connection()
+    return db.session.connection(bind=sharding.engine(shard))
+
+
+def search_query(terms):
+    """
+    the posts matching 'terms' as a query, best match first, for callers that load their own columns with
+    with_entities() rather than whole posts
+
+    :param terms:
+    :return: None when there is no word to look for
+    """
+    match = match_expression(terms)
+    if match is None:
+        return None
+    if not available(db.session.connection()):
+        return _like_query(terms)
+    # sharded, each shard returns its own best matches first and the shards take turns
+    return sharding.scatter(Post.query.join(post_search, post_search.c.rowid == Post.id).filter(
+        text('post_search MATCH :match')).params(match=match).order_by(post_search.c.rank))
+
+
+def _like_query(terms):
+    query = Post.query
+    for word in re.findall(r'\w+', terms, re.UNICODE):
+        query = query.filter(Post.body.contains(word))
+    return sharding.scatter(query).order_by(Post.timestamp.desc(), Post.id.desc())
+
+
+def index_posts(connection, posts):
+    """
+    add posts written without the ORM to the index on 'connection'
+
+    :param connection:
+    :param posts: dicts with 'id' and 'body'
+    :return:
+    """
+    if posts and available(connection):
+        connection.execute(text('DELETE FROM post_search WHERE rowid = :id'), [{'id': post['id']} for post in posts])
+        connection.execute(text('INSERT INTO post_search (rowid, body) VALUES (:id, :body)'),
+                           [{'id': post['id'], 'body': post['body'] or ''} for post in posts])
+
+
+def unindex_posts(connection, ids):
+    if ids and available(connection):
+        connection.execute(text('DELETE FROM post_search WHERE rowid = :id'), [{'id': id} for id in ids])
+
+
+def reindex(after_id=None):
+    """
+    rebuild the whole index from the post and post_archive tables
+
+    :param after_id: only add the posts with a greater id instead, for posts inserted without going through the ORM
+    (see app/bulk.py)
+    :return: the number of posts indexed
+    """
+    if not available(db.session.connection()):
+        return 0
+    indexed = 0
+    for shard in range(sharding.count()) or [None]:  # each shard indexes its own posts
+        connection = _on_shard(shard)
+        if after_id is None:
+            connection.execute(text('DELETE FROM post_search'))
+        for table in ('post', 'post_archive'):
+            indexed += connection.execute(text('INSERT INTO post_search (rowid, body) SELECT id, coalesce(body, \'\') '
+                                               'FROM %s WHERE id > :after_id' % table),
+                                          {'after_id': after_id or 0}).rowcount
+    db.session.commit()
+    return indexed
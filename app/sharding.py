@@ -0,0 +1,307 @@
+"""
+Posts split by author over several SQLite databases.
+
+With POST_SHARDS set to a list of SQLite URIs, each post is stored in shard 'user_id % len(POST_SHARDS)' instead of
+the post table of the main database, so the writes, the vacuums and the backups of the posts are spread over several
+files. Everything else (users, followers, the post id sequence) stays in the main database, which every shard
+connection ATTACHes: a query run on a shard can still join its posts with user and followers.
+
+- a new post goes to the shard of its author when the session flushes (see RoutingSession in app/engine.py), with an
+  id from the post_ids sequence of the main database, so the ids are unique across the shards
+- User.sorted_posts() reads the shard of the user only: Post.query is a PostQuery, which on_shard() pins to a shard
+- User.followed_posts() runs on every shard and merges the rows, each shard sorted on (timestamp, id), with heapq:
+  a ShardedQuery, which takes filter(), order_by(), limit() and the like like a query, and pushes them, limit
+  included, down to each shard
+- search works on the index of each shard and merges the results (see app/search.py)
+- the archived posts (see app/archive.py) are on the shard of their author too, in its post_archive table
+
+Without POST_SHARDS none of this is in the way: on_shard() does nothing and scatter() returns the query it is given.
+The materialized timelines (TIMELINE_ENABLED) are not supported on sharded posts. db_reshard.py moves the posts
+when the list of shards changes, and db_create.py creates the tables of the shards.
+"""
+import heapq
+import itertools
+from collections import defaultdict
+from operator import attrgetter
+
+from flask import current_app
+from flask_sqlalchemy import BaseQuery
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import Query
+from sqlalchemy.sql import operators
+
+from app import db
+
+
+def configure(app, uris):
+    """
+    shard the posts of 'app' over the SQLite databases at 'uris', or stop sharding them when 'uris' is empty. Sessions
+    opened before keep routing the way they did
+
+    :param app:
+    :param uris:
+    :return:
+    """
+    binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+    for name in app.extensions.get('post_shards', ()):
+        binds.pop(name, None)
+    names = ['posts%d' % i for i in range(len(uris))]
+    binds.update(zip(names, uris))
+    app.config['SQLALCHEMY_BINDS'] = binds
+    app.extensions['post_shards'] = names
+    if not uris:
+        app.extensions.pop('flush_connection', None)
+        return
+    primary = sqlite_path(app.config['SQLALCHEMY_DATABASE_URI'])
+    if primary is None or None in map(sqlite_path, uris):
+        raise ValueError('POST_SHARDS needs SQLite files for the database and every shard')
+    if app.config['TIMELINE_ENABLED']:
+        raise ValueError('TIMELINE_ENABLED does not work with POST_SHARDS')
+    app.extensions.setdefault('sqlite_attach', {}).update((name, {'app': primary}) for name in names)
+    app.extensions['flush_connection'] = _flush_connection
+
+
+def init_app(app):
+    configure(app, app.config['POST_SHARDS'])
+
+
+def sqlite_path(uri):
+    url = make_url(uri)
+    if not url.drivername.startswith('sqlite') or url.database in (None, '', ':memory:'):
+        return None
+    return url.database
+
+
+def count(app=None):
+    """
+    :return: the number of shards, 0 when the posts are not sharded
+    """
+    return len((app or current_app).extensions.get('post_shards', ()))
+
+
+def engine(shard, app=None):
+    app = app or current_app
+    return db.get_engine(app, app.extensions['post_shards'][shard])
+
+
+def engines(app=None):
+    """
+    :return: the engine of every shard, in order
+    """
+    return [engine(shard, app) for shard in range(count(app))]
+
+
+def shard_of(user_id, app=None):
+    """
+    :return: the shard holding the posts of 'user_id', None when the posts are not sharded
+    """
+    shards = count(app)
+    if not shards:
+        return None
+    return (user_id or 0) % shards
+
+
+def create_all(app=None):
+    """
+    create the post and post_archive tables, with their indexes and the search index, on every shard that does not
+    have them yet
+    """
+    from app.models import ArchivedPost, Post
+    for shard_engine in engines(app):
+        db.metadata.create_all(shard_engine, tables=[Post.__table__, ArchivedPost.__table__])
+
+
+def drop_all(app=None):
+    from app.models import ArchivedPost, Post
+    for shard_engine in engines(app):
+        db.metadata.drop_all(shard_engine, tables=[Post.__table__, ArchivedPost.__table__])
+
+
+def reshard(sources, targets, chunk_size=10000, progress=None):
+    """
+    move the posts, archived ones included, from one layout of the shards to another, the posts that stay on the same
+    database are not touched.
+    A layout is the list of the engines of the shards, in order, or [] for the post table of the main database. Each
+    chunk is first written to its new shard and then deleted from the old one, so an interrupted run can be started
+    again
+
+    :param sources: where the posts are now
+    :param targets: where they should go
+    :param chunk_size: posts read at a time
+    :param progress: a bulk.Progress
+    :return: the number of posts moved
+    """
+    from app.models import ArchivedPost, Post, post_ids
+    from app import search
+    moved = last_id = 0
+    for source, post in itertools.product(sources or [db.engine], (Post.__table__, ArchivedPost.__table__)):
+        after = 0
+        while True:
+            with source.connect() as connection:
+                rows = connection.execute(db.select([post]).where(post.c.id > after).order_by(post.c.id).limit(
+                    chunk_size)).fetchall()
+            if not rows:
+                break
+            after = rows[-1].id
+            last_id = max(last_id, after)
+            moving = defaultdict(list)
+            for row in rows:
+                target = targets[row.user_id % len(targets)] if targets else db.engine
+                if str(target.url) != str(source.url):
+                    moving[target].append(dict(row))
+            for target, posts in moving.items():
+                with target.begin() as connection:
+                    connection.execute(post.insert().prefix_with('OR REPLACE'), posts)
+                    search.index_posts(connection, posts)
+                with source.begin() as connection:
+                    ids = [row['id'] for row in posts]
+                    connection.execute(post.delete().where(post.c.id.in_(ids)))
+                    search.unindex_posts(connection, ids)
+                moved += len(posts)
+                if progress is not None:
+                    progress.add(len(posts))
+    # the sequence carries on after every post there is, whichever way they were numbered before
+    with db.engine.begin() as connection:
+        connection.execute(post_ids.update().where(post_ids.c.last_id < last_id).values(last_id=last_id))
+    return moved
+
+
+def _flush_connection(session, mapper, instance):
+    from app.models import Post
+    if isinstance(instance, Post):
+        return session.connection(mapper, bind=engine(shard_of(instance.user_id, session.app), session.app))
+    return session.connection(mapper)
+
+
+def next_ids(session, number=1):
+    """
+    take 'number' post ids from the sequence in the main database, in the transaction of 'session'
+
+    :return: the first of them
+    """
+    from app.models import post_ids
+    session.execute(post_ids.update().values(last_id=post_ids.c.last_id + number))
+    return session.execute(db.select([post_ids.c.last_id])).scalar() - number + 1
+
+
+class PostQuery(BaseQuery):
+    """
+    the query class of Post, which can be pinned to one shard
+    """
+    _shard = None
+
+    def on_shard(self, shard):
+        """
+        :param shard: from shard_of(), None leaves the query where it is
+        """
+        query = self._clone()
+        query._shard = shard
+        return query
+
+    def _connection_from_session(self, **kw):
+        if self._shard is not None:
+            kw['bind'] = engine(self._shard, self.session.app)
+        return Query._connection_from_session(self, **kw)
+
+
+def scatter(query):
+    """
+    :param query: a Post query
+    :return: a ShardedQuery running 'query' on every shard, or 'query' itself when the posts are not sharded
+    """
+    shards = count()
+    if not shards:
+        return query
+    return ShardedQuery([query.on_shard(shard) for shard in range(shards)])
+
+
+def _merge_order(clauses):
+    """
+    :return: (key, reverse) to merge rows sorted by 'clauses', the names of the columns they sort on, which the rows
+        have to have as attributes
+    """
+    names = [getattr(clause, 'element', clause).key for clause in clauses]
+    reverse = any(getattr(clause, 'modifier', None) is operators.desc_op for clause in clauses)
+    return attrgetter(*names), reverse
+
+
+def _round_robin(iterators):
+    iterators = list(iterators)
+    while iterators:
+        for iterator in list(iterators):
+            try:
+                yield next(iterator)
+            except StopIteration:
+                iterators.remove(iterator)
+
+
+class ShardedQuery(object):
+    """
+    the same query run on several shards, read as one. Rows come out in the order given to order_by(), merged from
+    what each shard returns in that order, or taking turns between the shards when there is no order
+    """
+
+    def __init__(self, queries, key=None, reverse=False, limit=None):
+        self.queries = queries
+        self.key = key
+        self.reverse = reverse
+        self._limit = limit
+
+    def _map(self, method, *args, **kwargs):
+        return ShardedQuery([getattr(query, method)(*args, **kwargs) for query in self.queries], self.key,
+                            self.reverse, self._limit)
+
+    def filter(self, *criterion):
+        return self._map('filter', *criterion)
+
+    def filter_by(self, **kwargs):
+        return self._map('filter_by', **kwargs)
+
+    def join(self, *props, **kwargs):
+        return self._map('join', *props, **kwargs)
+
+    def options(self, *args):
+        return self._map('options', *args)
+
+    def params(self, *args, **kwargs):
+        return self._map('params', *args, **kwargs)
+
+    def with_entities(self, *entities):
+        return self._map('with_entities', *entities)
+
+    def yield_per(self, count):
+        return self._map('yield_per', count)
+
+    def order_by(self, *clauses):
+        query = self._map('order_by', *clauses)
+        if len(clauses) == 1 and clauses[0] is None:
+            query.key, query.reverse = None, False
+        elif clauses:
+            query.key, query.reverse = _merge_order(clauses)
+        return query
+
+    def limit(self, limit):
+        query = self._map('limit', limit)  # no shard has to return more than that
+        query._limit = limit
+        return query
+
+    def __iter__(self):
+        streams = [iter(query) for query in self.queries]
+        if self.key is None:
+            rows = _round_robin(streams)
+        else:
+            rows = heapq.merge(*streams, key=self.key, reverse=self.reverse)
+        return itertools.islice(rows, self._limit)
+
+    def all(self):
+        return list(self)
+
+    def first(self):
+        return next(iter(self.limit(1)), None)
+
+    def count(self):
+        total = sum(query.count() for query in self.queries)
+        return total if self._limit is None else min(total, self._limit)
+
+    def __getitem__(self, index):
+        return self.all()[index]
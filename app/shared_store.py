@@ -0,0 +1,116 @@
+"""
+Access to a store shared by every worker process, for the caches and rate limits that have to agree across processes.
+
+The store is anything speaking the redis client API. connect() takes a URL: 'redis://...' needs the redis package,
+'local://' gives a LocalStore, an in-process stand-in implementing the handful of commands the app uses, key expiry
+included, so tests and single-process setups can exercise the shared code paths without a server.
+"""
+import fnmatch
+import threading
+import time
+
+
+def connect(url):
+    if url.startswith('local://'):
+        return LocalStore()
+    import redis  # only needed when a real shared store is configured
+    return redis.StrictRedis.from_url(url)
+
+
+def _encode(value):
+    # redis hands everything back as bytes
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode('utf-8')
+
+
+class LocalStore(object):
+    def __init__(self):
+        self._data = {}
+        self._expires = {}  # key -> time.time() past which the key is gone
+        self._lock = threading.Lock()
+
+    def _expire_old(self, key):
+        if key in self._expires and self._expires[key] <= time.time():
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+
+    def exists(self, key):
+        self._expire_old(key)
+        return key in self._data
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._expire_old(key)
+                self._expires.pop(key, None)
+            return sum(1 for key in keys if self._data.pop(key, None) is not None)
+
+    def flushdb(self):
+        with self._lock:
+            self._data.clear()
+            self._expires.clear()
+
+    def scan_iter(self, match=None):
+        """
+        the keys matching the glob 'match', all of them without one
+        """
+        with self._lock:
+            keys = list(self._data)
+        for key in keys:
+            self._expire_old(key)
+            if key in self._data and (match is None or fnmatch.fnmatchcase(key, match)):
+                yield key
+
+    def set(self, key, value, ex=None):
+        with self._lock:
+            self._data[key] = _encode(value)
+            self._expires.pop(key, None)
+            if ex is not None:
+                self._expires[key] = time.time() + ex
+            return True
+
+    def get(self, key):
+        self._expire_old(key)
+        return self._data.get(key)
+
+    def incrbyfloat(self, key, amount):
+        with self._lock:
+            self._expire_old(key)
+            value = float(self._data.get(key, 0)) + amount
+            self._data[key] = _encode(repr(value))
+            return value
+
+    def expire(self, key, seconds):
+        with self._lock:
+            self._expire_old(key)
+            if key not in self._data:
+                return False
+            self._expires[key] = time.time() + seconds
+            return True
+
+    def sadd(self, key, *values):
+        with self._lock:
+            self._expire_old(key)
+            members = self._data.setdefault(key, set())
+            before = len(members)
+            members.update(_encode(value) for value in values)
+            return len(members) - before
+
+    def srem(self, key, *values):
+        with self._lock:
+            self._expire_old(key)
+            members = self._data.get(key, set())
+            before = len(members)
+            members.difference_update(_encode(value) for value in values)
+            if not members:
+                self._data.pop(key, None)
+            return before - len(members)
+
+    def sismember(self, key, value):
+        self._expire_old(key)
+        return _encode(value) in self._data.get(key, ())
+
+    def smembers(self, key):
+        self._expire_old(key)
+        return set(self._data.get(key, ()))
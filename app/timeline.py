@@ -0,0 +1,134 @@
+"""
+Materialized home timelines (fan-out on write).
+
+User.followed_posts() joins 'followers' against the whole post table and sorts the result on every load of /index.
+When TIMELINE_ENABLED is set, every new post is instead pushed into the 'timeline' table of each follower of its
+author, so reading a home timeline becomes a range scan on ix_timeline_user_id_timestamp whose cost does not depend
+on how many posts there are.
+
+The join in followed_posts() stays the source of truth: rebuild() regenerates the whole table from it and check()
+reports the users whose timeline disagrees with it.
+"""
+from flask import current_app
+from sqlalchemy import and_, exists, literal, select
+
+from app import db
+from app.models import User, Post, followers, timeline
+
+
+def enabled():
+    return current_app.config['TIMELINE_ENABLED']
+
+
+def push(post):
+    """
+    fan a new post out to the timeline of everyone following its author. Called by index() before the commit, so the
+    post and its timeline rows land in the same transaction
+
+    :param post:
+    :return:
+    """
+    if not enabled():
+        return
+    if post.id is None:
+        db.session.flush()  # need the id of the post before it can be referenced
+    db.session.execute(timeline.insert().from_select(
+        ['user_id', 'post_id', 'timestamp'],
+        select([followers.c.follower_id,
+                literal(post.id, db.Integer),
+                literal(post.timestamp, db.DateTime)]).where(followers.c.followed_id == post.user_id).distinct()))
+
+
+def backfill(follower, followed):
+    """
+    copy the existing posts of 'followed' into the timeline of 'follower', used right after a follow
+
+    :param follower:
+    :param followed:
+    :return:
+    """
+    if not enabled():
+        return
+    already_there = exists().where(and_(timeline.c.user_id == follower.id, timeline.c.post_id == Post.id))
+    db.session.execute(timeline.insert().from_select(
+        ['user_id', 'post_id', 'timestamp'],
+        select([literal(follower.id, db.Integer), Post.id, Post.timestamp]).where(
+            and_(Post.user_id == followed.id, ~already_there))))
+
+
+def prune(follower, followed):
+    """
+    remove the posts of 'followed' from the timeline of 'follower', used right after an unfollow
+
+    :param follower:
+    :param followed:
+    :return:
+    """
+    if not enabled():
+        return
+    db.session.execute(timeline.delete().where(and_(
+        timeline.c.user_id == follower.id,
+        timeline.c.post_id.in_(select([Post.id]).where(Post.user_id == followed.id)))))
+
+
+def home_posts(user, load_authors=True, archived=False):
+    """
+    the posts to show on the home page of 'user', newest first. Reads the materialized timeline when it is enabled and
+    falls back to the followed_posts() join otherwise. Like followed_posts() this returns a query object.
+
+    :param user:
+    :param load_authors: see Post.with_authors()
+    :param archived: the archived posts instead, which are never in the materialized timeline (see app/archive.py)
+    :return:
+    """
+    if archived or not enabled():
+        return user.followed_posts(load_authors, archived)
+    query = Post.query.join(timeline, timeline.c.post_id == Post.id).filter(
+        timeline.c.user_id == user.id).order_by(timeline.c.timestamp.desc(), timeline.c.post_id.desc())
+    return Post.with_authors(query) if load_authors else query
+
+
+def sort_columns():
+    """
+    the (timestamp, id) columns home_posts() is sorted on, for pagination.paginate()
+
+    :return:
+    """
+    if not enabled():
+        return Post.timestamp, Post.id
+    return timeline.c.timestamp, timeline.c.post_id
+
+
+def rebuild():
+    """
+    throw the timeline table away and regenerate it from followers/post in one statement
+
+    :return: the number of timeline rows written
+    """
+    db.session.execute(timeline.delete())
+    db.session.execute(timeline.insert().from_select(
+        ['user_id', 'post_id', 'timestamp'],
+        select([followers.c.follower_id, Post.id, Post.timestamp]).select_from(
+            followers.join(Post.__table__, followers.c.followed_id == Post.user_id)).distinct()))
+    db.session.commit()
+    return db.session.query(timeline).count()
+
+
+def check(users=None):
+    """
+    compare the materialized timelines against the followed_posts() join
+
+    :param users: the users to check, defaults to all of them
+    :return: {user id: (post ids missing from the timeline, post ids that should not be there)} for every user whose
+    timeline is inconsistent, so an empty dict means everything is in order
+    """
+    if users is None:
+        users = User.query.all()
+    problems = {}
+    for user in users:
+        expected = set(post_id for post_id, in user.followed_posts(load_authors=False).with_entities(Post.id))
+        actual = set(post_id for post_id, in db.session.query(timeline.c.post_id).filter(
+            timeline.c.user_id == user.id))
+        if expected != actual:
+            problems[user.id] = (sorted(expected - actual), sorted(actual - expected))
+    return problems
@@ -2,29 +2,54 @@
 Each view function is mapped to one or more request URLS.
 
 """
+import os
 from datetime import datetime
 
+from flask import abort
+from flask import Blueprint
+from flask import current_app
 from flask import flash
 from flask import g  # global setup by Flask as a place to store and share data during the life of a request
+from flask import jsonify
 from flask import redirect
 from flask import render_template
 from flask import request
+from flask import Response
 from flask import session
 from flask import url_for
 from flask_login import login_user, current_user, login_required, logout_user
-
-# This 'app' is the actual object itself that was initiated when the module 'app' got initiated
-from app import app, oid, db, lm
+from flask_openid import OpenID
+
+from app import db, lm, conditional, timeline
+from app.admission import admission, limit_writes
+from app.fragments import fragments
+from app.last_seen import tracker as last_seen
+from app.pagination import paginate
+from app.profiling import profiler
+from app.replicas import read_replica
+from app.search import search_posts
 from app.forms import LoginForm, EditForm, PostForm, SearchForm
-from app.models import User, Post
-from config import POSTS_PER_PAGE, MAX_SEARCH_RESULTS
+from app.models import User, Post, avatar_urls, identities
+from config import POSTS_PER_PAGE, MAX_SEARCH_RESULTS, ADMINS, basedir
+
+# the views are registered on the app by create_app(), which calls init_app() below
+main = Blueprint('main', __name__)
+
+# flask-openid needs a place to store temp files
+oid = OpenID(fs_store_path=os.path.join(basedir, 'tmp'))
 
 
-@app.route('/', methods=['GET', 'POST'])
-@app.route('/index', methods=['GET', 'POST'])
-@app.route('/index/<int:page>', methods=['GET', 'POST'])
+def init_app(app):
+    oid.init_app(app)
+    app.register_blueprint(main)
+
+
+@main.route('/', methods=['GET', 'POST'])
+@main.route('/index', methods=['GET', 'POST'])
+@read_replica  # GETs read from a replica when there is one
+@limit_writes('POST')  # and POSTs are rate limited, see app/admission.py
 @login_required  # decorated with the flask_login extension
-def index(page=1):
+def index():
     form = PostForm()
     # user = {'nickname': 'Huy'}  # fake user
     if form.validate_on_submit():
@@ -32,9 +57,10 @@ def index(page=1):
                     timestamp=datetime.utcnow(),
                     author=g.user)
         db.session.add(post)
+        timeline.push(post)
         db.session.commit()
         flash("Your post is now live!")
-        return redirect(url_for('index'))  # redirect itself back to see the updated post
+        return redirect(url_for('main.index'))  # redirect itself back to see the updated post
         #  This redirect is important because it prevents the app from POSTing a second time by pressing refresh
     # user = g.user
 
@@ -49,21 +75,25 @@ def index(page=1):
     #     }
     # ]
     # posts = g.user.followed_posts().all()
-    posts = g.user.followed_posts().paginate(page, POSTS_PER_PAGE, False)
-
-    return render_template('index.html',  # render_template
-                           title="Home",
-                           posts=posts,
-                           form=form)
+    # posts = g.user.followed_posts().paginate(page, POSTS_PER_PAGE, False)
+    posts = paginate(timeline.home_posts(g.user), request.args.get('cursor'), POSTS_PER_PAGE,
+                     *timeline.sort_columns(), archive=timeline.home_posts(g.user, archived=True))
+    # a reload with nothing new gets a 304 without rendering anything, see app/conditional.py
+    parts, newest = conditional.posts_page(posts)
+    return conditional.respond(conditional.page_etag('index', g.user.id, g.user.version, parts), newest,
+                               lambda: render_template('index.html',  # render_template
+                                                       title="Home",
+                                                       posts=posts,
+                                                       form=form))
 
 
 #  POST requests. Default is GET
-@app.route("/login", methods=['GET', 'POST'])  # the methods tells flask that this view function accepts both GET and
+@main.route("/login", methods=['GET', 'POST'])  # the methods tells flask that this view function accepts both GET and
 @oid.loginhandler  # this tells flask-openid that this is the login function view
 def login():
     # does this handle the auto login? if g.user is present?
     if g.user is not None and g.user.is_authenticated:
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
 
     form = LoginForm()  # gets the object and instantiate it, the template then have access to the 'openid' and
     # 'remember_me' attributes of the object
@@ -84,11 +114,11 @@ def login():
     return render_template('login.html',
                            title='Sign In',
                            form=form,
-                           providers=app.config["OPENID_PROVIDERS"]
+                           providers=current_app.config["OPENID_PROVIDERS"]
                            )
 
 
-@app.before_request
+@main.before_app_request
 def before_request():
     """
     This is important to note. the 'User' and its relation to the 'g' variable
@@ -100,9 +130,8 @@ def before_request():
     """
     g.user = current_user  # global for flask-login
     if g.user.is_authenticated:
-        g.user.last_seen = datetime.utcnow()
-        db.session.add(g.user)
-        db.session.commit()
+        # batched in memory instead of a commit per request, see app/last_seen.py
+        last_seen.touch(g.user.id)
         g.search_form = SearchForm()
 
 
@@ -115,27 +144,35 @@ def load_user(id):
     :param id:
     :return:
     """
-    return User.query.get(int(id))
+    # from the identity cache when it can, without a query, see app/identity.py
+    return identities.load(int(id))
 
 
-@app.route("/user/<nickname>")  # this route is referenced in the template by '{{ url_for('user',
+@main.route("/user/<nickname>")  # this route is referenced in the template by '{{ url_for('main.user',
 # nickname=g.user.nickname}}'
-@app.route("/user/<nickname>/<int:page>")
+@read_replica
 @login_required
-def user(nickname, page=1):
-    user = User.query.filter_by(nickname=nickname).first()  # user here is an object with attributes of nickname
+def user(nickname):
+    # user here is an object with attributes of nickname. populate_existing(): the logged in user's own profile
+    # comes from the database, not from the cached snapshot
+    user = User.query.filter_by(nickname=nickname).populate_existing().first()
     if user is None:
         flash("User {} for found".format(nickname))
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     # posts = g.user.followed_posts().all()
-    posts = user.sorted_posts().paginate(page, POSTS_PER_PAGE, False)
+    posts = paginate(user.sorted_posts(), request.args.get('cursor'), POSTS_PER_PAGE,
+                     archive=user.sorted_posts(archived=True))
     # posts = [
     #     {'author': user, 'body': "Test post body #1"},
     #     {'author': user, 'body': "Test post body #2"}
     # ]
-    return render_template('user.html',
-                           user=user,
-                           posts=posts)
+    parts, newest = conditional.posts_page(posts)
+    profile = (user.id, user.version, user.last_seen, user.posts_count, user.followers_count, user.followed_count,
+               g.user.is_following(user))
+    return conditional.respond(conditional.page_etag('user', g.user.id, g.user.version, profile, parts), newest,
+                               lambda: render_template('user.html',
+                                                       user=user,
+                                                       posts=posts))
 
 
 # function is called after OpenID try to login
@@ -145,31 +182,32 @@ def after_login(resp):
     if resp.email is None or resp.email == "":
         flash('Invalid login. Please try again.')
         #  if is not a valid email, we will not allow for login
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
     # find in database for the email provided
     user = User.query.filter_by(email=resp.email).first()
     if user is None:  # if not User if found, the user will then be considered a new User and will be added to the DB
         nickname = resp.nickname
         if nickname is None or nickname == "":  # solve cases for some OpenID does not provide user name
             nickname = resp.email.split('@')[0]
-        nickname = User.make_unique_nickname(nickname)  # this solves the unique nickname problem by incrementing the
-        #  number
-        user = User(nickname=nickname, email=resp.email)  # There's a problem here with unique nickname
-        db.session.add(user)
-        db.session.commit()
+        # this solves the unique nickname problem by incrementing the number, and retries when a concurrent signup
+        # took the same nickname first
+        user = User.create(nickname, resp.email)
         # make the user follower himself/herself
-        db.session.add(user.follow(user))
-        db.session.commit()
+        if user.follow(user) is not None:
+            db.session.add(user)
+            timeline.backfill(user, user)
+            db.session.commit()
 
     remember_me = False
     if 'remember_me' in session:
         remember_me = session['remember_me']
         session.pop('remember_me', None)
     login_user(user, remember=remember_me)
-    return redirect(request.args.get('next') or url_for('index'))
+    return redirect(request.args.get('next') or url_for('main.index'))
 
 
-@app.route('/edit', methods=['POST', 'GET'])
+@main.route('/edit', methods=['POST', 'GET'])
+@limit_writes('POST')
 @login_required
 def edit():
     """
@@ -181,37 +219,42 @@ def edit():
     if form.validate_on_submit():
         g.user.nickname = form.nickname.data
         g.user.about_me = form.about_me.data
+        g.user.version = (g.user.version or 0) + 1  # renderings of the old profile are out of date now
         db.session.add(g.user)
         db.session.commit()
+        fragments.invalidate_author(g.user.id)
         flash("Your changes have been saved!")
-        return redirect(url_for('edit'))
+        return redirect(url_for('main.edit'))
     else:
         form.nickname.data = g.user.nickname
         form.about_me.data = g.user.about_me
     return render_template('edit.html', form=form)
 
 
-@app.route("/follow/<nickname>")
+@main.route("/follow/<nickname>")
+@limit_writes('GET')
 @login_required
 def follow(nickname):
     user = User.query.filter_by(nickname=nickname).first()
     if user is None:
         flash("User {} not found.".format(nickname))
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     if user == g.user:
         flash("You can't follow yourself!")
-        return redirect(url_for('user', nickname=nickname))
+        return redirect(url_for('main.user', nickname=nickname))
     u = g.user.follow(user)
     if u is None:
         flash('Cannot follow {}.'.format(nickname))
-        return redirect(url_for('user', nickname=nickname))
+        return redirect(url_for('main.user', nickname=nickname))
     db.session.add(u)
+    timeline.backfill(g.user, user)
     db.session.commit()
     flash("You are not following {}.".format(nickname))
-    return redirect(url_for('user', nickname=nickname))
+    return redirect(url_for('main.user', nickname=nickname))
 
 
-@app.route('/unfollow/<nickname>')
+@main.route('/unfollow/<nickname>')
+@limit_writes('GET')
 @login_required
 def unfollow(nickname):
     user = User.query.filter_by(nickname=nickname).first()
@@ -219,29 +262,30 @@ def unfollow(nickname):
         flash("User {} not found.".format(nickname))
     if user == g.user:
         flash("You can't unfollow yourself!")
-        return redirect(url_for('user', nickname=nickname))
+        return redirect(url_for('main.user', nickname=nickname))
     u = g.user.unfollow(user)
     if u is None:
         flash('Cannot unfollow ' + nickname + '.')
-        return redirect(url_for('user', nickname=nickname))
+        return redirect(url_for('main.user', nickname=nickname))
     db.session.add(u)
+    timeline.prune(g.user, user)
     db.session.commit()
     flash('You have stopped following ' + nickname + '.')
-    return redirect(url_for('user', nickname=nickname))
+    return redirect(url_for('main.user', nickname=nickname))
 
 
-@app.route("/logout")
+@main.route("/logout")
 def logout():
     logout_user()
-    return redirect(url_for('index'))
+    return redirect(url_for('main.index'))
 
 
-@app.errorhandler(404)
+@main.app_errorhandler(404)
 def not_found_error(error):
     return render_template('404.html'), 404
 
 
-@app.errorhandler(500)
+@main.app_errorhandler(500)
 def internal_error(error):
     """
     If this is triggered by the database error, then the DB session will be in an invalid state, rollback is needed
@@ -253,25 +297,53 @@ def internal_error(error):
     return render_template('500.html'), 500
 
 
-@app.route("/search", methods=["POST"])
+@main.route("/search", methods=["POST"])
 @login_required
 def search():
     if not g.search_form.validate_on_submit():
-        return redirect(url_for('index'))
-    return redirect(url_for('search_results', query=g.search_form.search.data))
+        return redirect(url_for('main.index'))
+    return redirect(url_for('main.search_results', query=g.search_form.search.data))
 
 
-@app.route('/search_results/<query>')
+@main.route('/search_results/<query>')
+@read_replica
 @login_required
 def search_results(query):
 
     # results = Post.query.whoosh_search(query, MAX_SEARCH_RESULTS).all()
-    results = []
+    results = search_posts(query, MAX_SEARCH_RESULTS)
     return render_template('search_results.html',
                            query=query,
                            results=results)
 
 
-@app.route('/err')
+@main.route('/admin/cache')
+@login_required
+def cache_stats():
+    """
+    hit/miss counters of the in-process caches, for monitoring. Only for the addresses in ADMINS
+    :return:
+    """
+    if g.user.email not in ADMINS:
+        abort(404)
+    return jsonify(fragments=fragments.stats(), avatars=avatar_urls.stats(), identities=identities.stats())
+
+
+@main.route('/admin/metrics')
+@login_required
+def metrics():
+    """
+    latency histograms of every endpoint, the cache counters and the admission control gauges, in the Prometheus
+    text format (see app/profiling.py and app/admission.py). Only for the addresses in ADMINS
+    :return:
+    """
+    if g.user.email not in ADMINS:
+        abort(404)
+    return Response(profiler.metrics({'fragments': fragments.stats(), 'avatars': avatar_urls.stats(),
+                                     'identities': identities.stats()}) + admission.metrics(),
+                    mimetype='text/plain; version=0.0.4')
+
+
+@main.route('/err')
 def err():
     raise Exception
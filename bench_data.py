@@ -0,0 +1,83 @@
+#!flask/bin/python
+"""
+Seeded synthetic data for the benchmarks: users, a power-law follow graph and posts.
+
+A few users are followed by almost everyone and most by hardly anyone, how many users each one follows has a long tail
+too, and the authors of the posts are skewed the same way as the popularity, like on a real microblog. The same
+arguments and seed always give the same database.
+
+    ./bench_data.py [--users 2000] [--posts 200000] [--seed 42] DATABASE_FILE
+
+or from another script, inside an app context: bench_data.generate(users, posts, seed)
+"""
+import argparse
+import itertools
+import random
+from datetime import datetime, timedelta
+
+from app import app, bulk, db
+from app.models import User, followers
+
+VOCABULARY = ['word%d' % i for i in range(5000)]
+EPOCH = datetime(2017, 1, 1)
+
+
+def zipf_weights(count, exponent=1.1):
+    return list(itertools.accumulate(1.0 / (rank + 1) ** exponent for rank in range(count)))
+
+
+def generate(users, posts, seed=42, follows=20):
+    """
+    fill the database of the current app with 'users' users, who follow 'follows' users on average (plus themselves)
+    and wrote 'posts' posts between them
+
+    :return: the nicknames of the users, the most followed first
+    """
+    rng = random.Random(seed)
+    nicknames = ['user%d' % i for i in range(users)]
+    last_user_id, last_post_id = bulk.last_ids()
+    bulk.import_users({'nickname': nickname, 'email': nickname + '@example.com', 'about_me': 'about ' + nickname}
+                      for nickname in nicknames)
+    ids = dict(db.session.query(User.nickname, User.id).filter(User.id > last_user_id))
+    db.session.commit()
+
+    # popularity falls off as a power of the rank, and so do the out-degrees (pareto, with 'follows' as their mean)
+    popularity = zipf_weights(users)
+    rows = []
+    for nickname in nicknames:
+        wanted = min(users - 1, int(rng.paretovariate(2.0) * follows / 2.0))
+        followed = set()
+        while len(followed) < wanted:
+            followed.update(rng.choices(nicknames, cum_weights=popularity, k=wanted - len(followed)))
+            followed.discard(nickname)
+        rows.extend({'follower_id': ids[nickname], 'followed_id': ids[other]} for other in sorted(followed))
+    for offset in range(0, len(rows), 10000):
+        with db.engine.begin() as connection:
+            connection.execute(followers.insert(), rows[offset:offset + 10000])
+
+    span = 30 * 86400
+
+    def post_records():
+        for i in range(posts):
+            words = rng.choices(VOCABULARY, cum_weights=vocabulary_weights, k=rng.randint(3, 15))
+            yield {'author': rng.choices(nicknames, cum_weights=popularity)[0], 'body': ' '.join(words)[:140],
+                   'timestamp': (EPOCH + timedelta(seconds=rng.randint(0, span))).isoformat()}
+
+    vocabulary_weights = zipf_weights(len(VOCABULARY))
+    bulk.import_posts(post_records())
+    bulk.finish(last_user_id, last_post_id)
+    return nicknames
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fill a database with seeded synthetic users, follows and posts.')
+    parser.add_argument('database')
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--posts', type=int, default=200000)
+    parser.add_argument('--follows', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + args.database
+    with app.app_context():
+        db.create_all()
+        generate(args.users, args.posts, args.seed, args.follows)
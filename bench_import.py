@@ -0,0 +1,74 @@
+#!flask/bin/python
+"""
+Import time of the app, from 'python -X importtime' in a fresh interpreter each time.
+
+Importing the package and the models has to stay cheap for the scripts and the workers: the views, OpenID and the
+logging handlers are only loaded by create_app(). BUDGETS is the time each statement may take, in milliseconds (the
+best of a few runs), and this script exits with 1 when one goes over it. tests.py only fails past three times the
+budget, or when one of the modules in LAZY gets imported.
+
+    ./bench_import.py [--repeat 5] [--top 15]
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+BUDGETS = [
+    ('import app', 400),
+    ('import app.models', 450),
+    ('from app import app', 900),  # the whole application, for comparison
+]
+
+# modules only create_app() may import
+LAZY = ['flask_openid', 'flask_wtf', 'app.views', 'app.api', 'app.mail_log', 'app.profiling']
+
+_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+def importtime(statement):
+    """
+    run 'statement' in a new interpreter
+
+    :return: (module name, self us, cumulative us, depth) of each module it imported, in the order they finished
+    """
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement], stderr=subprocess.PIPE,
+                             stdout=subprocess.DEVNULL, cwd=os.path.dirname(os.path.abspath(__file__)),
+                             universal_newlines=True, check=True)
+    modules = []
+    for line in process.stderr.splitlines():
+        match = _LINE.match(line)
+        if match:
+            modules.append((match.group(4), int(match.group(1)), int(match.group(2)), len(match.group(3)) // 2))
+    return modules
+
+
+def measure(statement, repeat=3):
+    """
+    :return: the best total in milliseconds, and the modules of that run. The modules the interpreter imports on its
+        own at startup are left out of both
+    """
+    startup = set(name for name, _, _, _ in importtime('pass'))
+    best = None
+    for i in range(repeat):
+        modules = [module for module in importtime(statement) if module[0] not in startup]
+        total = sum(cumulative for _, _, cumulative, depth in modules if depth == 0) / 1000.0
+        if best is None or total < best[0]:
+            best = (total, modules)
+    return best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the import time of the app.')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15, help='how many of the slowest modules to list')
+    args = parser.parse_args()
+    over = False
+    for statement, budget in BUDGETS:
+        total, modules = measure(statement, args.repeat)
+        over = over or total > budget
+        print('%-24s %7.1f ms  (budget %d ms)%s' % (statement, total, budget, '  OVER' if total > budget else ''))
+        for name, own, cumulative, depth in sorted(modules, key=lambda module: -module[1])[:args.top]:
+            print('    %-40s %7.1f ms self %8.1f ms cumulative' % (name, own / 1000.0, cumulative / 1000.0))
+    sys.exit(1 if over else 0)
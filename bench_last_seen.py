@@ -0,0 +1,59 @@
+#!flask/bin/python
+"""
+Requests/second of authenticated page views with last_seen written through on every request (the old behaviour,
+LAST_SEEN_FLUSH_THRESHOLD = 1) against the batched tracker.
+
+    ./bench_last_seen.py [requests per thread] [threads]
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from app import app, db
+from app.last_seen import tracker
+from app.models import User
+
+requests_per_thread = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+threads = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+batched_threshold = app.config['LAST_SEEN_FLUSH_THRESHOLD']
+
+path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+app.config['WTF_CSRF_ENABLED'] = False
+
+with app.app_context():
+    db.create_all()
+    users = [User(nickname='user%d' % i, email='user%d@example.com' % i) for i in range(threads)]
+    db.session.add_all(users)
+    db.session.commit()
+    user_ids = [u.id for u in users]
+
+
+def hammer(user_id):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+    for i in range(requests_per_thread):
+        client.get('/edit')
+
+
+def run(threshold):
+    app.config['LAST_SEEN_FLUSH_THRESHOLD'] = threshold
+    workers = [threading.Thread(target=hammer, args=(user_id,)) for user_id in user_ids]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    tracker.flush()
+    return requests_per_thread * threads / (time.time() - start)
+
+
+before = run(1)
+after = run(batched_threshold)
+print('%d threads x %d requests' % (threads, requests_per_thread))
+print('write-through: %8.1f requests/s' % before)
+print('batched:       %8.1f requests/s (%.1fx)' % (after, after / before))
@@ -0,0 +1,54 @@
+#!flask/bin/python
+"""
+Cost of User.make_unique_nickname() when thousands of users share the same base nickname, against the old loop that
+tried john2, john3, ... with one query each.
+
+    ./bench_nickname.py [same-prefix users]
+"""
+import os
+import sys
+import tempfile
+import time
+
+from app import app, db
+from app.instrumentation import QueryCounter
+from app.models import User
+
+count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+
+path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+
+
+def old_make_unique_nickname(nickname):
+    if User.query.filter_by(nickname=nickname).first() is None:
+        return nickname
+    version = 2
+    while True:
+        new_nickname = nickname + str(version)
+        if User.query.filter_by(nickname=new_nickname).first() is None:
+            break
+        version += 1
+    return new_nickname
+
+
+def timed(function):
+    with QueryCounter() as queries:
+        start = time.time()
+        nickname = function('john')
+        elapsed = time.time() - start
+    return nickname, elapsed, queries.count
+
+
+with app.app_context():
+    db.create_all()
+    names = ['john'] + ['john%d' % i for i in range(2, count + 1)]
+    # some neighbours in the index that share the prefix without being candidates
+    names += ['johnny%d' % i for i in range(count // 10)] + ['johnson']
+    db.session.execute(User.__table__.insert(), [{'nickname': name, 'email': name + '@example.com'} for name in names])
+    db.session.commit()
+
+    for label, function in (('query per candidate', old_make_unique_nickname),
+                            ('single range scan', User.make_unique_nickname)):
+        nickname, elapsed, queries = timed(function)
+        print('%-20s %-10s %8.2f ms %6d queries' % (label, nickname, elapsed * 1000, queries))
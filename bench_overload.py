@@ -0,0 +1,159 @@
+#!flask/bin/python
+"""
+Load test of the admission control (see app/admission.py): latency of the reads while bots flood the writes.
+
+Builds a scratch database and serves it from a threaded server in a child process, once without admission control
+and once with the limits of config.py. Reader clients load /index as logged in users the whole time, --read-rate
+times a second between them, and after a quiet first half writer clients flood /index with --write-rate new posts a
+second.
+
+    ./bench_overload.py [--readers 8] [--read-rate 40] [--writers 16] [--write-rate 150] [--seconds 30]
+
+The table compares the latency of the reads before and during the flood, and counts what became of the writes.
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+try:
+    from http.client import HTTPConnection
+    from urllib.parse import urlencode
+except ImportError:
+    from httplib import HTTPConnection
+    from urllib import urlencode
+
+from app import create_app, db
+from app.models import User, Post
+
+parser = argparse.ArgumentParser(description='Load test the admission control with a flood of writes.')
+parser.add_argument('--readers', type=int, default=8)
+parser.add_argument('--read-rate', type=float, default=40, help='reads a second, all the readers together')
+parser.add_argument('--writers', type=int, default=16)
+parser.add_argument('--write-rate', type=float, default=150, help='writes a second, all the writers together')
+parser.add_argument('--seconds', type=float, default=30, help='for each run, writes start half way through')
+parser.add_argument('--port', type=int, default=8766)
+args = parser.parse_args()
+
+DATABASE = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+OFF = dict(RATE_LIMIT_USER_RATE=None, RATE_LIMIT_GLOBAL_RATE=None, SHED_MAX_WRITES=None, SHED_MAX_LOCK_WAIT=None)
+
+
+def make_app(**overrides):
+    return create_app(SQLALCHEMY_DATABASE_URI=DATABASE, WTF_CSRF_ENABLED=False, **overrides)
+
+
+def serve(overrides):
+    from werkzeug.serving import make_server
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)  # no line per request
+    make_server('127.0.0.1', args.port, make_app(**overrides), threaded=True).serve_forever()
+
+
+def wait_for_server(deadline=20):
+    start = time.time()
+    while time.time() - start < deadline:
+        try:
+            connection = HTTPConnection('127.0.0.1', args.port, timeout=1)
+            connection.request('GET', '/login')
+            connection.getresponse().read()
+            return
+        except Exception:
+            time.sleep(0.2)
+    raise RuntimeError('the server did not come up')
+
+
+def paced(rate, stop_at):
+    """
+    yields 'rate' times a second until 'stop_at', at a fixed pace rather than as fast as the answers come back, so
+    both runs get the same traffic
+    """
+    next_at = time.time()
+    while next_at < stop_at:
+        time.sleep(max(0, next_at - time.time()))
+        yield
+        next_at += 1.0 / rate
+
+
+def reader(cookie, stop_at, write_from, quiet, flooded):
+    connection = HTTPConnection('127.0.0.1', args.port, timeout=60)
+    for _ in paced(args.read_rate / args.readers, stop_at):
+        start = time.time()
+        try:
+            connection.request('GET', '/index', headers={'Cookie': cookie})
+            response = connection.getresponse()
+            response.read()
+        except Exception:
+            connection = HTTPConnection('127.0.0.1', args.port, timeout=60)
+            continue
+        (quiet if start < write_from else flooded).append(time.time() - start)
+
+
+def writer(cookie, stop_at, statuses):
+    connection = HTTPConnection('127.0.0.1', args.port, timeout=60)
+    headers = {'Cookie': cookie, 'Content-Type': 'application/x-www-form-urlencoded'}
+    for _ in paced(args.write_rate / args.writers, stop_at):
+        try:
+            connection.request('POST', '/index', urlencode({'post': 'spam'}), headers)
+            response = connection.getresponse()
+            response.read()
+            statuses.append(response.status)
+        except Exception as e:
+            statuses.append(type(e).__name__)
+            connection = HTTPConnection('127.0.0.1', args.port, timeout=60)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else float('nan')
+
+
+app = make_app()
+with app.app_context():
+    db.create_all()
+    users = [User(nickname='user%d' % i, email='user%d@example.com' % i) for i in range(args.readers + args.writers)]
+    db.session.add_all(users)
+    db.session.commit()
+    now = datetime.utcnow()
+    db.session.add_all([Post(body='post number %d' % i, author=users[i % len(users)],
+                             timestamp=now - timedelta(minutes=i)) for i in range(2000)])
+    for user in users:
+        for followed in users[:10]:
+            user.follow(followed)
+    db.session.commit()
+    user_ids = [user.id for user in users]
+
+# a session cookie per user, signed the way the app does it, so the clients are logged in
+serializer = app.session_interface.get_signing_serializer(app)
+cookies = ['%s=%s' % (app.session_cookie_name, serializer.dumps({'user_id': str(user_id), '_user_id': str(user_id),
+                                                                  '_fresh': True}))
+           for user_id in user_ids]
+
+print('%-10s %11s %11s %11s %11s %8s %8s %8s' % ('admission', 'quiet p50', 'quiet p99', 'flood p50', 'flood p99',
+                                                 'written', '429', '503'))
+for name, overrides in (('off', OFF), ('on', {})):
+    server = multiprocessing.Process(target=serve, args=(overrides,))
+    server.daemon = True
+    server.start()
+    try:
+        wait_for_server()
+        quiet, flooded, statuses = [], [], []
+        start = time.time()
+        stop_at, write_from = start + args.seconds, start + args.seconds / 2
+        threads = [threading.Thread(target=reader, args=(cookies[i], stop_at, write_from, quiet, flooded))
+                   for i in range(args.readers)]
+        threads += [threading.Timer(args.seconds / 2, writer, args=(cookies[args.readers + i], stop_at, statuses))
+                    for i in range(args.writers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        print('%-10s %9.1fms %9.1fms %9.1fms %9.1fms %8d %8d %8d' % (
+            name, percentile(quiet, 0.5) * 1000, percentile(quiet, 0.99) * 1000, percentile(flooded, 0.5) * 1000,
+            percentile(flooded, 0.99) * 1000, statuses.count(302), statuses.count(429), statuses.count(503)))
+    finally:
+        server.terminate()
+        server.join()
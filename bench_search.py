@@ -0,0 +1,66 @@
+#!flask/bin/python
+"""
+Search latency over a large synthetic post table.
+
+Fills a scratch database with posts made of random words, builds the FTS5 index and times search_posts() for single
+words and word pairs of varying frequency.
+
+    ./bench_search.py [posts] [searches]
+"""
+import itertools
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from app import app, db, search
+from app.models import User, Post
+
+post_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+searches = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+random.seed(42)
+# a zipf-ish vocabulary: a few very common words and a long tail of rare ones
+vocabulary = ['word%d' % i for i in range(20000)]
+cumulative_weights = list(itertools.accumulate(1.0 / (rank + 1) for rank in range(len(vocabulary))))
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+with app.app_context():
+    db.create_all()
+    db.session.execute(User.__table__.insert(), [{'nickname': 'user%d' % i, 'email': 'user%d@example.com' % i}
+                                                 for i in range(1, 1001)])
+    start = time.time()
+    now = datetime.utcnow()
+    for offset in range(0, post_count, 50000):
+        rows = []
+        for i in range(offset, min(post_count, offset + 50000)):
+            words = random.choices(vocabulary, cum_weights=cumulative_weights, k=random.randint(5, 20))
+            rows.append({'body': ' '.join(words)[:140], 'user_id': i % 1000 + 1,
+                         'timestamp': now - timedelta(seconds=i)})
+        db.session.execute(Post.__table__.insert(), rows)
+    db.session.commit()
+    print('%d posts generated in %.1f s' % (post_count, time.time() - start))
+    start = time.time()
+    search.reindex()
+    print('index built in %.1f s' % (time.time() - start))
+
+    for label, words_per_search, pool in (('common word', 1, vocabulary[:50]),
+                                          ('rare word', 1, vocabulary[5000:]),
+                                          ('two words', 2, vocabulary[:2000])):
+        latencies = []
+        for i in range(searches):
+            terms = ' '.join(random.sample(pool, words_per_search))
+            start = time.time()
+            search.search_posts(terms, app.config['MAX_SEARCH_RESULTS'])
+            latencies.append((time.time() - start) * 1000)
+        print('%-12s p50 %7.2f ms  p95 %7.2f ms  max %7.2f ms' % (
+            label, percentile(latencies, 0.5), percentile(latencies, 0.95), max(latencies)))
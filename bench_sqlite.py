@@ -0,0 +1,102 @@
+#!flask/bin/python
+"""
+Read latency of an SQLite database while another connection keeps committing, for each profile of
+app/engine.py.
+
+Every profile gets a fresh copy of the same scratch database. One writer thread inserts posts, committing each one
+like the index() view does, while reader threads page through the timeline of a user the way followed_posts() does.
+
+    ./bench_sqlite.py [--profiles default,wal,throughput,durable] [--readers 4] [--seconds 5]
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, select
+from sqlalchemy.pool import QueuePool
+
+from app import app, db
+from app.engine import SQLITE_PROFILES, install_pragmas, sqlite_pragmas
+from app.models import User, Post, followers
+
+parser = argparse.ArgumentParser(description='Read latency of SQLite under write load, per PRAGMA profile.')
+parser.add_argument('--profiles', default=','.join(sorted(SQLITE_PROFILES)))
+parser.add_argument('--readers', type=int, default=4)
+parser.add_argument('--seconds', type=float, default=5)
+parser.add_argument('--users', type=int, default=200)
+parser.add_argument('--posts', type=int, default=20000)
+args = parser.parse_args()
+
+directory = tempfile.mkdtemp()
+template = os.path.join(directory, 'template.db')
+engine = create_engine('sqlite:///' + template)
+db.metadata.create_all(engine, tables=[User.__table__, Post.__table__, followers])
+now = datetime.utcnow()
+with engine.begin() as connection:
+    connection.execute(User.__table__.insert(), [{'id': i, 'nickname': 'user%d' % i, 'email': 'user%d@example.com' % i}
+                                                 for i in range(1, args.users + 1)])
+    connection.execute(Post.__table__.insert(), [{'body': 'post number %d' % i, 'user_id': i % args.users + 1,
+                                                  'timestamp': now - timedelta(seconds=i)}
+                                                 for i in range(args.posts)])
+    connection.execute(followers.insert(), [{'follower_id': i, 'followed_id': (i + j) % args.users + 1}
+                                            for i in range(1, args.users + 1) for j in range(20)])
+engine.dispose()
+
+post = Post.__table__
+timeline_query = select([post.c.id, post.c.body, post.c.timestamp]).where(post.c.user_id.in_(
+    select([followers.c.followed_id]).where(followers.c.follower_id == 1))).order_by(
+    post.c.timestamp.desc()).limit(app.config['POSTS_PER_PAGE'] * 10)
+
+
+def writer(engine, stop_at, writes, errors):
+    while time.time() < stop_at:
+        try:
+            with engine.begin() as connection:
+                connection.execute(post.insert(), body='a new post', user_id=2, timestamp=datetime.utcnow())
+            writes.append(1)
+        except Exception as e:
+            errors.append(e)
+
+
+def reader(engine, stop_at, latencies, errors):
+    while time.time() < stop_at:
+        start = time.time()
+        try:
+            with engine.connect() as connection:
+                connection.execute(timeline_query).fetchall()
+        except Exception as e:
+            errors.append(e)
+            continue
+        latencies.append(time.time() - start)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else float('nan')
+
+
+print('%-11s %8s %9s %9s %9s %7s' % ('profile', 'writes/s', 'reads/s', 'p50 ms', 'p99 ms', 'errors'))
+for profile in args.profiles.split(','):
+    path = os.path.join(directory, profile + '.db')
+    shutil.copy(template, path)
+    engine = create_engine('sqlite:///' + path, poolclass=QueuePool, pool_size=args.readers + 1,
+                           connect_args={'check_same_thread': False})
+    install_pragmas(engine, sqlite_pragmas(dict(app.config, SQLITE_PROFILE=profile)))
+    writes, latencies, errors = [], [], []
+    stop_at = time.time() + args.seconds
+    threads = [threading.Thread(target=writer, args=(engine, stop_at, writes, errors))]
+    threads += [threading.Thread(target=reader, args=(engine, stop_at, latencies, errors))
+                for i in range(args.readers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    engine.dispose()
+    print('%-11s %8.1f %9.1f %9.2f %9.2f %7d' % (profile, len(writes) / args.seconds, len(latencies) / args.seconds,
+                                                 percentile(latencies, 0.5) * 1000,
+                                                 percentile(latencies, 0.99) * 1000, len(errors)))
+shutil.rmtree(directory)
@@ -0,0 +1,180 @@
+#!flask/bin/python
+"""
+Benchmarks of the hot paths, on a seeded synthetic database (see bench_data.py).
+
+Times the model methods (followed_posts, sorted_posts, pagination, is_following, make_unique_nickname, search) and the
+views, driven through app.test_client() as a logged in user who follows many others. Results go to stdout and, with
+--output, to a JSON file. --compare reads such a file from another commit and reports every scenario whose median
+got slower by more than --threshold, exiting with 1 when there is one.
+
+    ./bench_suite.py [--users 2000] [--posts 200000] [--repeat 50] [--output results.json] [--compare base.json]
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+parser = argparse.ArgumentParser(description='Benchmark the microblog hot paths.')
+parser.add_argument('--users', type=int, default=2000)
+parser.add_argument('--posts', type=int, default=200000)
+parser.add_argument('--seed', type=int, default=42)
+parser.add_argument('--repeat', type=int, default=50)
+parser.add_argument('--only', help='comma separated scenario names')
+parser.add_argument('--output')
+parser.add_argument('--compare')
+parser.add_argument('--threshold', type=float, default=1.2, help='slowdown ratio counted as a regression')
+args = parser.parse_args()
+
+# the database has to be chosen before the app is imported
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+
+import sqlalchemy
+
+import bench_data
+from app import app, db, search
+from app.models import User, follow_graph
+from app.pagination import paginate
+from app.fragments import fragments
+from config import POSTS_PER_PAGE
+
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['PROFILE_SAMPLE_RATE'] = 0
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def measure(function, repeat):
+    function()  # warm up
+    timings = []
+    for i in range(repeat):
+        start = time.time()
+        function()
+        timings.append((time.time() - start) * 1000)
+    return OrderedDict([('median_ms', percentile(timings, 0.5)), ('p95_ms', percentile(timings, 0.95)),
+                        ('min_ms', min(timings)), ('mean_ms', sum(timings) / len(timings)), ('runs', repeat)])
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def scenarios(reader, popular, client):
+    """
+    :param reader: a user who follows a lot of people
+    :param popular: the most followed user, who has the most posts
+    :param client: a test client logged in as 'reader'
+    :return: name -> function to time
+    """
+    def walk_pages(query, pages=20):
+        cursor = None
+        for i in range(pages):
+            cursor = paginate(query, cursor, POSTS_PER_PAGE).next_num
+            if cursor is None:
+                break
+
+    deep_cursor = paginate(reader.followed_posts(), None, 200).next_num
+    others = User.query.order_by(User.id).limit(200).all()
+
+    def is_following_cold():
+        follow_graph.clear()
+        for other in others:
+            reader.is_following(other)
+
+    def is_following_warm():
+        for other in others:
+            reader.is_following(other)
+
+    def get(url):
+        def request():
+            response = client.get(url)
+            assert response.status_code == 200, (url, response.status_code)
+            response.get_data()
+        return request
+
+    def get_cold(url):
+        def request():
+            fragments.clear()
+            get(url)()
+        return request
+
+    functions = OrderedDict([
+        ('followed_posts_first_page', lambda: reader.followed_posts().limit(POSTS_PER_PAGE).all()),
+        ('sorted_posts_first_page', lambda: popular.sorted_posts().limit(POSTS_PER_PAGE).all()),
+        ('paginate_followed_20_pages', lambda: walk_pages(reader.followed_posts())),
+        ('paginate_followed_deep_page', lambda: paginate(reader.followed_posts(), deep_cursor, POSTS_PER_PAGE)),
+        ('is_following_200_cold', is_following_cold),
+        ('is_following_200_warm', is_following_warm),
+        ('make_unique_nickname', lambda: User.make_unique_nickname('user1')),
+        ('search_common_word', lambda: search.search_posts('word0', app.config['MAX_SEARCH_RESULTS'])),
+        ('view_index', get('/index')),
+        ('view_index_cold_fragments', get_cold('/index')),
+        ('view_index_deep_page', get('/index?cursor=%s' % deep_cursor)),
+        ('view_user', get('/user/' + popular.nickname)),
+        ('view_search_results', get('/search_results/word1')),
+        ('view_api_timeline', get('/api/timeline?limit=50')),
+    ])
+    if deep_cursor is None:
+        # without a 201st post the deep page would be page 1 all over again
+        print('skipping the deep page scenarios, the reader follows fewer than 201 posts')
+        del functions['paginate_followed_deep_page'], functions['view_index_deep_page']
+    return functions
+
+
+def compare(results, path, threshold):
+    with open(path) as f:
+        base = json.load(f)
+    regressions = []
+    print('\ncompared with %s (commit %s)' % (path, base['meta'].get('commit')))
+    for name, result in results.items():
+        if name not in base['results']:
+            continue
+        ratio = result['median_ms'] / max(base['results'][name]['median_ms'], 1e-6)
+        flag = 'REGRESSION' if ratio > threshold else ''
+        if flag:
+            regressions.append(name)
+        print('%-32s %9.2f -> %9.2f ms  x%.2f %s' % (name, base['results'][name]['median_ms'], result['median_ms'],
+                                                     ratio, flag))
+    return regressions
+
+
+with app.app_context():
+    db.create_all()
+    start = time.time()
+    nicknames = bench_data.generate(args.users, args.posts, args.seed)
+    print('generated %d users and %d posts in %.1f s' % (args.users, args.posts, time.time() - start))
+    reader = User.query.order_by(User.followed_count.desc()).first()
+    popular = User.query.filter_by(nickname=nicknames[0]).one()
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = session['_user_id'] = str(reader.id)
+        session['_fresh'] = True
+
+    results = OrderedDict()
+    only = args.only.split(',') if args.only else None
+    for name, function in scenarios(reader, popular, client).items():
+        if only and name not in only:
+            continue
+        results[name] = measure(function, args.repeat)
+        db.session.rollback()  # nothing stays cached in the session between scenarios
+        print('%-32s median %9.2f ms  p95 %9.2f ms' % (name, results[name]['median_ms'], results[name]['p95_ms']))
+
+meta = OrderedDict([('commit', git_commit()), ('time', time.strftime('%Y-%m-%dT%H:%M:%S')),
+                    ('python', platform.python_version()), ('sqlalchemy', sqlalchemy.__version__),
+                    ('users', args.users), ('posts', args.posts), ('seed', args.seed), ('repeat', args.repeat)])
+if args.output:
+    with open(args.output, 'w') as f:
+        json.dump(OrderedDict([('meta', meta), ('results', results)]), f, indent=2)
+if args.compare:
+    sys.exit(1 if compare(results, args.compare, args.threshold) else 0)
@@ -0,0 +1,131 @@
+#!flask/bin/python
+"""
+Load test of run_production.py: throughput and latency of logged in /index views as the number of workers grows.
+
+Builds a scratch database, starts the production server on it for each worker count in turn and fires requests at
+it from client threads for a fixed time.
+
+    ./bench_workers.py [--workers 1,2,4] [--threads 4] [--clients 16] [--seconds 10] [--store redis://...]
+
+More than one worker needs a shared store for the follow graph and the rate limits (see FOLLOW_GRAPH_STORE), given
+with --store or in the FOLLOW_GRAPH_STORE environment variable.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+try:
+    from http.client import HTTPConnection
+except ImportError:
+    from httplib import HTTPConnection
+
+parser = argparse.ArgumentParser(description='Load test run_production.py with a growing number of workers.')
+parser.add_argument('--workers', default='1,2,4')
+parser.add_argument('--threads', type=int, default=4)
+parser.add_argument('--clients', type=int, default=16)
+parser.add_argument('--seconds', type=float, default=10)
+parser.add_argument('--port', type=int, default=8765)
+parser.add_argument('--store', default=os.environ.get('FOLLOW_GRAPH_STORE'),
+                    help='the shared store of the workers, e.g. redis://localhost:6379/0')
+args = parser.parse_args()
+worker_counts = [int(count) for count in args.workers.split(',')]
+if max(worker_counts) > 1 and not args.store:
+    parser.error('more than one worker needs --store, run_production.py refuses to start them without one')
+
+# the server processes read the database from the environment, so set it before the app gets imported
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+if args.store:
+    os.environ['FOLLOW_GRAPH_STORE'] = os.environ['RATE_LIMIT_STORE'] = args.store
+
+from app import app, db
+from app.models import User, Post
+
+with app.app_context():
+    db.create_all()
+    users = [User(nickname='user%d' % i, email='user%d@example.com' % i) for i in range(50)]
+    db.session.add_all(users)
+    db.session.commit()
+    now = datetime.utcnow()
+    db.session.add_all([Post(body='post number %d' % i, author=users[i % 50], timestamp=now - timedelta(minutes=i))
+                        for i in range(2000)])
+    for user in users:
+        for followed in users[:10]:
+            user.follow(followed)
+    db.session.commit()
+    user_ids = [user.id for user in users]
+
+# a session cookie per user, signed the way the app does it, so the clients are logged in
+serializer = app.session_interface.get_signing_serializer(app)
+cookies = ['%s=%s' % (app.session_cookie_name, serializer.dumps({'user_id': str(user_id), '_user_id': str(user_id),
+                                                                  '_fresh': True}))
+           for user_id in user_ids]
+
+
+def wait_for_server(server, log, deadline=20):
+    start = time.time()
+    while time.time() - start < deadline:
+        if server.poll() is not None:
+            log.seek(0)
+            raise RuntimeError('the server exited with status %d:\n%s' % (server.returncode, log.read().decode('utf-8')))
+        try:
+            connection = HTTPConnection('127.0.0.1', args.port, timeout=1)
+            connection.request('GET', '/login')
+            connection.getresponse().read()
+            return
+        except Exception:
+            time.sleep(0.2)
+    raise RuntimeError('the server did not come up')
+
+
+def client(number, stop_at, latencies, errors):
+    connection = HTTPConnection('127.0.0.1', args.port, timeout=30)
+    headers = {'Cookie': cookies[number % len(cookies)]}
+    while time.time() < stop_at:
+        start = time.time()
+        try:
+            connection.request('GET', '/index', headers=headers)
+            response = connection.getresponse()
+            response.read()
+            if response.status != 200:
+                errors.append(response.status)
+                continue
+        except Exception as e:
+            errors.append(e)
+            connection = HTTPConnection('127.0.0.1', args.port, timeout=30)
+            continue
+        latencies.append(time.time() - start)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else float('nan')
+
+
+print('%7s %7s %10s %9s %9s %7s' % ('workers', 'threads', 'requests/s', 'p50 ms', 'p99 ms', 'errors'))
+for workers in worker_counts:
+    log = tempfile.TemporaryFile()  # the server's stderr, shown when it fails to start
+    server = subprocess.Popen([sys.executable, 'run_production.py', '--bind', '127.0.0.1:%d' % args.port,
+                               '--workers', str(workers), '--threads', str(args.threads)],
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              stdout=subprocess.DEVNULL, stderr=log)
+    try:
+        wait_for_server(server, log)
+        latencies, errors = [], []
+        stop_at = time.time() + args.seconds
+        clients = [threading.Thread(target=client, args=(i, stop_at, latencies, errors)) for i in range(args.clients)]
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        print('%7d %7d %10.1f %9.1f %9.1f %7d' % (workers, args.threads, len(latencies) / args.seconds,
+                                                   percentile(latencies, 0.5) * 1000,
+                                                   percentile(latencies, 0.99) * 1000, len(errors)))
+    finally:
+        server.terminate()
+        server.wait()
+        log.close()
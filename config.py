@@ -7,6 +7,13 @@ SECRET_KEY = 'you-will-never-guess'
 
 # pagination
 POSTS_PER_PAGE = 3
+# posts per page of the JSON API (app/api.py) when the client does not ask for a 'limit', and the most it can ask for
+API_PER_PAGE = 20
+API_MAX_PER_PAGE = 200
+
+# home timeline: when enabled, new posts are fanned out into a per-follower 'timeline' table and /index reads from it
+# instead of joining followers against every post. Run ./db_timeline.py rebuild after switching it on
+TIMELINE_ENABLED = False
 
 OPENID_PROVIDERS = [
     {'name': 'Google', 'url': 'https://www.google.com/accounts/o8/id'},
@@ -16,9 +23,46 @@ OPENID_PROVIDERS = [
     {'name': 'MyOpenID', 'url': 'https://www.myopenid.com'}]
 
 
-SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir, 'app.db')
+SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///' + os.path.join(basedir, 'app.db')
 SQLALCHEMY_MIGRATE_REPO = os.path.join(basedir, 'db_repository')
 
+# connection pool of each worker process. Keep SQLALCHEMY_POOL_SIZE at least SERVER_THREADS so threads don't queue
+# for a connection. SQLite connections wait up to SQLITE_BUSY_TIMEOUT seconds for another worker's write lock
+SQLALCHEMY_POOL_SIZE = 5
+SQLALCHEMY_MAX_OVERFLOW = 5
+SQLALCHEMY_POOL_TIMEOUT = 10
+SQLALCHEMY_POOL_RECYCLE = 3600
+SQLITE_BUSY_TIMEOUT = 15
+# PRAGMAs run on every new SQLite connection: one of the profiles in app/engine.py ('default', 'wal', 'throughput',
+# 'durable'), with SQLITE_PRAGMAS layered on top, e.g. {'cache_size': -32000}
+SQLITE_PROFILE = 'wal'
+SQLITE_PRAGMAS = {}
+
+# URIs of read replicas of the database, the GET requests of the views marked @read_replica read from one of them
+# (see app/replicas.py). A client that wrote something reads from the primary for REPLICA_STICKY_SECONDS after it.
+# For local testing a copy of the SQLite file does, kept up to date by db_replicate.py, e.g.
+# ['sqlite:///' + os.path.join(basedir, 'replica.db')]
+SQLALCHEMY_REPLICAS = []
+REPLICA_STICKY_SECONDS = 5
+
+# SQLite files to spread the posts over, by author (see app/sharding.py), e.g.
+# ['sqlite:///' + os.path.join(basedir, 'posts%d.db' % i) for i in range(4)]. Empty keeps them in the main database.
+# Run db_reshard.py after changing it, it moves the posts that now belong to another shard
+POST_SHARDS = []
+
+# posts older than ARCHIVE_AFTER_DAYS days are moved to the post_archive table by db_archive.py (see app/archive.py),
+# keeping the post table and its indexes small. The pages past the recent posts read the archive. None never archives
+ARCHIVE_AFTER_DAYS = None
+# posts moved per transaction, and the seconds db_archive.py waits between two of them so requests get the database
+ARCHIVE_CHUNK_SIZE = 1000
+ARCHIVE_PAUSE = 0.1
+
+# last_seen is kept in memory and written for all users at once in a single UPDATE, either every
+# LAST_SEEN_FLUSH_INTERVAL seconds (so it is never staler than that) or as soon as LAST_SEEN_FLUSH_THRESHOLD users are
+# waiting. A threshold of 1 writes through on every request like before
+LAST_SEEN_FLUSH_INTERVAL = 60
+LAST_SEEN_FLUSH_THRESHOLD = 100
+
 
 # mail server settings
 # mail server settings
@@ -26,10 +70,78 @@ MAIL_SERVER = 'localhost'
 MAIL_PORT = 25
 MAIL_USERNAME = None
 MAIL_PASSWORD = None
+# error emails are queued (up to MAIL_QUEUE_SIZE records, more are dropped) and sent by a background thread as
+# digests: it waits MAIL_DIGEST_DELAY seconds for more errors, sends at most one digest every MAIL_MIN_INTERVAL seconds
+# and lists up to MAIL_DIGEST_MAX errors in it. See app/mail_log.py
+MAIL_QUEUE_SIZE = 1000
+MAIL_DIGEST_DELAY = 10
+MAIL_MIN_INTERVAL = 60
+MAIL_DIGEST_MAX = 50
+MAIL_TIMEOUT = 10
+
+# run_production.py: a pre-forking gunicorn master with SERVER_WORKERS processes of SERVER_THREADS threads each.
+# kill -HUP the master to reload the code, workers get SERVER_GRACEFUL_TIMEOUT seconds to finish their requests.
+# One worker by default: more, twice the CPUs plus one is a good start, need FOLLOW_GRAPH_STORE, and
+# RATE_LIMIT_STORE for the rate limits to hold across them
+SERVER_BIND = '0.0.0.0:8000'
+SERVER_WORKERS = 1
+SERVER_THREADS = 4
+SERVER_TIMEOUT = 30
+SERVER_GRACEFUL_TIMEOUT = 30
 
 # administrator list
 ADMINS = ['you@example.com']
 
-# setting full text search params
+# where User.is_following() caches who follows whom. None keeps it in each process, which is right for a single
+# worker. With several workers point it at a shared store, 'redis://localhost:6379/0' (needs the redis package), so
+# a follow in one worker is seen by the others. 'local://' is an in-process stand-in for the shared store
+FOLLOW_GRAPH_STORE = os.environ.get('FOLLOW_GRAPH_STORE') or None
+# the sets of at most FOLLOW_GRAPH_CACHE_SIZE users are kept in each process, a set FOLLOW_GRAPH_TTL seconds at most
+# in either
+FOLLOW_GRAPH_CACHE_SIZE = 10000
+FOLLOW_GRAPH_TTL = 3600
+
+# admission control of the views that write, see app/admission.py. Every user can write RATE_LIMIT_USER_BURST times in
+# a row and then RATE_LIMIT_USER_RATE times a second, and all the users together RATE_LIMIT_GLOBAL_BURST and
+# RATE_LIMIT_GLOBAL_RATE, past which they get a 429. A rate of None lifts that limit. The buckets are kept in each
+# process, or in a shared store like FOLLOW_GRAPH_STORE when RATE_LIMIT_STORE is set, which holds the limits across
+# the workers
+RATE_LIMIT_USER_RATE = 1.0
+RATE_LIMIT_USER_BURST = 10
+RATE_LIMIT_GLOBAL_RATE = 50.0
+RATE_LIMIT_GLOBAL_BURST = 100
+RATE_LIMIT_STORE = os.environ.get('RATE_LIMIT_STORE') or None
+# and a worker answers 503 to new writes while SHED_MAX_WRITES are already in progress in it, or while writes wait more
+# than SHED_MAX_LOCK_WAIT seconds for the database lock on average (None turns either check off), telling the client
+# to come back after SHED_RETRY_AFTER seconds. Keep SHED_MAX_LOCK_WAIT below SQLITE_BUSY_TIMEOUT, and SHED_MAX_WRITES
+# below SERVER_THREADS: a worker never has more requests in progress than threads, so writes filling all of them
+# would never be shed, and one thread is left for the reads
+SHED_MAX_WRITES = max(1, SERVER_THREADS - 1)
+SHED_MAX_LOCK_WAIT = 1.0
+SHED_RETRY_AFTER = 1
+
+# number of avatar URLs User.avatar() keeps around
+AVATAR_CACHE_SIZE = 4096
+
+# number of rendered post.html fragments kept by app/fragments.py
+FRAGMENT_CACHE_SIZE = 10000
+
+# logged in users Flask-Login finds in memory instead of loading them, see app/identity.py. With several workers a
+# change made in one of them is seen by the others after IDENTITY_CACHE_TTL seconds
+IDENTITY_CACHE_SIZE = 10000
+IDENTITY_CACHE_TTL = 60
+
+# seconds browsers may keep files from /static without asking again. The pages themselves are always revalidated,
+# with an ETag, see app/conditional.py
+SEND_FILE_MAX_AGE_DEFAULT = 86400
+
+# fraction of the requests to run under cProfile, 0 turns it off. The PROFILE_KEEP slowest profiled requests are
+# kept in PROFILE_DIR, see app/profiling.py
+PROFILE_SAMPLE_RATE = 0
+PROFILE_KEEP = 20
+PROFILE_DIR = os.path.join(basedir, 'tmp', 'profiles')
+
+# setting full text search params. WHOOSH_BASE is only used on Python 2, otherwise posts are indexed in an SQLite FTS5
+# table (app/search.py). MAX_SEARCH_RESULTS is passed down to the search query as its LIMIT
 WHOOSH_BASE = os.path.join(basedir, 'search.db')
 MAX_SEARCH_RESULTS = 50
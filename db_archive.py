@@ -0,0 +1,33 @@
+#!flask/bin/python
+"""
+Moves the posts older than ARCHIVE_AFTER_DAYS to the archive (see app/archive.py)
+
+    ./db_archive.py                     archive what is old enough once, from cron
+    ./db_archive.py --interval 3600     and again every hour
+
+The posts are moved ARCHIVE_CHUNK_SIZE at a time, one transaction each, with ARCHIVE_PAUSE seconds between chunks so
+the app is not kept waiting for the database.
+"""
+import argparse
+import time
+
+from app import app, archive, bulk
+
+parser = argparse.ArgumentParser(description='Move the old posts to the archive.')
+parser.add_argument('--interval', type=float, help='seconds between runs, run once when not given')
+parser.add_argument('--chunk-size', type=int, help='posts moved per transaction, ARCHIVE_CHUNK_SIZE by default')
+args = parser.parse_args()
+
+with app.app_context():
+    if archive.cutoff() is None:
+        parser.exit(1, 'set ARCHIVE_AFTER_DAYS to archive the posts\n')
+    while True:
+        start = time.time()
+        progress = bulk.Progress('posts')
+        moved = archive.archive_posts(args.chunk_size or app.config['ARCHIVE_CHUNK_SIZE'],
+                                      app.config['ARCHIVE_PAUSE'], progress)
+        progress.done()
+        print('Archived %d posts older than %s in %.1f s' % (moved, archive.cutoff().date(), time.time() - start))
+        if args.interval is None:
+            break
+        time.sleep(args.interval)
@@ -2,10 +2,12 @@
 from migrate.versioning import api
 from config import SQLALCHEMY_DATABASE_URI
 from config import SQLALCHEMY_MIGRATE_REPO
-from app import db
+from app import app, db, sharding
 import os.path
 
-db.create_all()
+with app.app_context():
+    db.create_all()
+    sharding.create_all()  # the post tables of the shards, when there are some
 
 if not os.path.exists(SQLALCHEMY_MIGRATE_REPO):
     api.create(SQLALCHEMY_MIGRATE_REPO, 'database repository')
@@ -0,0 +1,41 @@
+#!flask/bin/python
+"""
+Bulk import of users and posts from other systems (see app/bulk.py)
+
+    ./db_import.py users FILE    fields: email, nickname, about_me
+    ./db_import.py posts FILE    fields: author (the nickname), body, timestamp
+
+FILE holds JSON lines, or CSV with a header line when it ends in .csv (or with --format csv), and - reads stdin. Import
+the users before their posts.
+"""
+import argparse
+import io
+import sys
+import time
+
+from app import app, bulk
+
+parser = argparse.ArgumentParser(description='Bulk import users or posts.')
+parser.add_argument('kind', choices=['users', 'posts'])
+parser.add_argument('file')
+parser.add_argument('--format', choices=['jsonl', 'csv'])
+parser.add_argument('--chunk-size', type=int, default=10000)
+args = parser.parse_args()
+
+format = args.format or ('csv' if args.file.endswith('.csv') else 'jsonl')
+if args.file == '-':
+    stream = io.open(sys.stdin.fileno(), encoding='utf-8', newline='')
+else:
+    stream = io.open(args.file, encoding='utf-8', newline='')
+
+with app.app_context(), stream:
+    last_user_id, last_post_id = bulk.last_ids()
+    progress = bulk.Progress(args.kind)
+    load = bulk.import_users if args.kind == 'users' else bulk.import_posts
+    imported, skipped = load(bulk.read_records(stream, format), args.chunk_size, progress)
+    progress.done()
+    print('Imported %d %s in %.1f s (%.0f/s), skipped %d' % (imported, args.kind, progress.elapsed,
+                                                             imported / max(progress.elapsed, 1e-6), skipped))
+    start = time.time()
+    bulk.finish(last_user_id, last_post_id)
+    print('Search index, counters and timelines updated in %.1f s' % (time.time() - start))
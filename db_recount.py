@@ -0,0 +1,6 @@
+#!flask/bin/python
+from app import app
+from app.models import User
+
+with app.app_context():
+    print('Repaired the counters of ' + str(User.recount()) + ' users')
@@ -0,0 +1,5 @@
+#!flask/bin/python
+from app import app, search
+
+with app.app_context():
+    print('Indexed ' + str(search.reindex()) + ' posts for search')
@@ -0,0 +1,50 @@
+#!flask/bin/python
+"""
+Keeps SQLite read replicas up to date for local testing (see app/replicas.py)
+
+    ./db_replicate.py                  copy the database to every SQLite file in SQLALCHEMY_REPLICAS once
+    ./db_replicate.py --interval 2     and again every 2 seconds, like a replica lagging that far behind
+
+The copy is made with SQLite's online backup into the replica file itself, so the app can keep running and its open
+replica connections see the new data.
+"""
+import argparse
+import sqlite3
+import time
+
+from app.sharding import sqlite_path
+from config import SQLALCHEMY_DATABASE_URI, SQLALCHEMY_REPLICAS
+
+
+def copy_database(source, target):
+    """
+    copy the SQLite database at 'source' over the one at 'target'
+
+    :param source: path of the primary
+    :param target: path of the replica, created when it does not exist
+    """
+    primary = sqlite3.connect(source)
+    replica = sqlite3.connect(target)
+    try:
+        primary.backup(replica)
+    finally:
+        replica.close()
+        primary.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Copy the SQLite database to its SQLite read replicas.')
+    parser.add_argument('--interval', type=float, help='seconds between copies, copy once when not given')
+    args = parser.parse_args()
+    source = sqlite_path(SQLALCHEMY_DATABASE_URI)
+    targets = [path for path in map(sqlite_path, SQLALCHEMY_REPLICAS) if path]
+    if source is None or not targets:
+        parser.exit(1, 'needs an SQLite database and SQLite files in SQLALCHEMY_REPLICAS\n')
+    while True:
+        start = time.time()
+        for target in targets:
+            copy_database(source, target)
+        print('Copied %s to %d replicas in %.2f s' % (source, len(targets), time.time() - start))
+        if args.interval is None:
+            break
+        time.sleep(args.interval)
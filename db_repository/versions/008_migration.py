@@ -0,0 +1,32 @@
+from sqlalchemy import *
+from migrate import *
+
+
+from migrate.changeset import schema
+pre_meta = MetaData()
+post_meta = MetaData()
+
+
+def has_fts5(migrate_engine):
+    # the same probe as search.available()
+    return migrate_engine.name == 'sqlite' and any(
+        option == 'ENABLE_FTS5' for option, in migrate_engine.execute('PRAGMA compile_options'))
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    # full text index of the post bodies, see app/search.py. Only SQLite builds with FTS5 have it
+    if has_fts5(migrate_engine):
+        migrate_engine.execute("CREATE VIRTUAL TABLE IF NOT EXISTS post_search USING fts5(body, tokenize = 'porter unicode61')")
+        migrate_engine.execute("INSERT INTO post_search (rowid, body) SELECT id, coalesce(body, '') FROM post")
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    if has_fts5(migrate_engine):
+        migrate_engine.execute('DROP TABLE IF EXISTS post_search')
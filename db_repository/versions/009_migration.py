@@ -0,0 +1,32 @@
+from sqlalchemy import *
+from migrate import *
+
+
+from migrate.changeset import schema
+pre_meta = MetaData()
+post_meta = MetaData()
+user = Table('user', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('nickname', String(length=64)),
+    Column('email', String(length=120)),
+    Column('email_hash', String(length=32)),
+    Column('about_me', String(length=140)),
+    Column('last_seen', DateTime),
+    Column('version', Integer, default=ColumnDefault(0)),
+)
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['user'].columns['version'].create()
+    migrate_engine.execute(user.update().values(version=0))
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['user'].columns['version'].drop()
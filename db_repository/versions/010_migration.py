@@ -0,0 +1,47 @@
+from sqlalchemy import *
+from migrate import *
+
+
+from migrate.changeset import schema
+pre_meta = MetaData()
+post_meta = MetaData()
+followers = Table('followers', post_meta,
+    Column('follower_id', Integer),
+    Column('followed_id', Integer),
+)
+post = Table('post', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('body', String(length=140)),
+    Column('timestamp', DateTime),
+    Column('user_id', Integer),
+)
+indexes = [
+    Index('ix_followers_follower_id_followed_id', followers.c.follower_id, followers.c.followed_id, unique=True),
+    Index('ix_followers_followed_id', followers.c.followed_id),
+    Index('ix_post_user_id_timestamp', post.c.user_id, post.c.timestamp.desc(), post.c.id.desc()),
+]
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    # nothing stopped a pair from being followed twice before, keep one row of each so the unique index can be built
+    duplicates = migrate_engine.execute(
+        select([followers.c.follower_id, followers.c.followed_id]).group_by(
+            followers.c.follower_id, followers.c.followed_id).having(func.count() > 1)).fetchall()
+    for follower_id, followed_id in duplicates:
+        pair = and_(followers.c.follower_id == follower_id, followers.c.followed_id == followed_id)
+        migrate_engine.execute(followers.delete().where(pair))
+        migrate_engine.execute(followers.insert().values(follower_id=follower_id, followed_id=followed_id))
+    for index in indexes:
+        index.create()
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    for index in indexes:
+        index.drop()
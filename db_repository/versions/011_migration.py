@@ -0,0 +1,50 @@
+from sqlalchemy import *
+from migrate import *
+
+
+from migrate.changeset import schema
+pre_meta = MetaData()
+post_meta = MetaData()
+user = Table('user', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('nickname', String(length=64)),
+    Column('email', String(length=120)),
+    Column('email_hash', String(length=32)),
+    Column('about_me', String(length=140)),
+    Column('last_seen', DateTime),
+    Column('version', Integer, default=ColumnDefault(0)),
+    Column('followers_count', Integer, default=ColumnDefault(0)),
+    Column('followed_count', Integer, default=ColumnDefault(0)),
+    Column('posts_count', Integer, default=ColumnDefault(0)),
+)
+followers = Table('followers', post_meta,
+    Column('follower_id', Integer),
+    Column('followed_id', Integer),
+)
+post = Table('post', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('user_id', Integer),
+)
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['user'].columns['followers_count'].create()
+    post_meta.tables['user'].columns['followed_count'].create()
+    post_meta.tables['user'].columns['posts_count'].create()
+    migrate_engine.execute(user.update().values(
+        followers_count=select([func.count()]).where(followers.c.followed_id == user.c.id).as_scalar(),
+        followed_count=select([func.count()]).where(followers.c.follower_id == user.c.id).as_scalar(),
+        posts_count=select([func.count()]).where(post.c.user_id == user.c.id).as_scalar()))
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['user'].columns['followers_count'].drop()
+    post_meta.tables['user'].columns['followed_count'].drop()
+    post_meta.tables['user'].columns['posts_count'].drop()
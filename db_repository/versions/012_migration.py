@@ -0,0 +1,31 @@
+from sqlalchemy import *
+from migrate import *
+
+
+from migrate.changeset import schema
+pre_meta = MetaData()
+post_meta = MetaData()
+post_ids = Table('post_ids', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('last_id', Integer, nullable=False),
+)
+post = Table('post', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+)
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['post_ids'].create()
+    # carry on from the posts there are, so the ids stay unique when the posts get sharded
+    migrate_engine.execute(post_ids.insert().values(id=1, last_id=select([func.coalesce(func.max(post.c.id), 0)])))
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['post_ids'].drop()
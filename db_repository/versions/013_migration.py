@@ -0,0 +1,30 @@
+from sqlalchemy import *
+from migrate import *
+
+
+from migrate.changeset import schema
+pre_meta = MetaData()
+post_meta = MetaData()
+post_archive = Table('post_archive', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False, autoincrement=False),
+    Column('body', String(length=140)),
+    Column('timestamp', DateTime),
+    Column('user_id', Integer),
+)
+Index('ix_post_archive_user_id_timestamp', post_archive.c.user_id, post_archive.c.timestamp.desc(),
+      post_archive.c.id.desc())
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['post_archive'].create()
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['post_archive'].drop()
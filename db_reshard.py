@@ -0,0 +1,35 @@
+#!flask/bin/python
+"""
+Moves the posts to the shards listed in POST_SHARDS (see app/sharding.py)
+
+    ./db_reshard.py                              from the post table of the main database, to start sharding
+    ./db_reshard.py --from URI,URI,...           from the shards as they were before POST_SHARDS was changed
+
+With POST_SHARDS empty the posts go back to the main database. Only the posts whose shard changed are moved, and a run
+that was interrupted can be started again.
+"""
+import argparse
+import time
+
+from sqlalchemy import create_engine
+
+from app import app, bulk, sharding
+from app.engine import install_pragmas, sqlite_pragmas
+
+parser = argparse.ArgumentParser(description='Move the posts to the shards in POST_SHARDS.')
+parser.add_argument('--from', dest='sources', default='', help='comma separated URIs of the shards the posts are in')
+parser.add_argument('--chunk-size', type=int, default=10000)
+args = parser.parse_args()
+
+with app.app_context():
+    sources = []
+    for uri in filter(None, args.sources.split(',')):
+        engine = create_engine(uri)
+        install_pragmas(engine, sqlite_pragmas(app.config))
+        sources.append(engine)
+    sharding.create_all()
+    start = time.time()
+    progress = bulk.Progress('posts')
+    moved = sharding.reshard(sources, sharding.engines(), args.chunk_size, progress)
+    progress.done()
+    print('Moved %d posts to %d shards in %.1f s' % (moved, sharding.count(), time.time() - start))
@@ -0,0 +1,22 @@
+#!flask/bin/python
+"""
+Maintenance of the materialized home timelines (see app/timeline.py)
+
+    ./db_timeline.py rebuild    regenerate the timeline table from followers and posts
+    ./db_timeline.py check      compare every timeline against User.followed_posts()
+"""
+import sys
+from app import app, timeline
+
+if len(sys.argv) != 2 or sys.argv[1] not in ('rebuild', 'check'):
+    print('usage: db_timeline.py rebuild|check')
+    sys.exit(2)
+
+with app.app_context():
+    if sys.argv[1] == 'rebuild':
+        print('Timeline rebuilt with ' + str(timeline.rebuild()) + ' entries')
+    problems = timeline.check()
+    for user_id, (missing, extra) in sorted(problems.items()):
+        print('user %d: %d missing, %d extra' % (user_id, len(missing), len(extra)))
+    print(str(len(problems)) + ' inconsistent timelines')
+    sys.exit(1 if problems else 0)
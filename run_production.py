@@ -1,5 +1,82 @@
 #! flask/bin/python
+"""
+Production server. A gunicorn master forks SERVER_WORKERS worker processes running SERVER_THREADS threads each, all
+set in config.py and overridable on the command line:
 
-from app import app
+    ./run_production.py [--bind 0.0.0.0:8000] [--workers 9] [--threads 4] [--preload]
 
-app.run(debug=False)
+Every worker imports the app and builds it with create_app() after the fork, and the master never imports it, so
+kill -HUP <master pid> reloads the code gracefully: new workers are started on the new code and the old ones finish
+the requests they are serving first. --preload builds it once in the master instead, the workers start faster but
+HUP no longer reloads the code. Without gunicorn installed this falls back to werkzeug's forking server, which has no
+threads or reloading.
+
+Several workers need FOLLOW_GRAPH_STORE, or a follow in one worker stays unseen in the others' caches.
+"""
+import argparse
+import sys
+
+import config
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:
+    BaseApplication = object
+
+
+class Server(BaseApplication):
+    def __init__(self, options):
+        self.options = options
+        BaseApplication.__init__(self)
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        # imported here, in the worker, so that every new worker runs the code as it is now
+        from app import create_app
+        return create_app()
+
+
+def post_fork(server, worker):
+    # with --preload the master built the app, and its connections must not be shared with the master or between
+    # workers: each worker opens its own, to the main database, the replicas and the shards
+    application = server.app.callable
+    if application is not None:
+        from app import db
+        for bind in [None] + list(application.config.get('SQLALCHEMY_BINDS') or {}):
+            db.get_engine(application, bind).dispose()
+
+
+parser = argparse.ArgumentParser(description='Run the microblog with several worker processes.')
+parser.add_argument('--bind', default=config.SERVER_BIND)
+parser.add_argument('--workers', type=int, default=config.SERVER_WORKERS)
+parser.add_argument('--threads', type=int, default=config.SERVER_THREADS)
+parser.add_argument('--preload', action='store_true', help='build the app in the master, kill -HUP will not reload it')
+args = parser.parse_args()
+
+if args.workers > 1:
+    if not config.FOLLOW_GRAPH_STORE:
+        parser.error('%d workers need FOLLOW_GRAPH_STORE set in config.py, each would cache its own follow graph '
+                     'and miss the follows made in the others. Set it or run --workers 1' % args.workers)
+    if not config.RATE_LIMIT_STORE:
+        sys.stderr.write('warning: RATE_LIMIT_STORE is not set, every one of the %d workers has its own rate limits\n'
+                         % args.workers)
+
+if BaseApplication is object:
+    from werkzeug.serving import run_simple
+    from app import create_app
+    host, port = args.bind.rsplit(':', 1)
+    run_simple(host, int(port), create_app(), processes=args.workers)
+else:
+    Server({
+        'bind': args.bind,
+        'workers': args.workers,
+        'threads': args.threads,
+        'worker_class': 'gthread' if args.threads > 1 else 'sync',
+        'timeout': config.SERVER_TIMEOUT,
+        'graceful_timeout': config.SERVER_GRACEFUL_TIMEOUT,
+        'preload_app': args.preload,
+        'post_fork': post_fork,
+    }).run()
@@ -0,0 +1,113 @@
+#!flask/bin/python
+"""
+A local SMTP server that accepts every message and keeps it, as a stand-in for MAIL_SERVER in tests and development.
+
+    ./smtp_sink.py [port]    prints the messages it receives, run the app with MAIL_SERVER = 'localhost' and
+                             MAIL_PORT set to the same port (8025 by default)
+
+It speaks just enough SMTP for smtplib: no extensions, no authentication.
+"""
+import sys
+import threading
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+
+class SMTPSink(object):
+    def __init__(self, host='127.0.0.1', port=0, on_message=None):
+        """
+        :param port: 0 picks a free one, see 'address'
+        :param on_message: called with each (sender, recipients, data) as it arrives
+        """
+        self.messages = []  # (sender, recipients, data) tuples, data being the message as text
+        self.on_message = on_message
+        self.received = threading.Condition()
+        sink = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                sink._session(self.rfile, self.wfile)
+
+        self.server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.address = self.server.server_address
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='smtp-sink')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def wait(self, count, timeout=5):
+        """
+        :return: whether 'count' messages arrived within 'timeout' seconds
+        """
+        with self.received:
+            return self.received.wait_for(lambda: len(self.messages) >= count, timeout)
+
+    def _session(self, rfile, wfile):
+        def reply(line):
+            wfile.write((line + '\r\n').encode('ascii'))
+            wfile.flush()
+
+        reply('220 smtp sink ready')
+        sender, recipients = None, []
+        while True:
+            line = rfile.readline()
+            if not line:
+                return
+            command = line.decode('utf-8', 'replace').strip()
+            verb = command[:4].upper()
+            if verb in ('HELO', 'EHLO'):
+                reply('250 smtp sink')
+            elif verb == 'MAIL':
+                sender, recipients = command.split(':', 1)[1].strip().strip('<>'), []
+                reply('250 OK')
+            elif verb == 'RCPT':
+                recipients.append(command.split(':', 1)[1].strip().strip('<>'))
+                reply('250 OK')
+            elif verb == 'DATA':
+                reply('354 end data with <CR><LF>.<CR><LF>')
+                lines = []
+                for line in iter(rfile.readline, b''):
+                    if line in (b'.\r\n', b'.\n'):
+                        break
+                    lines.append(line[1:] if line.startswith(b'..') else line)
+                message = (sender, recipients, b''.join(lines).decode('utf-8', 'replace'))
+                with self.received:
+                    self.messages.append(message)
+                    self.received.notify_all()
+                if self.on_message is not None:
+                    self.on_message(*message)
+                reply('250 OK')
+            elif verb == 'RSET':
+                sender, recipients = None, []
+                reply('250 OK')
+            elif verb == 'NOOP':
+                reply('250 OK')
+            elif verb == 'QUIT':
+                reply('221 bye')
+                return
+            else:
+                reply('502 command not implemented')
+
+
+if __name__ == '__main__':
+    def show(sender, recipients, data):
+        print('From %s to %s\n%s\n%s' % (sender, ', '.join(recipients), data, '-' * 78))
+        sys.stdout.flush()
+
+    sink = SMTPSink(port=int(sys.argv[1]) if len(sys.argv) > 1 else 8025, on_message=show)
+    print('Listening on %s:%d' % sink.address)
+    try:
+        sink.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -1,10 +1,52 @@
+import base64
+import io
+import json
+import logging
 import os
+import queue
+import threading
+import time
 import unittest
 from datetime import datetime, timedelta
+from unittest import mock
 
-from app import app, db
-from app.models import User, Post
+from flask import session as flask_session
+from flask_login import login_user
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+
+import bench_import
+import db_replicate
+from app import archive, bulk, create_app, db, search, sharding, timeline
+from app.admission import MemoryBuckets, SharedStoreBuckets, admission
+from app.engine import sqlite_pragmas
+from app.instrumentation import QueryCounter, query_plan
+from app.last_seen import tracker as last_seen
+from app.mail_log import DigestMailHandler
+from app.pagination import paginate
+from app.profiling import profiler
+from app.follow_graph import FollowGraph, MemoryBackend, SharedStoreBackend
+from app.fragments import fragments
+from app.models import User, Post, avatar_urls, follow_graph, followers, identities, _load_followed_ids
+from app.shared_store import LocalStore
 from config import basedir
+from smtp_sink import SMTPSink
+
+app = create_app(TESTING=True, WTF_CSRF_ENABLED=False,
+                 SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(basedir, 'test.db'))
+
+
+def remove_database(path, engines=()):
+    """
+    dispose 'engines', which close their connections to it, and delete the SQLite file at 'path' with the -wal and
+    -shm files of its journal
+    """
+    for engine in engines:
+        engine.dispose()
+    for name in (path, path + '-wal', path + '-shm'):
+        if os.path.exists(name):
+            os.remove(name)
 
 
 class TestCase(unittest.TestCase):
@@ -12,15 +54,32 @@ class TestCase(unittest.TestCase):
         """
         Special methods to setup the test
         """
-        app.config['TESTING'] = True
-        app.config['WTF_CSRF_ENABLED'] = False
-        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'test.db')
+        app.config['TIMELINE_ENABLED'] = False
+        app.config['ARCHIVE_AFTER_DAYS'] = None
+        app.config['LAST_SEEN_FLUSH_THRESHOLD'] = 100
         self.app = app.test_client()
+        self.ctx = app.app_context()
+        self.ctx.push()
         db.create_all()
 
     def tearDown(self):
+        last_seen.pending.clear()
+        avatar_urls.clear()
+        follow_graph.clear()
+        fragments.clear()
+        identities.clear()
+        admission.clear()
         db.session.remove()
         db.drop_all()
+        self.ctx.pop()
+
+    def login(self, user):
+        """
+        log 'user' into the test client without going through OpenID
+        """
+        with self.app.session_transaction() as session:
+            session['user_id'] = session['_user_id'] = str(user.id)
+            session['_fresh'] = True
 
     def test_avatar(self):
         u = User(nickname='john', email='john@example.com')
@@ -28,6 +87,23 @@ class TestCase(unittest.TestCase):
         expected = 'http://www.gravatar.com/avatar/d4c74594d841139328695756648b6bd6'
         assert avatar[0:len(expected)] == expected
 
+    def test_avatar_cache(self):
+        u = User(nickname='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        assert u.email_hash == 'd4c74594d841139328695756648b6bd6'
+        hits = avatar_urls.hits
+        url = u.avatar(50)
+        assert u.avatar(50) == url
+        assert avatar_urls.hits == hits + 1
+        # a new email gets a new hash and the URLs of the old one are dropped
+        u.email = 'susan@example.com'
+        db.session.commit()
+        assert u.email_hash != 'd4c74594d841139328695756648b6bd6'
+        assert len(avatar_urls) == 0
+        assert u.avatar(50) != url
+        assert u.email_hash in u.avatar(50)
+
     def test_make_unique_nickname(self):
         u = User(nickname='john', email='john@example.com')
         db.session.add(u)
@@ -41,6 +117,27 @@ class TestCase(unittest.TestCase):
         assert nickname2 != 'john'
         assert nickname2 != nickname
 
+    def test_make_unique_nickname_probe(self):
+        db.session.add_all([User(nickname=name, email=name + '@example.com')
+                            for name in ['john', 'john2', 'john3', 'john5', 'johnny', 'john04', 'joho']])
+        db.session.commit()
+        with QueryCounter() as queries:
+            assert User.make_unique_nickname('john') == 'john4'
+        assert queries.count == 1
+        assert User.make_unique_nickname('susan') == 'susan'
+        assert User.make_unique_nickname('johnn') == 'johnn'
+
+    def test_create_retries_taken_nickname(self):
+        db.session.add(User(nickname='john', email='john@example.com'))
+        db.session.commit()
+        # another signup takes 'john' between picking the nickname and the insert
+        with mock.patch.object(User, 'make_unique_nickname', side_effect=['john', 'john2']):
+            u = User.create('john', 'other.john@example.com')
+        assert u.nickname == 'john2'
+        # and a lost race against the same person returns the user that won
+        with mock.patch.object(User, 'make_unique_nickname', side_effect=['john3']):
+            assert User.create('john', 'john@example.com').nickname == 'john'
+
     def test_follow(self):
         u1 = User(nickname='john', email='john@example.com')
         u2 = User(nickname='susan', email='susan@example.com')
@@ -65,6 +162,106 @@ class TestCase(unittest.TestCase):
         assert u1.followed.count() == 0
         assert u2.followers.count() == 0
 
+    def test_counters(self):
+        u1 = User(nickname='john', email='john@example.com')
+        u2 = User(nickname='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        u1.follow(u1)  # before the users are even inserted
+        db.session.commit()
+        u1.follow(u2)
+        u2.follow(u1)
+        db.session.add_all([Post(body='post %d' % i, author=u2, timestamp=datetime.utcnow()) for i in range(3)])
+        db.session.commit()
+        assert (u1.followers_count, u1.followed_count, u1.posts_count) == (2, 2, 0)
+        assert (u2.followers_count, u2.followed_count, u2.posts_count) == (1, 1, 3)
+        u1.unfollow(u2)
+        db.session.commit()
+        assert (u1.followed_count, u2.followers_count) == (1, 0)
+        assert User.recount() == 0
+        # the profile shows them without counting anything
+        self.login(u1)
+        with QueryCounter() as queries:
+            rv = self.app.get('/user/susan')
+        assert b'3 posts | 0 followers' in rv.data
+        assert not [statement for statement in queries.statements if 'count(' in statement.lower()]
+        # and recount() puts them right again when they drift
+        db.session.execute(User.__table__.update().values(posts_count=None, followers_count=7))
+        db.session.commit()
+        assert User.recount() == 2
+        assert (u1.followers_count, u2.posts_count) == (2, 3)
+
+    def test_follow_graph_cache(self):
+        u1 = User(nickname='john', email='john@example.com')
+        u2 = User(nickname='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u1.id, u2.id  # load the users back after the commit, only the follow checks should be counted
+        with QueryCounter() as queries:
+            assert not u1.is_following(u2)
+            assert not u1.is_following(u1)
+        assert queries.count == 1  # one load of the set u1 follows, then answered from memory
+        db.session.add(u1.follow(u2))
+        assert u1.is_following(u2)  # seen before the commit
+        db.session.rollback()
+        assert not u1.is_following(u2)  # and forgotten with the rollback
+        db.session.add(u1.follow(u2))
+        db.session.commit()
+        assert u1.is_following(u2)
+        with QueryCounter() as queries:
+            assert u1.is_following(u2)
+        assert queries.count == 0
+        # another worker follows while the set here is loaded and out of date: follow() goes by the database
+        u3 = User(nickname='mary', email='mary@example.com')
+        db.session.add(u3)
+        db.session.commit()
+        assert not u1.is_following(u3)
+        db.session.execute(followers.insert().values(follower_id=u1.id, followed_id=u3.id))
+        db.session.commit()
+        assert u1.follow(u3) is None and u1.unfollow(u3) is not None
+        db.session.commit()
+
+    def test_follow_graph_shared_store(self):
+        # two processes sharing one store, played by two FollowGraphs over the same LocalStore
+        graph = {1: set([1, 2])}
+        store = LocalStore()
+        first = FollowGraph(lambda user_id: graph[user_id], SharedStoreBackend(store))
+        second = FollowGraph(lambda user_id: graph[user_id], SharedStoreBackend(store))
+        assert first.is_following(1, 2) and not first.is_following(1, 3)
+        graph[1].discard(2)  # the database changes, and the first process records it
+        first.backend.remove(1, 2)
+        assert not second.is_following(1, 2)
+        first.backend.invalidate(1)
+        graph[1].add(3)
+        assert second.is_following(1, 3)
+        assert store.sismember('follow_graph:1', 3)
+        store.set('rate:global', 1)
+        first.clear()
+        assert list(store.scan_iter()) == ['rate:global']  # only its own keys
+
+    def test_follow_graph_versions(self):
+        # a follow commits and invalidates the set while it is being loaded from before the follow
+        graph = {1: set([2])}
+        for backend in (MemoryBackend(), SharedStoreBackend(LocalStore())):
+            def load_during_follow(user_id):
+                followed_ids = set(graph[user_id])
+                graph[user_id].add(3)
+                cache.end_of_transaction(session)
+                return followed_ids
+
+            session = mock.Mock(info={})
+            cache = FollowGraph(load_during_follow, backend)
+            cache.followed(session, 1, 3)
+            assert not cache.is_following(1, 3)  # what the load read
+            assert backend.contains(1, 3) is None  # but it was not kept
+            cache.loader = lambda user_id: graph[user_id]
+            assert cache.is_following(1, 3) and backend.contains(1, 3)
+            graph[1].discard(3)
+        # the memory backend is bounded
+        backend = MemoryBackend(maxsize=2)
+        for user_id in range(3):
+            backend.load(user_id, [1], backend.version(user_id))
+        assert backend.contains(0, 1) is None and backend.contains(2, 1)
+
     def test_follow_posts(self):
         # make four users
         u1 = User(nickname='john', email='john@example.com')
@@ -114,5 +311,695 @@ class TestCase(unittest.TestCase):
         assert f3 == [p4, p3]
         assert f4 == [p4]
 
+    def test_timeline(self):
+        app.config['TIMELINE_ENABLED'] = True
+        u1 = User(nickname='john', email='john@example.com')
+        u2 = User(nickname='susan', email='susan@example.com')
+        u3 = User(nickname='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        utcnow = datetime.utcnow()
+        p1 = Post(body="post from john", author=u1, timestamp=utcnow + timedelta(seconds=1))
+        p2 = Post(body="post from susan", author=u2, timestamp=utcnow + timedelta(seconds=2))
+        db.session.add_all([p1, p2])
+        u1.follow(u1)
+        u2.follow(u2)
+        u3.follow(u3)
+        u1.follow(u2)
+        db.session.commit()
+        # nothing was fanned out yet, the rebuild catches up with the existing posts
+        assert timeline.check() == {u1.id: ([p1.id, p2.id], []), u2.id: ([p2.id], [])}
+        timeline.rebuild()
+        assert timeline.check() == {}
+        assert timeline.home_posts(u1).all() == [p2, p1]
+        # new posts are pushed to every follower of the author
+        p3 = Post(body="post from mary", author=u3, timestamp=utcnow + timedelta(seconds=3))
+        db.session.add(p3)
+        timeline.push(p3)
+        db.session.commit()
+        assert timeline.home_posts(u3).all() == [p3]
+        assert timeline.home_posts(u1).all() == [p2, p1]
+        # following backfills the older posts, unfollowing prunes them again
+        u1.follow(u3)
+        timeline.backfill(u1, u3)
+        db.session.commit()
+        assert timeline.home_posts(u1).all() == [p3, p2, p1]
+        u1.unfollow(u2)
+        timeline.prune(u1, u2)
+        db.session.commit()
+        assert timeline.home_posts(u1).all() == [p3, p1]
+        assert timeline.check() == {}
+
+    def test_keyset_pagination(self):
+        u = User(nickname='john', email='john@example.com')
+        db.session.add(u)
+        utcnow = datetime.utcnow()
+        # two posts share a timestamp so the id has to break the tie
+        posts = [Post(body='post %d' % i, author=u, timestamp=utcnow + timedelta(seconds=i // 2)) for i in range(7)]
+        db.session.add_all(posts)
+        db.session.commit()
+        expected = u.sorted_posts().all()
+        page = paginate(u.sorted_posts(), None, 3)
+        assert page.items == expected[0:3] and not page.has_prev and page.has_next
+        page = paginate(u.sorted_posts(), page.next_num, 3)
+        assert page.items == expected[3:6] and page.has_prev and page.has_next
+        last = paginate(u.sorted_posts(), page.next_num, 3)
+        assert last.items == expected[6:] and last.has_prev and not last.has_next
+        page = paginate(u.sorted_posts(), last.prev_num, 3)
+        assert page.items == expected[3:6] and page.has_prev and page.has_next
+        page = paginate(u.sorted_posts(), page.prev_num, 3)
+        assert page.items == expected[0:3] and not page.has_prev and page.has_next
+        # a cursor that does not decode starts over from the top
+        assert paginate(u.sorted_posts(), 'garbage', 3).items == expected[0:3]
+        # and so does one whose timestamp is out of range
+        out_of_range = base64.urlsafe_b64encode(b'o:99999999999999999999:1').decode('ascii')
+        assert paginate(u.sorted_posts(), out_of_range, 3).items == expected[0:3]
+        # and through the view, following the links of the rendered page
+        self.login(u)
+        rv = self.app.get('/user/john')
+        assert b'post 6' in rv.data and b'post 3' not in rv.data
+        rv = self.app.get('/user/john?cursor=' + paginate(u.sorted_posts(), None, 3).next_num)
+        assert b'post 3' in rv.data and b'post 6' not in rv.data
+        assert self.app.get('/user/john?cursor=' + out_of_range).status_code == 200
+        assert self.app.get('/index?cursor=' + out_of_range).status_code == 200
+        assert self.app.get('/api/timeline?cursor=' + out_of_range).status_code == 400
+
+    def test_last_seen_batching(self):
+        app.config['LAST_SEEN_FLUSH_THRESHOLD'] = 2
+        u1 = User(nickname='john', email='john@example.com')
+        u2 = User(nickname='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        last_seen.pending.clear()
+        first = datetime(2017, 3, 1, 12, 0, 0)
+        # repeated hits of the same user are coalesced and nothing is written yet
+        last_seen.touch(u1.id, first)
+        last_seen.touch(u1.id, first + timedelta(minutes=1))
+        assert last_seen.pending == {u1.id: first + timedelta(minutes=1)}
+        assert db.session.query(User.last_seen).filter_by(id=u1.id).scalar() is None
+        # the second user reaches the threshold and both go out together
+        last_seen.touch(u2.id, first)
+        assert last_seen.pending == {}
+        db.session.expire_all()
+        assert u1.last_seen == first + timedelta(minutes=1)
+        assert u2.last_seen == first
+        # requests only record in memory
+        app.config['LAST_SEEN_FLUSH_THRESHOLD'] = 100
+        self.login(u1)
+        self.app.get('/index')
+        assert list(last_seen.pending) == [u1.id]
+        assert last_seen.flush() == 1
+
+    def test_page_query_count(self):
+        users = [User(nickname='user%d' % i, email='user%d@example.com' % i) for i in range(10)]
+        db.session.add_all(users)
+        utcnow = datetime.utcnow()
+        db.session.add_all([Post(body='post %d' % i, author=users[i % 10], timestamp=utcnow + timedelta(seconds=i))
+                            for i in range(20)])
+        db.session.commit()
+        for u in users:
+            users[0].follow(u)
+        db.session.commit()
+        self.login(users[0])
+
+        def render(page_size):
+            with mock.patch('app.views.POSTS_PER_PAGE', page_size):
+                db.session.expire_all()  # so authors can't come from the identity map of an earlier render
+                with QueryCounter() as queries:
+                    rv = self.app.get('/index')
+            assert rv.data.count(b' says:') == page_size
+            return queries.count
+
+        assert render(2) == render(10) == render(20)
+
+    def test_search(self):
+        u = User(nickname='john', email='john@example.com')
+        db.session.add(u)
+        utcnow = datetime.utcnow()
+        p1 = Post(body='the avengers movie was so cool', author=u, timestamp=utcnow)
+        p2 = Post(body='beautiful day in portland', author=u, timestamp=utcnow)
+        p3 = Post(body='portland, portland and more portland', author=u, timestamp=utcnow)
+        db.session.add_all([p1, p2, p3])
+        db.session.commit()
+        # indexed as they are inserted, ranked, limited and safe from FTS5 syntax
+        assert search.search_posts('portland', 10) == [p3, p2]
+        assert search.search_posts('portland', 1) == [p3]
+        assert search.search_posts('Movies', 10) == [p1]
+        assert search.search_posts('"cool" (*', 10) == [p1]
+        assert search.search_posts('?!', 10) == []
+        p2.body = 'rainy day in seattle'
+        db.session.delete(p3)
+        db.session.commit()
+        assert search.search_posts('portland', 10) == []
+        assert search.search_posts('seattle', 10) == [p2]
+        assert search.reindex() == 2
+        assert search.search_posts('day', 10) == [p2]
+        self.login(u)
+        assert b'rainy day in seattle' in self.app.get('/search_results/seattle').data
+
+    def test_fragment_cache(self):
+        u1 = User(nickname='john', email='john@example.com')
+        u2 = User(nickname='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        utcnow = datetime.utcnow()
+        db.session.add_all([Post(body='post %d' % i, author=u2, timestamp=utcnow + timedelta(seconds=i))
+                            for i in range(3)])
+        db.session.commit()
+        u1.follow(u1)
+        u1.follow(u2)
+        db.session.commit()
+        self.login(u1)
+        misses = fragments.cache.misses
+        assert b'susan says:' in self.app.get('/index').data
+        assert fragments.cache.misses == misses + 3
+        hits = fragments.cache.hits
+        assert b'susan says:' in self.app.get('/user/susan').data
+        assert fragments.cache.hits == hits + 3
+        # susan renames herself, her posts render again under the new name
+        self.login(u2)
+        self.app.post('/edit', data={'nickname': 'suzy', 'about_me': ''})
+        assert len(fragments.cache) == 0
+        self.login(u1)
+        rv = self.app.get('/index')
+        assert b'suzy says:' in rv.data and b'susan says:' not in rv.data
+        # and with a new email, however it was changed, under the new avatar
+        suzy = User.query.get(u2.id)
+        suzy.email = 'suzy@example.com'
+        db.session.commit()
+        assert suzy.email_hash.encode('ascii') in self.app.get('/index').data
+        # the counters are there for admins only
+        assert self.app.get('/admin/cache').status_code == 404
+        u1.email = app.config['ADMINS'][0]
+        db.session.commit()
+        assert b'"misses"' in self.app.get('/admin/cache').data
+
+    def test_conditional_get(self):
+        u1 = User(nickname='john', email='john@example.com')
+        u2 = User(nickname='susan', email='susan@example.com')
+        db.session.add_all([u1, u2, Post(body='first post', author=u2, timestamp=datetime.utcnow())])
+        u1.follow(u1)
+        u1.follow(u2)
+        db.session.commit()
+        self.login(u1)
+        rv = self.app.get('/index')
+        etag = rv.headers['ETag']
+        assert rv.status_code == 200 and 'no-cache' in rv.headers['Cache-Control']
+        assert rv.headers['Last-Modified']
+        # nothing changed: 304, and no template gets rendered
+        with mock.patch('app.views.render_template') as render:
+            rv = self.app.get('/index', headers={'If-None-Match': etag})
+        assert rv.status_code == 304 and rv.data == b'' and not render.called
+        # a new post, or the author renaming herself, changes the page
+        db.session.add(Post(body='second post', author=u2, timestamp=datetime.utcnow()))
+        db.session.commit()
+        rv = self.app.get('/index', headers={'If-None-Match': etag})
+        assert rv.status_code == 200 and b'second post' in rv.data
+        etag = rv.headers['ETag']
+        u2.version += 1
+        db.session.commit()
+        assert self.app.get('/index', headers={'If-None-Match': etag}).status_code == 200
+        # profiles too, and following changes what the profile shows
+        etag = self.app.get('/user/susan').headers['ETag']
+        assert self.app.get('/user/susan', headers={'If-None-Match': etag}).status_code == 304
+        u1.unfollow(u2)
+        db.session.commit()
+        assert self.app.get('/user/susan', headers={'If-None-Match': etag}).status_code == 200
+
+    def test_api(self):
+        u1 = User(nickname='john', email='john@example.com', about_me='hi')
+        u2 = User(nickname='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        utcnow = datetime.utcnow()
+        db.session.add_all([Post(body='post %d from susan' % i, author=u2, timestamp=utcnow + timedelta(seconds=i))
+                            for i in range(5)] + [Post(body='rainy day', author=u1, timestamp=utcnow - timedelta(seconds=1))])
+        db.session.commit()
+        u1.follow(u1)
+        u1.follow(u2)
+        db.session.commit()
+        # a client that is not logged in is told so, not sent to the login page
+        rv = self.app.get('/api/timeline')
+        assert rv.status_code == 401 and json.loads(rv.data.decode('utf-8')) == {'error': 'login required'}
+        self.login(u1)
+        rv = self.app.get('/api/timeline?limit=4')
+        assert rv.is_streamed and rv.mimetype == 'application/json'
+        page = json.loads(rv.data.decode('utf-8'))
+        assert [post['body'] for post in page['posts']] == ['post %d from susan' % i for i in (4, 3, 2, 1)]
+        assert set(page['posts'][0]) == {'id', 'body', 'timestamp', 'author_id', 'author', 'about_me'}
+        page = json.loads(self.app.get('/api/timeline?limit=4&fields=body,author&cursor=' +
+                                       page['next']).data.decode('utf-8'))
+        assert page == {'posts': [{'body': 'post 0 from susan', 'author': 'susan'},
+                                  {'body': 'rainy day', 'author': 'john'}], 'next': None}
+        # only the columns asked for are read, without the user table
+        with QueryCounter() as queries:
+            page = json.loads(self.app.get('/api/user/susan/posts?fields=id').data.decode('utf-8'))
+        assert len(page['posts']) == 5 and list(page['posts'][0]) == ['id']
+        assert 'post.body' not in queries.statements[-1] and 'JOIN user' not in queries.statements[-1]
+        page = json.loads(self.app.get('/api/search?q=rainy&fields=body,about_me').data.decode('utf-8'))
+        assert page['posts'] == [{'body': 'rainy day', 'about_me': 'hi'}]
+        assert self.app.get('/api/timeline?fields=password').status_code == 400
+        assert self.app.get('/api/timeline?cursor=nonsense').status_code == 400
+        assert self.app.get('/api/user/nobody/posts').status_code == 404
+
+    def test_bulk_import(self):
+        db.session.add(User(nickname='john', email='john@example.com'))
+        db.session.commit()
+        last_user_id, last_post_id = bulk.last_ids()
+        users = io.StringIO(u'{"email": "john@example.com", "nickname": "john"}\n'
+                            u'{"email": "other.john@example.com", "nickname": "john"}\n'
+                            u'{"email": "susan@example.com", "nickname": "susan", "about_me": "hi"}\n')
+        assert bulk.import_users(bulk.read_records(users, 'jsonl'), chunk_size=1) == (2, 1)
+        posts = io.StringIO(u'author,body,timestamp\n'
+                            u'susan,rainy day in seattle,2017-03-04T12:30:00Z\n'
+                            u'john2,hello,2017-03-04 12:31:00.500000\n'
+                            u'nobody,lost post,\n'
+                            u'susan,no timestamp,\n')
+        assert bulk.import_posts(bulk.read_records(posts, 'csv'), chunk_size=2) == (3, 1)
+        bulk.finish(last_user_id, last_post_id)
+        susan = User.query.filter_by(nickname='susan').one()
+        john2 = User.query.filter_by(email='other.john@example.com').one()
+        assert john2.nickname == 'john2' and john2.avatar(50) == User(email=john2.email).avatar(50)
+        assert susan.is_following(susan) and susan.followers_count == 1 and susan.posts_count == 2
+        assert [post.body for post in john2.sorted_posts()] == ['hello']
+        assert john2.posts[0].timestamp == datetime(2017, 3, 4, 12, 31, 0, 500000)
+        assert search.search_posts('seattle', 10) == [susan.sorted_posts()[-1]]
+
+    def test_profiling(self):
+        u = User(nickname='john', email=app.config['ADMINS'][0])
+        db.session.add_all([u, Post(body='first post', author=u, timestamp=datetime.utcnow())])
+        u.follow(u)
+        db.session.commit()
+        self.login(u)
+        profiler.clear()
+        self.app.get('/index')
+        self.app.get('/user/john')
+        metrics = self.app.get('/admin/metrics').data.decode('utf-8')
+        assert 'microblog_request_seconds_count{endpoint="main.index"} 1' in metrics
+        assert 'microblog_template_seconds_bucket{endpoint="main.user",le="+Inf"} 1' in metrics
+        assert 'microblog_cache_misses_total{cache="fragments"}' in metrics
+        statements = profiler.histograms[('sql_statements', 'main.index')]
+        assert statements.count == 1 and 0 < statements.sum < 10
+        assert profiler.histograms[('sql_seconds', 'main.index')].sum > 0
+        # the slowest profiled requests are dumped, up to PROFILE_KEEP of them
+        directory = os.path.join(basedir, 'tmp', 'test_profiles')
+        with mock.patch.dict(app.config, PROFILE_SAMPLE_RATE=1, PROFILE_KEEP=2, PROFILE_DIR=directory):
+            for i in range(4):
+                self.app.get('/index')
+        assert len(os.listdir(directory)) == 2
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+        profiler.slowest = []
+
+    def test_error_mail_digest(self):
+        sink = SMTPSink().start()
+        handler = DigestMailHandler(sink.address, 'no-reply@localhost', ['admin@example.com'], 'app failure',
+                                    delay=0.2, interval=0.5, max_records=2)
+        logger = logging.getLogger('test_error_mail_digest')
+        logger.addHandler(handler)
+        try:
+            for i in range(3):
+                try:
+                    raise ValueError('bad value %d' % i)
+                except ValueError:
+                    logger.exception('request failed')
+            assert sink.wait(1)
+            first_sent = time.time()
+            sender, recipients, data = sink.messages[0]
+            assert recipients == ['admin@example.com']
+            assert 'Subject: app failure (3 errors)' in data
+            assert 'bad value 1' in data and 'bad value 2' not in data and '... and 1 more' in data
+            # the next digest waits out the interval, and a full queue drops records instead of blocking
+            logger.error('one more')
+            with mock.patch.object(handler.queue, 'put_nowait', side_effect=queue.Full):
+                logger.error('dropped')
+            assert sink.wait(2)
+            assert 'one more' in sink.messages[1][2] and '1 more were dropped' in sink.messages[1][2]
+            assert handler.failed == 0 and time.time() - first_sent > 0.4
+        finally:
+            logger.removeHandler(handler)
+            handler.close()
+            sink.stop()
+
+    def test_query_plans(self):
+        u1 = User(nickname='john', email='john@example.com')
+        u2 = User(nickname='susan', email='susan@example.com')
+        db.session.add_all([u1, u2, Post(body='post from susan', author=u2, timestamp=datetime.utcnow())])
+        u1.follow(u2)
+        db.session.commit()
+        u3 = User(nickname='new', email='new@example.com')
+        db.session.add(u3)
+        with QueryCounter() as queries:
+            u1.sorted_posts().all()
+            u1.followed_posts().all()
+            u3.is_following(u2)  # no id yet, so this one goes to the database
+            _load_followed_ids(u1.id)
+            User.make_unique_nickname('john')
+            User.query.filter_by(email='john@example.com').first()
+        connection = db.session.connection()
+        for statement, parameters in zip(queries.statements, queries.parameters):
+            if not statement.startswith('SELECT'):
+                continue
+            for step in query_plan(connection, statement, parameters):
+                # 'SCAN post', or 'SCAN TABLE post' on older SQLite: the whole table is read
+                words = step.replace('SCAN TABLE ', 'SCAN ').split()
+                assert not (words[0] == 'SCAN' and words[1] in db.metadata.tables), (statement, step)
+
+    def test_sqlite_pragmas(self):
+        connection = db.session.connection()
+        assert connection.execute('PRAGMA journal_mode').scalar() == 'wal'
+        assert connection.execute('PRAGMA synchronous').scalar() == 1  # NORMAL
+        assert connection.execute('PRAGMA busy_timeout').scalar() == app.config['SQLITE_BUSY_TIMEOUT'] * 1000
+        config = dict(app.config, SQLITE_PROFILE='durable', SQLITE_PRAGMAS={'cache_size': -1000})
+        pragmas = sqlite_pragmas(config)
+        assert list(pragmas)[0] == 'journal_mode'
+        assert pragmas['synchronous'] == 'FULL' and pragmas['cache_size'] == -1000
+
+    def test_import_time(self):
+        # importing the package and the models leaves the views and the other extensions to create_app(): they import
+        # none of LAZY and fewer modules than the whole app in the same run. The budgets are bench_import.py's, here
+        # with room to spare for a loaded machine
+        budgets = dict(bench_import.BUDGETS)
+
+        def imported_by(statement):
+            total, modules = bench_import.measure(statement, repeat=2)
+            limit = budgets[statement] * 3
+            assert total < limit, '%s took %.0f ms, three times the budget is %d ms' % (statement, total, limit)
+            return set(name for name, _, _, _ in modules)
+
+        whole_app = imported_by('from app import app')
+        for statement in ('import app', 'import app.models'):
+            imported = imported_by(statement)
+            assert not imported.intersection(bench_import.LAZY), statement
+            assert len(imported) < len(whole_app), statement
+
+    def test_identity_cache(self):
+        def identity_queries():
+            db.session.remove()  # a new request starts with an empty session
+            with QueryCounter() as queries:
+                rv = self.app.get('/index')
+            assert rv.status_code == 200
+            return rv, [statement for statement in queries.statements
+                        if statement.startswith('SELECT user.') and statement.endswith('WHERE user.id = ?')]
+
+        u1 = User(nickname='john', email='john@example.com')
+        u2 = User(nickname='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        id1, id2 = u1.id, u2.id
+        self.login(u1)
+        assert len(identity_queries()[1]) == 1
+        rv, queries = identity_queries()
+        assert not queries and b'/user/john' in rv.data
+        # changing the user drops the snapshot once the change is committed
+        db.session.remove()
+        assert self.app.post('/edit', data={'nickname': 'johnny', 'about_me': 'hi'}).status_code == 302
+        assert identities.cache.get(id1) is None
+        rv, queries = identity_queries()
+        assert len(queries) == 1 and b'/user/johnny' in rv.data
+        # and so does following someone, for both users
+        identities.load(id2)
+        db.session.remove()
+        self.app.get('/follow/susan')
+        assert identities.cache.get(id1) is None and identities.cache.get(id2) is None
+        # a merged snapshot can still be written back
+        db.session.remove()
+        user = identities.load(id1)
+        user.about_me = 'changed'
+        db.session.commit()
+        db.session.remove()
+        assert User.query.get(id1).about_me == 'changed' and User.query.get(id1).followed_count == 1
+
+    def test_read_replicas(self):
+        u = User(nickname='john', email='john@example.com')
+        db.session.add(u)
+        db.session.add(u.follow(u))
+        db.session.add(Post(body='on both', author=u, timestamp=datetime.utcnow() - timedelta(seconds=1)))
+        db.session.commit()
+        replica_path = os.path.join(basedir, 'tmp', 'test_replica.db')
+        db_replicate.copy_database(os.path.join(basedir, 'test.db'), replica_path)
+        db.session.add(Post(body='only on the primary', author=u, timestamp=datetime.utcnow()))
+        db.session.commit()
+        self.login(u)
+        replicas = {'replica0': 'sqlite:///' + replica_path}
+        with mock.patch.dict(app.config, SQLALCHEMY_BINDS=replicas), \
+                mock.patch.dict(app.extensions, replicas=list(replicas)):
+            try:
+                rv = self.app.get('/index')
+                assert b'on both' in rv.data and b'only on the primary' not in rv.data
+                # a write makes the client read from the primary for a while, its own post included
+                assert self.app.post('/index', data={'post': 'just written'}).status_code == 302
+                rv = self.app.get('/index')
+                assert b'just written' in rv.data and b'only on the primary' in rv.data
+                with self.app.session_transaction() as session:
+                    session['primary_until'] = 0
+                assert b'only on the primary' not in self.app.get('/index').data
+                # in a routed session, reads go to the replica until the session writes
+                db.session.info['replica'] = db.get_engine(app, 'replica0')
+                assert Post.query.count() == 1
+                db.session.execute(Post.__table__.update().values(body='changed'))
+                assert Post.query.count() == 3
+                db.session.rollback()
+                # a user loaded from the replica is not cached, the replica can be behind
+                id = u.id
+                identities.clear()
+                db.session.remove()
+                db.session.info['replica'] = db.get_engine(app, 'replica0')
+                assert identities.load(id).nickname == 'john' and identities.cache.get(id) is None
+            finally:
+                db.session.info.pop('replica', None)
+                db.session.remove()
+                remove_database(replica_path, [db.get_engine(app, 'replica0')])
+
+    def test_sharding(self):
+        paths = [os.path.join(basedir, 'tmp', 'test_posts%d.db' % i) for i in range(2)]
+        sharding.configure(app, ['sqlite:///' + path for path in paths])
+        engines = sharding.engines()
+        db.session.remove()  # a session that routes the posts
+        try:
+            sharding.create_all()
+            users = [User(nickname='user%d' % i, email='user%d@example.com' % i) for i in range(3)]
+            db.session.add_all(users)
+            db.session.commit()
+            reader = users[0]
+            for user in users:
+                db.session.add(reader.follow(user))
+            now = datetime.utcnow()
+            for i in range(9):
+                db.session.add(Post(body='post %d' % i, author=users[i % 3], timestamp=now + timedelta(seconds=i)))
+            db.session.commit()
+            # each post is on the shard of its author, numbered from the shared sequence
+            for shard, engine in enumerate(sharding.engines()):
+                rows = engine.execute('SELECT id, user_id FROM post').fetchall()
+                assert rows and all(user_id % 2 == shard for id, user_id in rows)
+            assert db.session.execute('SELECT count(*) FROM post').scalar() == 0
+            expected = ['post %d' % i for i in reversed(range(9))]
+            assert [post.body for post in reader.followed_posts()] == expected
+            assert [post.body for post in reader.followed_posts().limit(4)] == expected[:4]
+            page = paginate(reader.followed_posts(), None, 4)
+            page = paginate(reader.followed_posts(), page.next_num, 4)
+            assert [post.body for post in page.items] == expected[4:8]
+            back = paginate(reader.followed_posts(), page.prev_num, 4)
+            assert [post.body for post in back.items] == expected[:4]
+            with QueryCounter() as queries:
+                assert [post.body for post in users[1].sorted_posts()] == ['post 7', 'post 4', 'post 1']
+            assert queries.count == 1
+            assert [post.author.nickname for post in users[2].sorted_posts()] == ['user2'] * 3
+            assert User.query.get(users[1].id).posts_count == 3 and User.recount() == 0
+            assert [post.body for post in search.search_posts('post', 20)] and \
+                set(post.body for post in search.search_posts('post', 20)) == set(expected)
+            self.login(reader)
+            rv = self.app.get('/index')
+            assert b'post 8' in rv.data and b'post 6' in rv.data
+            rv = json.loads(self.app.get('/api/timeline?limit=3&fields=id,author').data.decode('utf-8'))
+            assert [post['author'] for post in rv['posts']] == ['user2', 'user1', 'user0']
+            # and back to the main database
+            assert sharding.reshard(sharding.engines(), []) == 9
+            sharding.configure(app, [])
+            db.session.remove()
+            assert [post.body for post in User.query.get(reader.id).followed_posts()] == expected
+            db.session.add(Post(body='after', author=User.query.get(reader.id), timestamp=now + timedelta(seconds=10)))
+            db.session.commit()
+            assert Post.query.filter_by(body='after').one().id == 10
+        finally:
+            sharding.configure(app, [])
+            db.session.remove()
+            for path, engine in zip(paths, engines):
+                remove_database(path, [engine])
+
+    def test_archive(self):
+        app.config['TIMELINE_ENABLED'] = True
+        u1 = User(nickname='john', email='john@example.com')
+        u2 = User(nickname='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        db.session.add(u1.follow(u2))
+        utcnow = datetime.utcnow()
+        # one post a day, post 0 is 9 days old and the last 3 are newer than the cutoff
+        for i in range(10):
+            post = Post(body='post %d' % i, author=u2, timestamp=utcnow - timedelta(days=9 - i, hours=1))
+            db.session.add(post)
+            timeline.push(post)
+        db.session.commit()
+        expected = [post.body for post in u2.sorted_posts()]
+        assert archive.archive_posts() == 0  # off
+        app.config['ARCHIVE_AFTER_DAYS'] = 3
+        assert archive.archive_posts(chunk_size=3) == 7
+        assert [post.body for post in u2.sorted_posts()] == expected[:3]
+        assert [post.body for post in u2.sorted_posts(archived=True)] == expected[3:]
+        assert db.session.execute('SELECT count(*) FROM timeline').scalar() == 3
+        # the pages read the post table and go on into the archive, and back
+        pages, cursor = [], None
+        while True:
+            page = paginate(u2.sorted_posts(), cursor, 4, archive=u2.sorted_posts(archived=True))
+            pages.append(page)
+            cursor = page.next_num
+            if cursor is None:
+                break
+        assert [[post.body for post in page.items] for page in pages] == [expected[:4], expected[4:8], expected[8:]]
+        back = paginate(u2.sorted_posts(), pages[2].prev_num, 4, archive=u2.sorted_posts(archived=True))
+        assert [post.body for post in back.items] == expected[4:8]
+        back = paginate(u2.sorted_posts(), back.prev_num, 4, archive=u2.sorted_posts(archived=True))
+        assert [post.body for post in back.items] == expected[:4] and not back.has_prev
+        # the first page does not read the archive at all
+        with QueryCounter() as queries:
+            paginate(u2.sorted_posts(load_authors=False), None, 2, archive=u2.sorted_posts(archived=True))
+        assert queries.count == 1
+        self.login(u1)
+        cursor = paginate(u1.followed_posts(), None, 3, archive=u1.followed_posts(archived=True)).next_num
+        rv = self.app.get('/index?cursor=' + cursor)
+        assert b'post 6' in rv.data and b'post 4' in rv.data
+        rv = json.loads(self.app.get('/api/user/susan/posts?limit=5&fields=body').data.decode('utf-8'))
+        assert [post['body'] for post in rv['posts']] == expected[:5]
+        rv = json.loads(self.app.get('/api/timeline?limit=5&fields=body&cursor=' + rv['next']).data.decode('utf-8'))
+        assert [post['body'] for post in rv['posts']] == expected[5:] and rv['next'] is None
+        # still found, counted and numbered after
+        assert set(post.body for post in search.search_posts('post', 20)) == set(expected)
+        assert User.query.get(u2.id).posts_count == 10 and User.recount() == 0
+        db.session.add(Post(body='new', author=u2, timestamp=utcnow))
+        db.session.commit()
+        assert Post.query.filter_by(body='new').one().id == 11
+        # an old post can stay in the post table, here the newest one which is never archived (a bulk load gives old
+        # posts high ids), and the pages still list it among the archived ones in order
+        db.session.add(Post(body='old', author=u2, timestamp=utcnow - timedelta(days=5)))
+        db.session.commit()
+        assert archive.archive_posts() == 0
+        expected = ['new'] + expected[:5] + ['old'] + expected[5:]
+        pages, cursor = [], None
+        while True:
+            page = paginate(u2.sorted_posts(), cursor, 4, archive=u2.sorted_posts(archived=True))
+            pages.append(page)
+            cursor = page.next_num
+            if cursor is None:
+                break
+        assert [post.body for page in pages for post in page.items] == expected
+        back = paginate(u2.sorted_posts(), pages[2].prev_num, 4, archive=u2.sorted_posts(archived=True))
+        assert [post.body for post in back.items] == expected[4:8]
+        rv = json.loads(self.app.get('/api/user/susan/posts?limit=5&fields=body').data.decode('utf-8'))
+        assert [post['body'] for post in rv['posts']] == expected[:5]
+        rv = json.loads(self.app.get('/api/user/susan/posts?limit=5&fields=body&cursor=' + rv['next']).data.decode(
+            'utf-8'))
+        assert [post['body'] for post in rv['posts']] == expected[5:10]
+
+    def test_admission(self):
+        now = time.time()
+        for buckets in (MemoryBuckets(), SharedStoreBuckets(LocalStore())):
+            assert [buckets.take('a', 2.0, 3, now) for i in range(3)] == [0, 0, 0]
+            assert abs(buckets.take('a', 2.0, 3, now) - 0.5) < 1e-6
+            assert buckets.take('b', 2.0, 3, now) == 0  # each key its own bucket
+            assert buckets.take('a', 2.0, 3, now + 0.5) == 0 and buckets.take('a', 2.0, 3, now + 0.5)
+        store = LocalStore()
+        store.sadd('follow_graph:1', 2)
+        buckets = SharedStoreBuckets(store)
+        buckets.take('a', 2.0, 3)
+        buckets.clear()
+        assert list(store.scan_iter()) == ['follow_graph:1']  # only its own keys
+        u = User(nickname='john', email='john@example.com')
+        susan = User(nickname='susan', email='susan@example.com')
+        db.session.add_all([u, susan])
+        db.session.commit()
+        # logged in the way Flask-Login does it, each user has a bucket of their own, whatever their address
+        for user in (u, susan):
+            with app.test_request_context():
+                login_user(user)
+                logged_in = dict(flask_session)
+            client = app.test_client()
+            with client.session_transaction() as client_session:
+                client_session.update(logged_in)
+            with mock.patch.dict(app.config, RATE_LIMIT_USER_RATE=0.01, RATE_LIMIT_USER_BURST=1):
+                assert [client.post('/index', data={'post': 'hi'}).status_code for i in range(2)] == [302, 429]
+        admission.clear()
+        posts = Post.query.count()
+        self.login(u)
+        with mock.patch.dict(app.config, RATE_LIMIT_USER_RATE=0.01, RATE_LIMIT_USER_BURST=2):
+            assert [self.app.post('/index', data={'post': 'hi'}).status_code for i in range(2)] == [302, 302]
+            rv = self.app.post('/index', data={'post': 'hi'})
+            assert rv.status_code == 429 and 90 < int(rv.headers['Retry-After']) <= 100
+            assert self.app.get('/index').status_code == 200  # reads are not limited
+            assert self.app.get('/follow/john').status_code == 429
+        assert Post.query.count() == posts + 2
+        # shedding: too many writes in progress, or the lock waited on for too long
+        with mock.patch.dict(app.config, RATE_LIMIT_USER_RATE=None, SHED_MAX_WRITES=1):
+            admission.writing = 1
+            rv = self.app.post('/index', data={'post': 'hi'})
+            assert rv.status_code == 503 and rv.headers['Retry-After'] == '1'
+            admission.writing = 0
+            assert self.app.post('/index', data={'post': 'hi'}).status_code == 302 and admission.writing == 0
+            admission.observe_lock_wait(10)
+            assert self.app.post('/index', data={'post': 'hi'}).status_code == 503
+            assert admission.average_lock_wait(time.time() + 30) < app.config['SHED_MAX_LOCK_WAIT']
+        # the lock wait is measured on the writes
+        admission.lock_wait_at = 0
+        db.session.add(Post(body='measured', author=u))
+        db.session.commit()
+        assert admission.lock_wait_at > 0 and 'microblog_refused_total{status="429"} 2' in admission.metrics()
+        # and on the ones that fail, like those giving up on the lock
+        admission.lock_wait_at = 0
+        with self.assertRaises(OperationalError):
+            db.session.execute('INSERT INTO no_such_table VALUES (1)')
+        db.session.rollback()
+        assert admission.lock_wait_at > 0
+
+    def test_admission_concurrent_writes(self):
+        # with the default config, a worker whose threads all take a write sheds the last one
+        max_writes = app.config['SHED_MAX_WRITES']
+        assert max_writes < app.config['SERVER_THREADS']
+        u = User(nickname='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        self.login(u)
+        main, release = threading.current_thread(), threading.Event()
+
+        def hold_writes(conn, cursor, statement, parameters, context, executemany):
+            if threading.current_thread() is not main and statement.lstrip().upper().startswith('INSERT'):
+                release.wait(10)
+
+        statuses = []
+
+        def write(client):
+            statuses.append(client.post('/index', data={'post': 'hi'}).status_code)
+
+        clients = [app.test_client() for i in range(max_writes)]
+        for client in clients:
+            with client.session_transaction() as session:
+                session['user_id'] = session['_user_id'] = str(u.id)
+        threads = [threading.Thread(target=write, args=(client,)) for client in clients]
+        event.listen(Engine, 'before_cursor_execute', hold_writes)
+        try:
+            for thread in threads:
+                thread.start()
+            deadline = time.time() + 10
+            while admission.writing < max_writes and time.time() < deadline:
+                time.sleep(0.01)
+            assert admission.writing == max_writes
+            assert self.app.post('/index', data={'post': 'hi'}).status_code == 503
+            assert self.app.get('/index').status_code == 200
+        finally:
+            release.set()
+            for thread in threads:
+                thread.join()
+            event.remove(Engine, 'before_cursor_execute', hold_writes)
+        assert statuses == [302] * max_writes and admission.writing == 0
+        assert self.app.post('/index', data={'post': 'hi'}).status_code == 302
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file